@@ -0,0 +1,336 @@
+""" Globus tokens shared by every client, thread and watcher process on a host.
+
+Tokens are kept in a SQLite database (the configured `token_store`, with a
+`.sqlite` suffix; tokens in an existing JSON token file are imported once).
+Before renewing a token a process re-reads it from the database, and it
+stores the renewed token under the database's write lock (BEGIN IMMEDIATE)
+only if no other process stored one meanwhile, so processes finding the same
+token expiring mostly adopt the first one's result. Globus Auth is called
+outside the write lock, so other processes never wait on it.
+
+`TokenManager.start()` runs a background thread that renews tokens `margin`
+seconds before they expire, so API calls made by the dispatch workers find a
+valid access token in memory instead of refreshing it themselves. Clients
+passed through `share_session` reuse one pooled HTTP session.
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+
+import globus_sdk
+import requests
+
+from globus_sdk.authorizers import GlobusAuthorizer
+from requests.adapters import HTTPAdapter
+
+from governor import RequestGovernor
+from metrics import REGISTRY
+from mock_globus import mock_authorizer, mock_url
+from settings import LOGGER
+
+
+TOKEN_REFRESHES = REGISTRY.counter(
+    'globus_token_refreshes_total',
+    'Access tokens renewed, by who noticed the expiry (background or request) and whether this process '
+    'called Globus Auth (refreshed) or took the token another process stored (adopted)',
+    ('source', 'outcome'))
+
+# Connections kept per host by the shared session, enough for every dispatch worker
+POOL_SIZE = 32
+
+# Globus Auth gets a rate limit and circuit of its own, so that throttling or an outage
+# of the Flows service does not hold up token renewal
+AUTH_GOVERNOR = RequestGovernor(rate=2.0, burst=5)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    client_id TEXT NOT NULL,
+    resource_server TEXT NOT NULL,
+    token_data TEXT NOT NULL,
+    expires_at INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (client_id, resource_server)
+);
+"""
+
+_UPSERT = """
+INSERT INTO tokens (client_id, resource_server, token_data, expires_at, updated)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (client_id, resource_server) DO UPDATE SET
+    token_data = excluded.token_data,
+    expires_at = excluded.expires_at,
+    updated = excluded.updated
+"""
+
+
+def do_login_flow(native_client, scopes):
+    native_client.oauth2_start_flow(requested_scopes=scopes, refresh_tokens=True)
+    authorize_url = native_client.oauth2_get_authorize_url()
+    print(f"Please go to this URL and login:\n\n{authorize_url}\n")
+    auth_code = input("Please enter the code here: ").strip()
+    tokens = native_client.oauth2_exchange_code_for_tokens(auth_code)
+    return tokens
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def share_session(client):
+    """Make `client` send its requests through the process-wide pooled session; return it."""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=POOL_SIZE)
+            _SESSION.mount('https://', adapter)
+            _SESSION.mount('http://', adapter)
+    client.transport.session = _SESSION
+    return client
+
+
+@contextlib.contextmanager
+def user_only_umask():
+    """Create files readable and writable by their owner only, as the SDK's token storage does."""
+    old = os.umask(0o177)
+    try:
+        yield
+    finally:
+        os.umask(old)
+
+
+class TokenStore:
+    """Token data by resource server for one client id, in a SQLite database several processes may share."""
+
+    def __init__(self, db_path: 'str', client_id: 'str'):
+        self.db_path = os.path.abspath(os.path.expanduser(db_path))
+        self.client_id = client_id
+        self._lock = threading.Lock()
+        if not os.path.isdir(d := os.path.dirname(self.db_path)):
+            os.makedirs(d)
+        # Refresh tokens are secrets: SQLite creates the -wal and -shm files with the database's mode
+        with user_only_umask():
+            for path in (self.db_path, self.db_path + '-wal', self.db_path + '-shm'):
+                if os.path.exists(path):
+                    os.chmod(path, 0o600)
+            # Transactions are begun explicitly, see locked()
+            self._conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def get(self, resource_server: 'str') -> 'dict|None':
+        with self._lock:
+            return self._get(resource_server)
+
+    def _get(self, resource_server):
+        row = self._conn.execute(
+            'SELECT token_data FROM tokens WHERE client_id = ? AND resource_server = ?',
+            (self.client_id, resource_server)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _put(self, by_resource_server):
+        now = time.time()
+        self._conn.executemany(_UPSERT, [
+            (self.client_id, rs, json.dumps(dict(data)), int(data['expires_at_seconds']), now)
+            for rs, data in by_resource_server.items()])
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front; other processes wait for it up to the timeout
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def put(self, by_resource_server: 'dict') -> None:
+        with self._transaction():
+            self._put(by_resource_server)
+
+    def locked(self, resource_server: 'str', update) -> 'dict':
+        """Call `update(stored)` holding the database write lock, and store what it returns if not None.
+
+        `stored` is the current token data of `resource_server`; `update` returns
+        token data by resource server. Other processes calling locked() wait
+        until this one has committed. Returns the token data now stored.
+        """
+        with self._transaction():
+            stored = self._get(resource_server)
+            if (by_resource_server := update(stored)) is not None:
+                self._put(by_resource_server)
+                stored = by_resource_server.get(resource_server, stored)
+        return stored
+
+    def import_json(self, path: 'str') -> 'int':
+        """Copy the tokens of a `SimpleJSONFileAdapter` file into an empty store; return how many were imported."""
+        from globus_sdk.tokenstorage import SimpleJSONFileAdapter
+        if not (adapter := SimpleJSONFileAdapter(path)).file_exists():
+            return 0
+        if not (tokens := adapter.get_by_resource_server()):
+            return 0
+        with self._transaction():
+            # Another process may have imported them first
+            if self._conn.execute('SELECT 1 FROM tokens WHERE client_id = ?', (self.client_id,)).fetchone():
+                return 0
+            self._put(tokens)
+        return len(tokens)
+
+
+class SharedTokenAuthorizer(GlobusAuthorizer):
+    """Authorizes requests with the access token the TokenManager holds for one resource server."""
+
+    def __init__(self, tokens: 'TokenManager', resource_server: 'str'):
+        self.tokens = tokens
+        self.resource_server = resource_server
+
+    def get_authorization_header(self) -> 'str':
+        return f"Bearer {self.tokens.access_token(self.resource_server)}"
+
+    def handle_missing_authorization(self) -> bool:
+        # The token was rejected before its expiry, e.g. revoked; get another one
+        try:
+            self.tokens.refresh(self.resource_server, self.tokens.min_lifetime,
+                                stale=self.tokens.token_data(self.resource_server))
+        except globus_sdk.GlobusAPIError:
+            return False
+        return True
+
+
+class TokenManager:
+    def __init__(self, native_client, token_store: 'str', margin: 'float'=600.0, interval: 'float'=60.0,
+                 min_lifetime: 'float'=30.0):
+        """Tokens of `native_client` kept in the SQLite database next to `token_store`.
+
+        The background refresher wakes every `interval` seconds and renews
+        tokens with less than `margin` seconds left. A request renews the
+        token itself only if it has less than `min_lifetime` seconds left.
+        """
+        self.native_client = native_client
+        self.margin = margin
+        self.interval = interval
+        self.min_lifetime = min_lifetime
+        path = Path(os.path.expanduser(token_store))
+        self.store = TokenStore(str(path.with_suffix('.sqlite')), native_client.client_id)
+        if path.suffix != '.sqlite' and (n := self.store.import_json(str(path))):
+            LOGGER.info(f"Imported {n} tokens from {path} into {self.store.db_path}")
+        self._tokens = {}
+        self._lock = threading.Lock()
+        # One renewal at a time in this process; the others wait and find its result
+        self._refreshing = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> 'TokenManager':
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="token-refresher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+
+    def close(self) -> None:
+        self.stop()
+        self.store.close()
+
+    def login(self, resource_server: 'str', scopes) -> 'dict':
+        """Load the tokens of `resource_server`, logging in interactively if none are stored."""
+        with self._lock:
+            if (data := self._tokens.get(resource_server)) is None:
+                if (data := self.store.get(resource_server)) is None:
+                    response = do_login_flow(native_client=self.native_client, scopes=scopes)
+                    self.store.put(response.by_resource_server)
+                    data = response.by_resource_server[resource_server]
+                self._tokens[resource_server] = data
+        return data
+
+    def authorizer(self, resource_server: 'str', scopes) -> 'SharedTokenAuthorizer':
+        self.login(resource_server, scopes)
+        return SharedTokenAuthorizer(self, resource_server)
+
+    def token_data(self, resource_server: 'str') -> 'dict':
+        return self._tokens[resource_server]
+
+    def access_token(self, resource_server: 'str') -> 'str':
+        data = self._tokens[resource_server]
+        if data['expires_at_seconds'] - time.time() < self.min_lifetime:
+            # The refresher is behind or failed; renew on the request path
+            data = self.refresh(resource_server, self.min_lifetime, source='request')
+        return data['access_token']
+
+    def expires_in(self) -> 'dict':
+        now = time.time()
+        return {rs: data['expires_at_seconds'] - now for rs, data in list(self._tokens.items())}
+
+    def refresh(self, resource_server: 'str', min_lifetime: 'float', stale: 'dict|None'=None,
+                source: 'str'='request') -> 'dict':
+        """Make sure the token of `resource_server` has `min_lifetime` seconds left and is not `stale`."""
+        def fresh(data):
+            return (data is not None and data['expires_at_seconds'] - time.time() >= min_lifetime
+                    and (stale is None or data['access_token'] != stale['access_token']))
+
+        with self._refreshing:
+            if fresh(data := self._tokens[resource_server]):
+                return data
+            outcome = 'adopted'
+            # Another process may have renewed it already
+            if not fresh(stored := self.store.get(resource_server)):
+                current = stored if stored is not None else data
+                try:
+                    response = AUTH_GOVERNOR.call(self.native_client.oauth2_refresh_token, current['refresh_token'])
+                except globus_sdk.GlobusAPIError:
+                    # The refresh token may have been rotated by another process renewing at the same time
+                    if not fresh(stored := self.store.get(resource_server)):
+                        raise
+                else:
+                    renewed = {}
+                    for rs, d in response.by_resource_server.items():
+                        # Globus Auth may leave the refresh token out of the response when it does not rotate it
+                        renewed[rs] = {**d, 'refresh_token': d.get('refresh_token') or current['refresh_token']}
+
+                    def update(latest):
+                        nonlocal outcome
+                        if latest != stored and fresh(latest):
+                            # Renewed by another process while we called Globus Auth; its refresh token is current
+                            return None
+                        outcome = 'refreshed'
+                        return renewed
+
+                    stored = self.store.locked(resource_server, update)
+            with self._lock:
+                data = self._tokens[resource_server] = stored
+        TOKEN_REFRESHES.labels(source, outcome).inc()
+        LOGGER.info(f"Token for {resource_server} {outcome}, valid for {data['expires_at_seconds'] - time.time():.0f}s")
+        return data
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            for resource_server, expires_in in self.expires_in().items():
+                if expires_in >= self.margin:
+                    continue
+                try:
+                    self.refresh(resource_server, self.margin, source='background')
+                except Exception:
+                    LOGGER.exception(f"Refreshing the token for {resource_server} failed")
+
+
+def get_authorizer(tokens: 'TokenManager|None', resource_server: 'str', scopes):
+    if mock_url() is not None:
+        # The local mock service accepts any token
+        return mock_authorizer()
+    return tokens.authorizer(resource_server, scopes)
@@ -0,0 +1,135 @@
+""" Coalesce triggered files into batches submitted as a single flow run.
+
+A `Batcher` is a drop-in flow runner: the dispatcher calls it once per ready
+file and it hands lists of files to a batch runner. A batch is flushed when
+it reaches `max_files` files or `max_bytes` bytes, or `window` seconds after
+its first file arrived, whichever comes first. With `group_of`, files with
+different `group_of(path)`, e.g. files of different directories, are never
+put in the same batch.
+"""
+import os
+import threading
+import time
+
+from journal import SUBMITTED, FAILED
+from metrics import REGISTRY, SPANS
+from settings import LOGGER
+
+
+BATCH_FILES = REGISTRY.histogram(
+    'watcher_batch_files', 'Files per submitted batch', buckets=(1, 10, 50, 100, 250, 500, 1000, 5000, 10000))
+
+
+class _Batch:
+    __slots__ = ('items', 'bytes', 'opened')
+
+    def __init__(self):
+        self.items = {}
+        self.bytes = 0
+        self.opened = time.monotonic()
+
+
+class Batcher:
+    def __init__(self, BatchRunner, window: 'float'=5.0, max_files: 'int'=1000,
+                 max_bytes: 'int|None'=None, journal=None, tracker=None, group_of=None):
+        self.BatchRunner = BatchRunner
+        self.group_of = group_of
+        self.journal = journal
+        self.tracker = tracker
+        self.window = window
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._batches = {}
+        self._stopped = False
+        self._thread = None
+        self.batches = 0
+        self.files = 0
+
+    def start(self) -> None:
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="batcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the window timer and flush whatever is pending."""
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+        self.flush()
+
+    def __call__(self, path: 'str') -> None:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        group = None if self.group_of is None else self.group_of(path)
+        with self._lock:
+            if (pending := self._batches.get(group)) is None:
+                pending = self._batches[group] = _Batch()
+                self._wakeup.notify()
+            if path in pending.items:
+                return None
+            pending.items[path] = size
+            pending.bytes += size
+            full = len(pending.items) >= self.max_files or (
+                self.max_bytes is not None and pending.bytes >= self.max_bytes)
+            batch = self._take(group) if full else None
+        if batch:
+            self._submit(batch)
+
+    def flush(self) -> None:
+        with self._lock:
+            batches = [self._take(group) for group in list(self._batches)]
+        for batch in batches:
+            self._submit(batch)
+
+    def _take(self, group) -> 'list':
+        return list(self._batches.pop(group).items)
+
+    def _submit(self, batch: 'list') -> None:
+        self.batches += 1
+        self.files += len(batch)
+        BATCH_FILES.observe(len(batch))
+        if self.tracker is not None:
+            self.tracker.acquire()
+        LOGGER.info("Submitting batch of %d files", len(batch))
+        try:
+            run_id = self.BatchRunner(batch)
+        except Exception as e:
+            LOGGER.exception(f"Batch runner failed for {len(batch)} files")
+            self._journal(batch, FAILED, error=str(e))
+            run_id = None
+        else:
+            if run_id is not None:
+                self._journal(batch, SUBMITTED, run_id=run_id)
+                for path in batch:
+                    SPANS.mark(path, 'submitted')
+        if self.tracker is not None:
+            if run_id is None:
+                self.tracker.release()
+            else:
+                self.tracker.track(run_id, batch)
+
+    def _journal(self, batch: 'list', state: 'str', **kwargs) -> None:
+        if self.journal is not None:
+            for path in batch:
+                self.journal.mark(path, state, **kwargs)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                while not self._stopped and not (due := [g for g, b in self._batches.items()
+                                                         if time.monotonic() - b.opened >= self.window]):
+                    timeout = None if not self._batches else max(
+                        0.0, min(b.opened for b in self._batches.values()) + self.window - time.monotonic())
+                    self._wakeup.wait(timeout)
+                if self._stopped:
+                    return None
+                batches = [self._take(group) for group in due]
+            for batch in batches:
+                self._submit(batch)
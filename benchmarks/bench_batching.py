@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+""" Compare per-file and batched flow submission.
+
+An instrument burst of small files is fed through the Dispatcher to a
+simulated Flows service. Each run costs `--api-latency` seconds to submit and
+its transfer task completes `--task-overhead` + `--per-file` * n seconds
+later. Reports runs submitted, runs per minute and end-to-end delivery time
+(file ready -> its transfer task done) for each mode.
+
+    python benchmarks/bench_batching.py --files 5000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batching import Batcher
+from dispatch import Dispatcher
+from readiness import ReadinessEngine
+
+
+class ImmediateReadiness(ReadinessEngine):
+    name = 'immediate'
+
+    def when_ready(self, path, callback):
+        callback(path, 0.0)
+
+
+class SimulatedFlows:
+    def __init__(self, api_latency, task_overhead, per_file):
+        self.api_latency = api_latency
+        self.task_overhead = task_overhead
+        self.per_file = per_file
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.delivered = {}
+
+    def run(self, paths):
+        time.sleep(self.api_latency)
+        done = time.monotonic() + self.task_overhead + self.per_file * len(paths)
+        with self.lock:
+            self.runs += 1
+            for p in paths:
+                self.delivered[p] = done
+        return f"run-{self.runs}"
+
+
+def bench(mode, paths, args):
+    flows = SimulatedFlows(args.api_latency, args.task_overhead, args.per_file)
+    if mode == 'batched':
+        runner = Batcher(flows.run, window=args.window, max_files=args.max_files)
+        runner.start()
+    else:
+        runner = lambda p: flows.run([p])
+
+    dispatcher = Dispatcher(runner, ImmediateReadiness(), workers=args.workers, queue_size=len(paths))
+    dispatcher.start()
+    arrived = {}
+    start = time.monotonic()
+    for p in paths:
+        arrived[p] = time.monotonic()
+        dispatcher.submit(p)
+    dispatcher.join()
+    if mode == 'batched':
+        runner.stop()
+    submitted = time.monotonic() - start
+    dispatcher.stop()
+
+    latencies = sorted(flows.delivered[p] - arrived[p] for p in paths)
+    last = max(flows.delivered.values()) - start
+    return {
+        'mode': mode,
+        'files': len(paths),
+        'runs': flows.runs,
+        'submit_seconds': round(submitted, 3),
+        'runs_per_minute': round(flows.runs / submitted * 60, 1),
+        'delivery_p50': round(statistics.median(latencies), 3),
+        'delivery_p95': round(latencies[int(0.95 * (len(latencies) - 1))], 3),
+        'all_delivered_seconds': round(last, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-file vs batched flow submission")
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Seconds per run_flow call")
+    parser.add_argument("--task-overhead", type=float, default=2.0, help="Fixed seconds per transfer task")
+    parser.add_argument("--per-file", type=float, default=0.001, help="Seconds per file within a task")
+    parser.add_argument("--window", type=float, default=1.0)
+    parser.add_argument("--max-files", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(args.files):
+            paths.append(p := os.path.join(tmp, f"{i:06d}.dat"))
+            with open(p, 'wb') as stream:
+                stream.write(b'x' * 1024)
+
+        for mode in ['per-file', 'batched']:
+            print(json.dumps(bench(mode, paths, args)))
+
+
+if __name__ == "__main__":
+    main()
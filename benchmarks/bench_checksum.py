@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+""" Checksum throughput and deduplication savings of the --dedup stage.
+
+Writes `--files` files of `--size` MiB of random data into a scratch
+directory and reports, as JSON lines:
+
+    hash        GB/s hashing every file with checksum.Hasher for each
+                `--workers` and `--buffer` (KiB) combination
+    dedup       a checksum.Deduplicator in front of a flow runner that only
+                counts calls: first every file is delivered, then the
+                instrument "re-exports" them (same names and content, new
+                inodes) plus `--changed` files with new content; reports the
+                runs started, files skipped and bytes saved for the re-export
+                and the time spent in the stage per file
+
+    python benchmarks/bench_checksum.py --files 64 --size 16 --workers 1 2 4 8
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from checksum import Deduplicator, DigestIndex, Hasher
+
+
+def write(directory, files, size, seed=b''):
+    paths = []
+    for i in range(files):
+        path = os.path.join(directory, f"{i:05d}.dat")
+        with open(path, 'wb') as f:
+            f.write(seed + os.urandom(size - len(seed)))
+        paths.append(path)
+    return paths
+
+
+def reexport(paths, changed):
+    # Rewrite every file through a temporary name, as exporters do, changing the first `changed`
+    for i, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if i < changed:
+            data = b'changed' + data[7:]
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+
+def bench_hash(paths, algorithm, workers, buffer_kib):
+    hasher = Hasher(algorithm, workers=workers, buffer_size=buffer_kib << 10)
+    start = time.perf_counter()
+    for future in [hasher.submit(p) for p in paths]:
+        future.result()
+    elapsed = time.perf_counter() - start
+    hasher.close()
+    total = sum(os.path.getsize(p) for p in paths)
+    return {'phase': 'hash', 'algorithm': algorithm, 'workers': workers, 'buffer_kib': buffer_kib,
+            'files': len(paths), 'bytes': total, 'seconds': round(elapsed, 3),
+            'gb_per_sec': round(total / elapsed / 1e9, 3)}
+
+
+def bench_dedup(tmp, paths, algorithm, workers, changed):
+    runs = []
+    index = DigestIndex(os.path.join(tmp, 'digests.sqlite'))
+    hasher = Hasher(algorithm, workers=workers, index=index)
+    dedup = Deduplicator(lambda p: runs.append(p) or f"run-{len(runs)}", hasher, index,
+                         destination_of=lambda p: f"collection:{os.path.basename(p)}")
+    results = []
+    for phase in ('first', 'reexport'):
+        if phase == 'reexport':
+            reexport(paths, changed)
+        before = len(runs)
+        start = time.perf_counter()
+        for p in paths:
+            dedup(p)
+        elapsed = time.perf_counter() - start
+        results.append({'phase': f"dedup-{phase}", 'files': len(paths), 'runs': len(runs) - before,
+                        'skipped': dedup.skipped, 'saved_bytes': dedup.saved_bytes,
+                        'ms_per_file': round(1000 * elapsed / len(paths), 3)})
+    hasher.close()
+    index.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark checksumming and deduplication")
+    parser.add_argument("--files", type=int, default=32)
+    parser.add_argument("--size", type=int, default=16, help="MiB per file")
+    parser.add_argument("--algorithm", default='sha256')
+    parser.add_argument("--workers", type=int, nargs="*", default=[1, 2, 4])
+    parser.add_argument("--buffer", type=int, nargs="*", default=[64, 1024, 8192], help="Read sizes in KiB")
+    parser.add_argument("--changed", type=int, default=4, help="Re-exported files with new content")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data = os.path.join(tmp, 'data')
+        os.makedirs(data)
+        paths = write(data, args.files, args.size << 20)
+        for workers in args.workers:
+            for buffer_kib in args.buffer:
+                print(json.dumps(bench_hash(paths, args.algorithm, workers, buffer_kib)), flush=True)
+        for result in bench_dedup(tmp, paths, args.algorithm, max(args.workers), args.changed):
+            print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
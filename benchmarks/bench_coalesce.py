@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+""" Event storms in, submissions out: the watcher with and without --debounce.
+
+`--writers` threads each write `--files` files into a watched scratch
+directory, appending `--chunks` flushed chunks of `--chunk` KiB to each,
+`--interval` seconds apart, so that every file raises a storm of
+modification events. Every other writer writes `name.tmp` and renames it to
+`name.h5` when done, the rest write `name.h5` in place. Only `*.h5` is
+accepted. A real watchdog observer feeds watch.Handler, whose dispatcher only
+records what is submitted. Reports, as JSON lines per mode:
+
+    events          file events the Handler saw
+    submitted       submissions, and how many of them were for distinct files
+    missed          accepted files never submitted
+    early           files submitted before their writer was done
+    ready           submissions that skip the readiness check
+    settle_ms       p50/max delay from the writer being done to the submission,
+                    for the renaming and the in-place writers
+    peak_active     most files whose events were being coalesced at once
+
+    python benchmarks/bench_coalesce.py --writers 8 --files 50 --chunks 64 --debounce 0.5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from watchdog.observers import Observer
+
+from coalesce import EventCoalescer
+from matcher import PathMatcher
+from readiness import ReadinessEngine
+from watch import Handler
+
+
+class RecordingDispatcher:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.submissions = []
+
+    def submit(self, path, ready=False):
+        with self.lock:
+            self.submissions.append((path, ready, time.monotonic()))
+        return True
+
+
+class CountingReadiness(ReadinessEngine):
+    name = 'counting'
+
+    def __init__(self):
+        super().__init__()
+        self.events = 0
+
+    def notify(self, event):
+        if not event.is_directory:
+            self.events += 1
+
+
+def writer(directory, index, args, done):
+    rename = index % 2 == 1
+    chunk = os.urandom(args.chunk << 10)
+    for i in range(args.files):
+        final = os.path.join(directory, f"w{index:02d}-{i:05d}.h5")
+        path = final + '.tmp' if rename else final
+        with open(path, 'wb') as f:
+            for _ in range(args.chunks):
+                f.write(chunk)
+                f.flush()
+                time.sleep(args.interval)
+        # The writer is done once it closed the file, before any rename
+        at = time.monotonic()
+        if rename:
+            os.rename(path, final)
+        done[final] = (at, rename)
+
+
+def bench(mode, tmp, args):
+    directory = os.path.join(tmp, mode)
+    os.makedirs(directory)
+    matcher = PathMatcher(include=['*.h5'], root=directory)
+    dispatcher = RecordingDispatcher()
+    readiness = CountingReadiness()
+    coalescer = None
+    if mode == 'debounce':
+        coalescer = EventCoalescer(matcher.matches, debounce=args.debounce)
+        coalescer.emit = dispatcher.submit
+        coalescer.start()
+    handler = Handler(print, matcher, readiness=readiness, dispatcher=dispatcher, coalescer=coalescer)
+    observer = Observer()
+    observer.schedule(handler, directory, recursive=True)
+    observer.start()
+
+    done = {}
+    peak = 0
+    threads = [threading.Thread(target=writer, args=(directory, i, args, done)) for i in range(args.writers)]
+    for t in threads:
+        t.start()
+    while any(t.is_alive() for t in threads):
+        if coalescer is not None:
+            peak = max(peak, len(coalescer._paths))
+        time.sleep(0.01)
+    # Let the last events arrive and settle
+    deadline = time.monotonic() + args.debounce + 2.0
+    while time.monotonic() < deadline:
+        if coalescer is not None:
+            peak = max(peak, len(coalescer._paths))
+        time.sleep(0.05)
+    observer.stop()
+    observer.join()
+    if coalescer is not None:
+        coalescer.stop()
+
+    submitted = {}
+    for path, ready, at in dispatcher.submissions:
+        submitted.setdefault(path, (ready, at))
+    delays = {True: [], False: []}
+    for p, (_, at) in submitted.items():
+        if p in done:
+            delays[done[p][1]].append(1000 * (at - done[p][0]))
+    result = {
+        'mode': mode,
+        'files': len(done),
+        'events': readiness.events,
+        'submitted': len(dispatcher.submissions),
+        'distinct': len(submitted),
+        'missed': len(set(done) - set(submitted)),
+        'early': sum(1 for d in delays[True] + delays[False] if d < 0),
+        'ready': sum(1 for _, ready, _ in dispatcher.submissions if ready),
+        'peak_active': peak,
+    }
+    for rename, kind in ((True, 'renamed'), (False, 'in_place')):
+        if ds := sorted(delays[rename]):
+            result[f"settle_ms_p50_{kind}"] = round(ds[len(ds) // 2], 1)
+            result[f"settle_ms_max_{kind}"] = round(ds[-1], 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark event coalescing")
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--files", type=int, default=25, help="Files per writer")
+    parser.add_argument("--chunks", type=int, default=64, help="Flushed writes per file")
+    parser.add_argument("--chunk", type=int, default=64, help="KiB per write")
+    parser.add_argument("--interval", type=float, default=0.002, help="Seconds between writes")
+    parser.add_argument("--debounce", type=float, default=0.5)
+    parser.add_argument("--modes", nargs="*", default=['created', 'debounce'])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in args.modes:
+            print(json.dumps(bench(mode, tmp, args)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
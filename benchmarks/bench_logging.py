@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+""" Cost of the per-file log lines to the threads that emit them.
+
+Configures logging from conf/logging.yaml through settings.configure_logging,
+with the file handler writing into a scratch directory and the console handler
+to /dev/null, then has `--threads` threads log the lines the watcher writes for
+every file, `--files` files in all. Each mode runs in a new process:
+
+    sync          the handlers write on the calling thread, messages are
+                  f-strings (the watcher before the log queue)
+    sync-lazy     as sync, with %-style arguments
+    queue         records go through logqueue to a writer thread
+    queue-sample  as queue, keeping one in --sample per-file lines
+
+Reports, as one JSON line per mode, the time the emitting threads spent
+logging (per record and in total), the time until the last line was written
+and the number of lines written.
+
+    python benchmarks/bench_logging.py --files 20000 --threads 4 --sample 10
+"""
+import argparse
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODES = ['sync', 'sync-lazy', 'queue', 'queue-sample']
+
+
+def eager(logger, name, waited, run_id):
+    logger.info(f"File created: {name}")
+    logger.info(f"File ready: {name} (waited {waited:.3f}s)")
+    logger.info(f"source_path: /data/{name}")
+    logger.info(f"destination_path: /dest/{name}")
+    logger.info(f"Transferring {name}")
+    logger.info(f"View status at https://app.globus.org/runs/{run_id}/logs")
+
+
+def lazy(logger, name, waited, run_id):
+    logger.info("File created: %s", name)
+    logger.info("File ready: %s (waited %.3fs)", name, waited)
+    logger.info("source_path: %s", f"/data/{name}")
+    logger.info("destination_path: %s", f"/dest/{name}")
+    logger.info("Transferring %s", name)
+    logger.info("View status at https://app.globus.org/runs/%s/logs", run_id)
+
+
+def run(mode, files, threads, sample):
+    import yaml
+    import structlog
+    import logqueue
+    import settings
+
+    with open(os.path.join(ROOT, 'conf', 'logging.yaml')) as stream:
+        config = yaml.safe_load(stream)
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as devnull:
+        config = copy.deepcopy(config)
+        config['handlers']['file']['filename'] = logfile = os.path.join(tmp, 'bench.log')
+        config['handlers']['console']['stream'] = devnull
+        config['queue'] = {'enabled': mode.startswith('queue'), 'sample': sample if mode == 'queue-sample' else 1}
+        settings.configure_logging(config)
+        logger = structlog.get_logger('bench')
+        emit = eager if mode == 'sync' else lazy
+
+        spent = [0.0] * threads
+
+        def worker(k):
+            start = time.perf_counter()
+            for i in range(k, files, threads):
+                emit(logger, f"{i:08d}.dat", 0.25, f"run-{i:08d}")
+            spent[k] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pool = [threading.Thread(target=worker, args=(k,)) for k in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        emitted = time.perf_counter() - start
+        logqueue.uninstall()
+        drained = time.perf_counter() - start
+        for handler in logging.getLogger().handlers:
+            handler.close()
+        with open(logfile, 'rb') as stream:
+            lines = sum(1 for _ in stream)
+
+    records = files * 6
+    return {'mode': mode, 'files': files, 'threads': threads, 'records': records, 'lines_written': lines,
+            'caller_us_per_record': round(1e6 * sum(spent) / records, 2),
+            'caller_seconds': round(emitted, 3), 'drain_seconds': round(drained, 3),
+            'records_per_sec': round(records / emitted)}
+
+
+def isolated(fn, *args):
+    # settings configures logging when imported, so every mode gets its own interpreter
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark synchronous and queued logging")
+    parser.add_argument("--mode", nargs="*", choices=MODES, default=MODES)
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--sample", type=int, default=10, help="Keep one in N per-file lines in queue-sample mode")
+    args = parser.parse_args()
+
+    for mode in args.mode:
+        print(json.dumps(isolated(run, mode, args.files, args.threads, args.sample)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+""" Microbenchmark of watcher event classification.
+
+Classifies synthetic event paths with the previous per-pattern `str.endswith`
+loop and with a compiled PathMatcher, and reports events per second. Then
+routes paths spread over `--routes` instrument directories, once by testing
+every route's prefix in turn and once with the routing.RoutingTable trie.
+
+    python benchmarks/bench_matcher.py --events 200000 --routes 20 200
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matcher import PathMatcher
+from routing import RoutingTable
+
+
+SUFFIXES = ['.dat', '.h5', '.tif', '.txt', '.json', '.csv', '.tmp', '.part', '.log', '.png']
+
+
+def synthetic_paths(n, root, depth):
+    rnd = random.Random(0)
+    dirs = ['raw', 'processed', 'scratch', 'run_0001', 'run_0002', 'cal']
+    for i in range(n):
+        parts = [rnd.choice(dirs) for _ in range(rnd.randint(1, depth))]
+        yield os.path.join(root, *parts, f"frame_{i:08d}{rnd.choice(SUFFIXES)}")
+
+
+def endswith_loop(patterns):
+    def match(path):
+        for pattern in patterns:
+            if path.endswith(pattern):
+                return True
+        return False
+    return match
+
+
+def linear_routes(routes):
+    # One prefix test and matcher per route, deepest directory first
+    ordered = sorted(((r['path'].rstrip('/') + '/', PathMatcher(include=r['extensions'], root=r['path']))
+                      for r in routes), key=lambda r: -len(r[0]))
+
+    def resolve(path):
+        for prefix, matcher in ordered:
+            if path.startswith(prefix) and matcher.matches(path):
+                return prefix
+        return None
+    return resolve
+
+
+def bench(name, match, paths, **extra):
+    start = time.perf_counter()
+    matched = sum(1 for p in paths if match(p))
+    elapsed = time.perf_counter() - start
+    return {'matcher': name, 'events': len(paths), 'matched': matched,
+            'events_per_sec': round(len(paths) / elapsed), **extra}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark event classification")
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--routes", type=int, nargs="*", default=[20, 200], help="Numbers of routes to compare")
+    args = parser.parse_args()
+
+    root = '/data/instrument'
+    paths = list(synthetic_paths(args.events, root, args.depth))
+    include = ['.dat', '.h5', '.tif']
+
+    results = [
+        bench('endswith-loop', endswith_loop(include), paths),
+        bench('suffix-set', PathMatcher(include=include, root=root).matches, paths),
+        bench('suffix-set+exclude', PathMatcher(
+            include=include, exclude=['*.tmp', '*.part', '.*'], root=root).matches, paths),
+        bench('suffix-set+exclude+prune', PathMatcher(
+            include=include, exclude=['*.tmp', '*.part', '.*'], prune=['processed', 'scratch'],
+            root=root).matches, paths),
+        bench('globs+prune', PathMatcher(
+            include=['run_*/**/*.h5', 'frame_*.dat'], exclude=['*.tmp'], prune=['processed', 'scratch'],
+            root=root).matches, paths),
+    ]
+    flow = {'id': 'flow', 'input': {}}
+    for n in args.routes:
+        routes = [{'path': f"/data/instrument_{k:03d}", 'extensions': include} for k in range(n)]
+        routed = [p.replace(root, routes[i % n]['path'], 1) for i, p in enumerate(paths)]
+        results.append(bench('routes-linear', linear_routes(routes), routed, routes=n))
+        results.append(bench('routes-trie', RoutingTable.from_config(routes, flow).resolve, routed, routes=n))
+
+    for r in results:
+        print(json.dumps(r))
+
+
+if __name__ == "__main__":
+    main()
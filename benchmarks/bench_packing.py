@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+""" Compare per-file and packed delivery of a burst of small files.
+
+A burst of `--files` files of `--size` bytes is fed through the Dispatcher
+to a simulated Flows service. Each run costs `--api-latency` seconds to
+submit and its transfer task completes `--task-overhead` + `--per-file`
+seconds per file + bytes / `--bandwidth` later. In the packed modes the
+files go through packing.Packer, each archive is one file of the task, and
+the archive is then really unpacked with process_images(archives=...) in a
+scratch destination, whose time is added to the delivery of its files.
+Reports runs, bytes sent, archive ratio, pack and unpack time and files per
+second delivered for each mode.
+
+    python benchmarks/bench_packing.py --files 20000 --size 2048
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dispatch import Dispatcher
+from gcf_process_images import process_images
+from packing import Packer
+from readiness import ReadinessEngine
+
+
+class ImmediateReadiness(ReadinessEngine):
+    name = 'immediate'
+
+    def when_ready(self, path, callback):
+        callback(path, 0.0)
+
+
+class SimulatedTransfer:
+    def __init__(self, api_latency, task_overhead, per_file, bandwidth):
+        self.api_latency = api_latency
+        self.task_overhead = task_overhead
+        self.per_file = per_file
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.bytes = 0
+        self.delivered = {}
+        self.archives = []
+
+    def run_file(self, path):
+        time.sleep(self.api_latency)
+        size = os.path.getsize(path)
+        done = time.monotonic() + self.task_overhead + self.per_file + size / self.bandwidth
+        with self.lock:
+            self.runs += 1
+            self.bytes += size
+            self.delivered[path] = done
+        return f"run-{self.runs}"
+
+    def run_archive(self, archive, paths):
+        time.sleep(self.api_latency)
+        size = os.path.getsize(archive)
+        done = time.monotonic() + self.task_overhead + self.per_file + size / self.bandwidth
+        with self.lock:
+            self.runs += 1
+            self.bytes += size
+            self.archives.append((archive, paths, done))
+        return f"run-{self.runs}"
+
+
+def bench(mode, paths, tmp, args):
+    transfer = SimulatedTransfer(args.api_latency, args.task_overhead, args.per_file, args.bandwidth)
+    packer = None
+    if mode == 'per-file':
+        runner = transfer.run_file
+    else:
+        packer = runner = Packer(transfer.run_archive, os.path.join(tmp, f"staging-{mode}"),
+                                 FileRunner=transfer.run_file, max_files=args.max_files, window=args.window,
+                                 compression='zstd' if mode == 'packed-zstd' else None)
+        packer.start()
+
+    dispatcher = Dispatcher(runner, ImmediateReadiness(), workers=args.workers, queue_size=len(paths))
+    dispatcher.start()
+    start = time.monotonic()
+    for p in paths:
+        dispatcher.submit(p)
+    dispatcher.join()
+    if packer is not None:
+        packer.stop()
+    submitted = time.monotonic() - start
+    dispatcher.stop()
+
+    unpack_seconds = 0.0
+    if packer is not None:
+        # The compute step unpacks each archive once the transfer task is done
+        destination = os.path.join(tmp, f"destination-{mode}")
+        os.makedirs(destination)
+        for archive, members, done in transfer.archives:
+            shutil.copy(archive, destination)
+            t = time.perf_counter()
+            process_images(destination, workers=1, archives=[os.path.basename(archive)])
+            elapsed = time.perf_counter() - t
+            unpack_seconds += elapsed
+            for p in members:
+                transfer.delivered[p] = done + elapsed
+
+    last = max(transfer.delivered.values()) - start
+    stats = packer.stats() if packer is not None else {}
+    return {
+        'mode': mode,
+        'files': len(paths),
+        'runs': transfer.runs,
+        'bytes_sent': transfer.bytes,
+        'ratio': stats.get('ratio'),
+        'submit_seconds': round(submitted, 3),
+        'unpack_seconds': round(unpack_seconds, 3),
+        'all_delivered_seconds': round(last, 3),
+        'files_per_sec': round(len(paths) / last, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-file vs packed delivery")
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--size", type=int, default=4096, help="Bytes per file")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Seconds per run_flow call")
+    parser.add_argument("--task-overhead", type=float, default=2.0, help="Fixed seconds per transfer task")
+    parser.add_argument("--per-file", type=float, default=0.02, help="Seconds per file within a task")
+    parser.add_argument("--bandwidth", type=float, default=100e6, help="Bytes per second of a task")
+    parser.add_argument("--window", type=float, default=2.0)
+    parser.add_argument("--max-files", type=int, default=10000)
+    parser.add_argument("--modes", nargs="*", default=['per-file', 'packed', 'packed-zstd'])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'scan')
+        os.makedirs(source)
+        paths = []
+        # Half random, half repetitive, so that compression has something to do
+        for i in range(args.files):
+            paths.append(p := os.path.join(source, f"{i:06d}.dat"))
+            with open(p, 'wb') as stream:
+                stream.write(os.urandom(args.size // 2) + bytes(j % 256 for j in range(args.size - args.size // 2)))
+
+        for mode in args.modes:
+            print(json.dumps(bench(mode, paths, tmp, args)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
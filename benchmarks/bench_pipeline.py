@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+""" End-to-end benchmark of the watch -> dispatch pipeline.
+
+A FileTrigger watches a scratch directory with a recording flow runner while a
+separate writer process generates one of these workloads:
+
+    burst    --files files written back to back
+    steady   --files files at --rate files/sec
+    slow     --writers files at a time, each held open for --hold seconds
+             while it is written in --chunks chunks
+    deep     --files files spread over a tree --depth directories deep with
+             --fanout subdirectories each, created as the files arrive
+
+The writer records when it closed each file; the runner records when the flow
+was started for it. Reported per (workload, readiness backend), as one JSON
+line each:
+
+    latency_p50/p95/p99   file closed -> flow started, seconds
+    events_per_sec        flows started per second of the run
+    missed, duplicates    files never dispatched, files dispatched twice
+    cpu_seconds, rss_mb   CPU time and peak RSS of the watcher process
+
+    python benchmarks/bench_pipeline.py --workload burst steady --readiness procfd inotify --files 500
+    python benchmarks/bench_pipeline.py --workload slow --readiness quiescence --quiet-period 1 --output runs.jsonl
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from journal import Journal
+from readiness import make_readiness
+from watch import FileTrigger
+
+
+class RecordingRunner:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.started = {}
+        self.duplicates = 0
+
+    def __call__(self, path):
+        now = time.monotonic()
+        with self.lock:
+            if path in self.started:
+                self.duplicates += 1
+            else:
+                self.started[path] = now
+        if self.latency:
+            time.sleep(self.latency)
+        return None
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, interval=0.1):
+        super().__init__(name="rss-sampler", daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def rss(self):
+        try:
+            with open('/proc/self/statm') as stream:
+                return int(stream.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            # ru_maxrss is the peak over the life of the process, in KiB on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+
+def write_file(path, size, chunks=1, hold=0.0):
+    block = b'x' * max(1, size // chunks)
+    with open(path, 'wb') as stream:
+        for i in range(chunks):
+            stream.write(block)
+            stream.flush()
+            if hold and i < chunks - 1:
+                time.sleep(hold / (chunks - 1))
+    return time.monotonic()
+
+
+def burst(root, args):
+    return {(p := os.path.join(root, f"{i:06d}.dat")): write_file(p, args.size) for i in range(args.files)}
+
+
+def steady(root, args):
+    closed = {}
+    start = time.monotonic()
+    for i in range(args.files):
+        if (delay := start + i / args.rate - time.monotonic()) > 0:
+            time.sleep(delay)
+        closed[p] = write_file(p := os.path.join(root, f"{i:06d}.dat"), args.size)
+    return closed
+
+
+def slow(root, args):
+    closed = {}
+    lock = threading.Lock()
+    names = iter(range(args.files))
+
+    def writer():
+        for i in names:
+            done = write_file(p := os.path.join(root, f"{i:06d}.dat"), args.size, args.chunks, args.hold)
+            with lock:
+                closed[p] = done
+
+    threads = [threading.Thread(target=writer) for _ in range(args.writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return closed
+
+
+def deep(root, args):
+    closed = {}
+    for i in range(args.files):
+        parts, n = [], i
+        for _ in range(args.depth):
+            parts.append(f"d{n % args.fanout}")
+            n //= args.fanout
+        os.makedirs(directory := os.path.join(root, *parts), exist_ok=True)
+        closed[p] = write_file(p := os.path.join(directory, f"{i:06d}.dat"), args.size)
+    return closed
+
+
+WORKLOADS = {'burst': burst, 'steady': steady, 'slow': slow, 'deep': deep}
+
+
+def generate(workload, root, args, go, results):
+    go.wait()
+    results.put(WORKLOADS[workload](root, args))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(q * len(values)))], 4)
+
+
+def bench(workload, backend, args):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'watch')
+        os.mkdir(root)
+
+        # The writer is started before the trigger changes directory, and writes only once told to
+        ctx = multiprocessing.get_context('spawn')
+        go = ctx.Event()
+        results = ctx.Queue()
+        writer = ctx.Process(target=generate, args=(workload, root, args, go, results), daemon=True)
+        writer.start()
+
+        kwargs = {'interval': args.interval}
+        if backend == 'quiescence':
+            kwargs['quiet_period'] = args.quiet_period
+        journal = Journal(os.path.join(tmp, 'journal.sqlite')).open() if args.journal else None
+        runner = RecordingRunner(args.api_latency)
+        trigger = FileTrigger(
+            root, ['.dat'], FlowRunner=runner, readiness=make_readiness(backend, **kwargs),
+            workers=args.workers, queue_size=args.queue_size, stats_interval=0, journal=journal,
+            catch_up=False)
+
+        sampler = RssSampler()
+        sampler.start()
+        cpu = resource.getrusage(resource.RUSAGE_SELF)
+        thread = threading.Thread(target=trigger.run, name="trigger", daemon=True)
+        thread.start()
+        while not trigger.observer.is_alive():
+            time.sleep(0.01)
+
+        start = time.monotonic()
+        go.set()
+        closed = results.get()
+        writer.join()
+        written = time.monotonic()
+
+        # Wait for the last dispatch, or give up after --settle seconds without progress
+        progress, last = time.monotonic(), 0
+        while len(runner.started) < len(closed) and time.monotonic() - progress < args.settle:
+            time.sleep(0.05)
+            if (n := len(runner.started)) != last:
+                progress, last = time.monotonic(), n
+        finished = time.monotonic()
+        stats = trigger.stats()
+
+        trigger.stop()
+        thread.join()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        sampler.stopped.set()
+        sampler.join()
+        if journal is not None:
+            journal.close()
+        os.chdir(cwd)
+
+    latencies = sorted(runner.started[p] - t for p, t in closed.items() if p in runner.started)
+    dispatched = len(latencies)
+    elapsed = (max(runner.started.values()) if runner.started else finished) - start
+    return {
+        'workload': workload,
+        'readiness': backend,
+        'files': len(closed),
+        'dispatched': dispatched,
+        'missed': len(closed) - dispatched,
+        'duplicates': runner.duplicates,
+        'dropped': stats['dispatch']['dropped'],
+        'write_seconds': round(written - start, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'events_per_sec': round(dispatched / elapsed, 1) if elapsed > 0 else None,
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_p99': percentile(latencies, 0.99),
+        'latency_max': round(latencies[-1], 4) if latencies else None,
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime - cpu.ru_utime - cpu.ru_stime, 3),
+        'rss_mb': round(sampler.peak / 2 ** 20, 1),
+        'workers': args.workers,
+        'journal': args.journal,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the watch -> dispatch pipeline")
+    parser.add_argument("--workload", nargs="*", choices=list(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument("--readiness", nargs="*", choices=["procfd", "inotify", "quiescence"],
+                        default=["procfd", "inotify"])
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size", type=int, default=4096, help="Bytes per file")
+    parser.add_argument("--rate", type=float, default=100.0, help="Files/sec of the steady workload")
+    parser.add_argument("--writers", type=int, default=8, help="Files held open at once by the slow workload")
+    parser.add_argument("--hold", type=float, default=2.0, help="Seconds a slow writer keeps its file open")
+    parser.add_argument("--chunks", type=int, default=4, help="Writes per file of the slow workload")
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=4, help="Dispatch workers")
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--interval", type=float, default=1.0, help="Readiness polling interval")
+    parser.add_argument("--quiet-period", type=float, default=5.0, help="Quiescence backend quiet period")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Seconds per simulated run_flow call")
+    parser.add_argument("--journal", action="store_true", help="Journal every file in a scratch SQLite database")
+    parser.add_argument("--settle", type=float, default=30.0,
+                        help="Seconds without a dispatch after which the remaining files count as missed")
+    parser.add_argument("--output", type=str, help="Also append the results to this JSON lines file")
+    args = parser.parse_args()
+
+    meta = {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+    for workload in args.workload:
+        for backend in args.readiness:
+            line = json.dumps({**bench(workload, backend, args), **meta})
+            print(line, flush=True)
+            if args.output:
+                with open(args.output, 'a', encoding='utf-8') as stream:
+                    stream.write(line + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+""" Cost of one polling cycle against the size of the tree and the churn.
+
+Builds a tree of `--dirs` directories holding `--files` files in all in a
+scratch directory, then for each churn level writes that many new files into
+random directories and times one cycle of:
+
+    watchdog      watchdog's PollingObserver cycle: a DirectorySnapshot of
+                  the whole tree and its diff with the previous one
+    indexed       polling.PollingObserver.poll(), which stats directories
+                  and lists only the changed ones
+
+Reports one JSON line per observer and churn level with the cycle time, the
+directories listed and the created events seen.
+
+    python benchmarks/bench_polling.py --dirs 2000 --files 200000 --churn 0 10 1000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.utils.dirsnapshot import DirectorySnapshot, DirectorySnapshotDiff
+
+from polling import PollingObserver
+
+
+class Counting(FileSystemEventHandler):
+    def __init__(self):
+        self.created = 0
+
+    def on_created(self, event):
+        self.created += not event.is_directory
+
+
+def build(root, dirs, files):
+    paths = []
+    for d in range(dirs):
+        path = os.path.join(root, f"run_{d // 100:03d}", f"scan_{d:05d}")
+        os.makedirs(path)
+        paths.append(path)
+    for i in range(files):
+        with open(os.path.join(paths[i % dirs], f"{i:08d}.dat"), 'wb'):
+            pass
+    return paths
+
+
+def churn(paths, n, tag):
+    for i in range(n):
+        with open(os.path.join(random.choice(paths), f"{tag}_{i:06d}.dat"), 'wb'):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark polling observers")
+    parser.add_argument("--dirs", type=int, default=1000)
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--churn", type=int, nargs="*", default=[0, 10, 1000])
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args()
+
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'tree')
+        paths = build(root, args.dirs, args.files)
+
+        handler = Counting()
+        observer = PollingObserver(workers=args.workers)
+        start = time.perf_counter()
+        observer.schedule(handler, root, recursive=True)
+        index_seconds = time.perf_counter() - start
+        # Directories written just now are listed again until their mtime tick has passed
+        time.sleep(observer.granularity)
+        observer.poll()
+        observer.poll()
+        snapshot = DirectorySnapshot(root)
+        print(json.dumps({'observer': 'indexed', 'phase': 'index', 'directories': len(observer._trees[0].dirs),
+                          'files': args.files, 'seconds': round(index_seconds, 4)}), flush=True)
+
+        for n in args.churn:
+            churn(paths, n, f"w{n}")
+            start = time.perf_counter()
+            new = DirectorySnapshot(root)
+            created = len(DirectorySnapshotDiff(snapshot, new).files_created)
+            elapsed = time.perf_counter() - start
+            snapshot = new
+            print(json.dumps({'observer': 'watchdog', 'churn': n, 'cycle_seconds': round(elapsed, 4),
+                              'directories_listed': args.dirs, 'created': created}), flush=True)
+
+            before = handler.created
+            start = time.perf_counter()
+            listed = observer.poll()
+            elapsed = time.perf_counter() - start
+            print(json.dumps({'observer': 'indexed', 'churn': n, 'cycle_seconds': round(elapsed, 4),
+                              'directories_listed': listed, 'created': handler.created - before}), flush=True)
+            time.sleep(observer.granularity)
+            observer.poll()
+        observer.join()
+
+
+if __name__ == "__main__":
+    main()
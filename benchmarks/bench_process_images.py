@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+""" Throughput and memory of gcf_process_images.process_images.
+
+Writes `--images` synthetic JPEGs carrying an EXIF DateTime into a scratch
+directory, then runs process_images on a fresh copy for each combination of
+worker count and reducing gap, each in a new process, and reports images/sec,
+milliseconds per image and the peak RSS of the process and its workers.
+A reducing gap of "none" decodes every image at full resolution.
+
+    python benchmarks/bench_process_images.py --images 500 --workers 1 2 4 8
+    python benchmarks/bench_process_images.py --workers 1 --reducing-gap none 2 --sizes 800 400 200
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from gcf_process_images import process_images
+
+
+def make_images(directory, count, width, height):
+    # A smooth gradient compresses like a photograph rather than like noise
+    base = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    exif = Image.Exif()
+    exif[0x0132] = '2023:06:30 12:00:00'
+    for i in range(count):
+        # Distinct content, or process_images would skip all but the first as duplicates
+        exif[0x010E] = f"image {i}"
+        base.save(os.path.join(directory, f"IMG_{i:05d}.jpeg"), quality=90, exif=exif)
+
+
+def run(template, workers, **kwargs):
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'images')
+        shutil.copytree(template, source)
+        count = len(os.listdir(source))
+        start = time.perf_counter()
+        result = json.loads(process_images(source, workers=workers, **kwargs))
+        elapsed = time.perf_counter() - start
+    assert len(result['thumbnails_generated']) == count * len(set(map(tuple, kwargs['sizes']))), result
+    # ru_maxrss is in KiB on Linux; forked workers count as children once joined
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {'workers': workers, 'reducing_gap': kwargs['reducing_gap'], 'images': count,
+            'seconds': round(elapsed, 3), 'images_per_sec': round(count / elapsed, 1),
+            'ms_per_image': round(1000 * elapsed * workers / count, 2), 'peak_rss_mb': round(peak / 1024, 1)}
+
+
+def isolated(fn, *args, **kwargs):
+    # A fresh interpreter per call. Linux carries ru_maxrss across exec, so the
+    # images are made in one as well, keeping this process small.
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(fn, args, kwargs)
+
+
+def size(value):
+    return [int(v) for v in value.split('x')] if 'x' in value else [int(value)] * 2
+
+
+def gap(value):
+    return None if value.lower() == 'none' else float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark process_images")
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--workers", type=int, nargs="*", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--sizes", type=size, nargs="*", default=[[200, 200]],
+                        help="Thumbnail sizes, WxH or a single number")
+    parser.add_argument("--reducing-gap", type=gap, nargs="*", default=[2.0],
+                        help="Reducing gaps to compare, 'none' for a full resolution decode")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as template:
+        isolated(make_images, template, args.images, args.width, args.height)
+        for workers in args.workers:
+            for reducing_gap in args.reducing_gap:
+                print(json.dumps(isolated(run, template, workers, sizes=args.sizes, reducing_gap=reducing_gap)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+""" Balance, failover and exclusivity of shard leases between watcher nodes.
+
+Starts `--nodes` sharding.Shards nodes on one lease database in a scratch
+directory, then crashes one (it stops renewing without releasing its leases)
+and stops another cleanly. Every 10 ms it samples which shards each node
+believes it holds and reports, as one JSON line per phase, how long until
+every shard was held again, the largest and smallest share, and the samples in
+which two nodes held the same shard (must be 0) or a shard had no holder.
+Finally reports how evenly `--files` synthetic paths spread over the nodes
+for each shard key.
+
+    python benchmarks/bench_sharding.py --nodes 4 --shards 64 --ttl 3
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sharding import Shards
+
+
+def sample(nodes):
+    holders = Counter()
+    shares = []
+    for node in nodes:
+        owned = node.owned()
+        shares.append(len(owned))
+        holders.update(owned)
+    return holders, shares
+
+
+def watch(phase, nodes, count, timeout):
+    """Sample ownership until every shard has exactly one holder and shares are fair, or `timeout`."""
+    start = time.monotonic()
+    samples = overlaps = uncovered = 0
+    settled = None
+    fair = -(-count // len(nodes))
+    while (elapsed := time.monotonic() - start) < timeout:
+        holders, shares = sample(nodes)
+        samples += 1
+        overlaps += sum(1 for n in holders.values() if n > 1)
+        uncovered += count - len(holders)
+        if len(holders) == count and max(shares) <= fair:
+            settled = elapsed
+            break
+        time.sleep(0.01)
+    _, shares = sample(nodes)
+    return {'phase': phase, 'nodes': len(nodes), 'settled_seconds': None if settled is None else round(settled, 3),
+            'max_share': max(shares), 'min_share': min(shares), 'samples': samples,
+            'double_held': overlaps, 'unheld_shard_samples': uncovered}
+
+
+def crash(node):
+    # Stop renewing without handing the leases back, as if the process had died
+    node._stopped.set()
+    node._thread.join()
+    node._conn.close()
+
+
+def spread(by, count, nodes, files, depth):
+    root = '/data/instrument'
+    shards = Shards.__new__(Shards)
+    shards.roots, shards.count, shards.by = [root + os.sep], count, by
+    per_node = Counter()
+    for i in range(files):
+        top = f"run_{i % 50:03d}"
+        rest = os.sep.join(f"d{(i >> (3 * level)) % 8}" for level in range(depth))
+        per_node[shards.shard(os.path.join(root, top, rest, f"{i:08d}.dat")) % nodes] += 1
+    counts = [per_node[n] for n in range(nodes)]
+    return {'phase': f"spread-{by}", 'nodes': nodes, 'files': files,
+            'max_node_files': max(counts), 'min_node_files': min(counts),
+            'imbalance': round(max(counts) / (files / nodes), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark shard lease balance and failover")
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--shards", type=int, default=64)
+    parser.add_argument("--ttl", type=float, default=3.0, help="Lease ttl in seconds")
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--depth", type=int, default=3)
+    args = parser.parse_args()
+
+    timeout = 10 * args.ttl
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, 'shards.sqlite')
+
+        def node(i):
+            return Shards(db, ['/data'], count=args.shards, node=f"node-{i}", ttl=args.ttl)
+
+        nodes = [node(i).start() for i in range(args.nodes)]
+        print(json.dumps(watch('start', nodes, args.shards, timeout)), flush=True)
+
+        crash(nodes.pop())
+        print(json.dumps(watch('crash', nodes, args.shards, timeout)), flush=True)
+
+        nodes.pop(0).stop()
+        print(json.dumps(watch('stop', nodes, args.shards, timeout)), flush=True)
+
+        nodes.append(node(args.nodes).start())
+        print(json.dumps(watch('join', nodes, args.shards, timeout)), flush=True)
+        for n in nodes:
+            n.stop()
+
+    for by in ('top', 'hash'):
+        print(json.dumps(spread(by, args.shards, args.nodes, args.files, args.depth)))
+
+
+if __name__ == "__main__":
+    main()
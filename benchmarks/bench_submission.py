@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+""" End-to-end run submission throughput against the local mock Flows service.
+
+Starts mock_globus.MockFlowsServer in-process with the requested latency and
+fault injection, deploys flows/transfer_flow_definition.json on it, then has
+`--threads` threads start `--runs` runs through the SDK and the request
+governor, as the dispatch workers do. Reports runs/sec, submission latency
+percentiles and the governor's retry counters as one JSON line.
+
+    python benchmarks/bench_submission.py --runs 500 --latency 0.05 --throttle-rate 0.1 --rate-limit 50
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import globus_sdk
+
+from governor import GOVERNOR, TRANSPORT_PARAMS
+from mock_globus import MOCK_URL_VAR, MockFlowsServer, MockFlowsService, mock_authorizer, use_mock
+
+
+FLOWS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flows')
+
+FLOW_INPUT = {
+    'source': {'id': '00000000-0000-0000-0000-000000000001', 'path': '/data/file.dat'},
+    'destination': {'id': '00000000-0000-0000-0000-000000000002', 'path': '/dest/file.dat'},
+    'recursive_tx': False,
+    'sync_level': 0,
+    'verify_checksum': True,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark run submission against the mock Flows service")
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.1)
+    parser.add_argument("--rate-limit", type=float, default=10.0, help="Governor calls per second")
+    parser.add_argument("--burst", type=int, default=20)
+    parser.add_argument("--max-retries", type=int, default=5)
+    args = parser.parse_args()
+
+    service = MockFlowsService(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                               throttle_rate=args.throttle_rate, retry_after=args.retry_after, seed=0)
+    server = MockFlowsServer(service).start()
+    # Deploy without faults, they are for the runs
+    rates, service.throttle_rate, service.error_rate = (service.throttle_rate, service.error_rate), 0.0, 0.0
+    flow_id = server.preload(FLOWS_DIR)['transfer_flow']
+    service.throttle_rate, service.error_rate = rates
+
+    GOVERNOR.configure(rate=args.rate_limit, burst=args.burst, max_retries=args.max_retries)
+    os.environ[MOCK_URL_VAR] = server.url
+    use_mock()
+    client = globus_sdk.SpecificFlowClient(flow_id, authorizer=mock_authorizer(), transport_params=TRANSPORT_PARAMS)
+
+    pending = iter(range(args.runs))
+    lock = threading.Lock()
+    latencies, failures = [], []
+
+    def submit():
+        for i in pending:
+            start = time.monotonic()
+            try:
+                GOVERNOR.call(client.run_flow, body={'input': FLOW_INPUT}, label=f"bench {i}")
+            except globus_sdk.GlobusError as e:
+                with lock:
+                    failures.append(getattr(e, 'http_status', None))
+                continue
+            with lock:
+                latencies.append(time.monotonic() - start)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=submit) for _ in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+    server.stop()
+
+    latencies.sort()
+    pick = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))], 4) if latencies else None
+    print(json.dumps({
+        'runs': args.runs,
+        'submitted': len(latencies),
+        'failed': len(failures),
+        'seconds': round(elapsed, 3),
+        'runs_per_sec': round(len(latencies) / elapsed, 1),
+        'latency_p50': pick(0.50),
+        'latency_p95': pick(0.95),
+        'latency_p99': pick(0.99),
+        'governor': GOVERNOR.stats(),
+        'mock': service.stats()['responses'],
+    }))
+
+
+if __name__ == "__main__":
+    main()
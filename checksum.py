@@ -0,0 +1,305 @@
+""" Checksum ready files locally and skip content already delivered.
+
+Instruments re-export or retry and write files identical to ones already
+transferred. `Deduplicator` wraps the flow runner: it hashes each ready file
+and, when the destination path of the file last received the same content
+by a run that succeeded, records the file as a duplicate instead of starting
+another transfer. The dispatcher starts hashing a file through
+`prefetch(path)` as soon as the file is ready and queued, so that the
+`Hasher`'s threads work through the queue ahead of the dispatch workers, and
+waits for the digest in `prepare(path)` before it takes a run slot.
+
+Files are hashed by a `Hasher` on a pool of threads (hashlib releases the
+GIL for large updates) with `readinto` into a preallocated buffer, one
+`buffer_size` read at a time. Digests are cached, in memory and in a
+`DigestIndex` SQLite database, by (device, inode, size, mtime_ns), so a file
+seen again unchanged, e.g. after a restart, is not read again. The index
+also keeps the digest last delivered to every destination: with a run
+tracker a delivery is recorded once its run succeeded, so that a file only
+buffered by a batch or archive, or whose run failed, never looks delivered;
+without one, when its run was started.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from journal import DUPLICATE, FAILED
+from metrics import REGISTRY
+from settings import LOGGER
+
+
+HASHED_BYTES = REGISTRY.counter('watcher_hashed_bytes_total', 'Bytes read to checksum ready files')
+HASH_SECONDS = REGISTRY.counter('watcher_hash_seconds_total', 'Seconds the hashing threads spent checksumming')
+DIGEST_CACHE = REGISTRY.counter('watcher_digest_cache_total', 'Digest lookups by where the digest came from',
+                                ('source',))
+DEDUP_FILES = REGISTRY.counter('watcher_dedup_skipped_files_total',
+                               'Files not transferred because their destination already holds the same content')
+DEDUP_BYTES = REGISTRY.counter('watcher_dedup_saved_bytes_total', 'Bytes not transferred thanks to deduplication')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (dev, ino)
+);
+CREATE TABLE IF NOT EXISTS deliveries (
+    destination TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    path TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+Delivery = namedtuple('Delivery', 'digest path inode size')
+
+
+def file_digest(path: 'str', algorithm: 'str'='sha256', buffer: 'bytearray|None'=None) -> 'str':
+    h = hashlib.new(algorithm)
+    buffer = bytearray(8 << 20) if buffer is None else buffer
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while n := f.readinto(buffer):
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+class DigestIndex:
+    """Digests by file version, and the digest last submitted to each destination, in SQLite."""
+
+    def __init__(self, db_path: 'str'):
+        self.db_path = os.path.abspath(os.path.expanduser(db_path))
+        self._lock = threading.Lock()
+        if not os.path.isdir(d := os.path.dirname(self.db_path)):
+            os.makedirs(d)
+        self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def digest(self, st: 'os.stat_result') -> 'str|None':
+        with self._lock:
+            row = self._conn.execute('SELECT size, mtime_ns, digest FROM digests WHERE dev = ? AND ino = ?',
+                                     (st.st_dev, st.st_ino)).fetchone()
+        if row is None or (row[0], row[1]) != (st.st_size, st.st_mtime_ns):
+            return None
+        return row[2]
+
+    def put_digest(self, st: 'os.stat_result', digest: 'str') -> None:
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO digests (dev, ino, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?)',
+                               (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest))
+
+    def delivery(self, destination: 'str') -> 'Delivery|None':
+        with self._lock:
+            row = self._conn.execute('SELECT digest, path, inode, size FROM deliveries WHERE destination = ?',
+                                     (destination,)).fetchone()
+        return None if row is None else Delivery(*row)
+
+    def put_delivery(self, destination: 'str', digest: 'str', path: 'str', st: 'os.stat_result') -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO deliveries (destination, digest, path, inode, size, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (destination, digest, path, st.st_ino, st.st_size, time.time()))
+
+
+class Hasher:
+    def __init__(self, algorithm: 'str'='sha256', workers: 'int'=4, buffer_size: 'int'=8 << 20,
+                 index: 'DigestIndex|None'=None, cache_size: 'int'=100000):
+        """Checksum files with `workers` threads, reading `buffer_size` bytes at a time."""
+        hashlib.new(algorithm)
+        self.algorithm = algorithm
+        self.workers = workers
+        self.buffer_size = buffer_size
+        self.index = index
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hash")
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.cached = 0
+
+    def close(self) -> None:
+        self._pool.shutdown()
+
+    def submit(self, path: 'str', st: 'os.stat_result|None'=None):
+        """Return a Future of the digest of `path`."""
+        return self._pool.submit(self.digest, path, st)
+
+    def digest(self, path: 'str', st: 'os.stat_result|None'=None) -> 'str':
+        """The digest of `path`, from the cache when this version of the file was hashed before."""
+        st = os.stat(path) if st is None else st
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if (digest := self._cache.get(key)) is not None:
+                self._cache.move_to_end(key)
+                self.cached += 1
+        if digest is not None:
+            DIGEST_CACHE.labels('memory').inc()
+            return digest
+        if self.index is not None and (digest := self.index.digest(st)) is not None:
+            DIGEST_CACHE.labels('index').inc()
+        else:
+            digest = self._hash(path, st.st_size)
+            if self.index is not None:
+                self.index.put_digest(st, digest)
+        with self._lock:
+            self._cache[key] = digest
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return digest
+
+    def _hash(self, path: 'str', size: 'int') -> 'str':
+        # One buffer per thread, allocated once
+        if (buffer := getattr(self._local, 'buffer', None)) is None:
+            buffer = self._local.buffer = bytearray(self.buffer_size)
+        start = time.perf_counter()
+        digest = file_digest(path, self.algorithm, buffer)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            self.seconds += elapsed
+        HASHED_BYTES.inc(size)
+        HASH_SECONDS.inc(elapsed)
+        DIGEST_CACHE.labels('hashed').inc()
+        return digest
+
+    def stats(self) -> 'dict':
+        with self._lock:
+            return {'files': self.files, 'bytes': self.bytes, 'cached': self.cached,
+                    'gb_per_sec': round(self.bytes / self.seconds / 1e9, 3) if self.seconds else None}
+
+
+class Deduplicator:
+    """A flow runner that starts flows only for files whose destination does not hold their content yet.
+
+    `destination_of(path)` names where a file is delivered, e.g. the
+    destination collection and path. The last delivery to a destination
+    counts unless the journal records its file as failed.
+    """
+
+    def __init__(self, runner, hasher: 'Hasher', index: 'DigestIndex', destination_of, journal=None):
+        self.runner = runner
+        self.hasher = hasher
+        self.index = index
+        self.destination_of = destination_of
+        self.journal = journal
+        self.tracker = getattr(runner, 'tracker', None)
+        self.on_finished = None
+        self._following = False
+        self._pending = {}
+        self._hashing = {}
+        self._lock = threading.Lock()
+        self.skipped = 0
+        self.saved_bytes = 0
+
+    def follow(self, tracker) -> None:
+        """Record deliveries once `tracker` sees their run succeed, instead of when it is started.
+
+        Chains to the tracker's current `on_finished`, so call it last.
+        """
+        self.on_finished = tracker.on_finished
+        tracker.on_finished = self.finished
+        self._following = True
+
+    def prefetch(self, path: 'str') -> None:
+        """Start checksumming a file that just became ready; called by the dispatcher as it queues the file."""
+        if os.path.isdir(path):
+            return None
+        future = self.hasher.submit(path)
+        with self._lock:
+            self._hashing[path] = future
+
+    def prepare(self, path: 'str') -> None:
+        """Wait for the checksum of a ready file; called by the dispatcher before it takes a run slot."""
+        with self._lock:
+            future = self._hashing.pop(path, None)
+        if future is None:
+            return None
+        try:
+            future.result()
+        except OSError as e:
+            # Reported when the file is dispatched
+            LOGGER.debug(f"Cannot checksum {path} yet: {e}")
+
+    def __call__(self, path: 'str'):
+        if os.path.isdir(path):
+            # Dataset directories are transferred as they are
+            return self.runner(path)
+        try:
+            st = os.stat(path)
+            # Cached by prefetch() unless the file changed since
+            digest = self.hasher.digest(path, st)
+        except OSError as e:
+            LOGGER.warning(f"Cannot checksum {path}, transferring it anyway: {e}")
+            return self.runner(path)
+        if (destination := self.destination_of(path)) is None:
+            return self.runner(path)
+        if (previous := self.index.delivery(destination)) is not None and previous.digest == digest \
+                and not self._failed(previous):
+            with self._lock:
+                self.skipped += 1
+                self.saved_bytes += st.st_size
+            DEDUP_FILES.inc()
+            DEDUP_BYTES.inc(st.st_size)
+            LOGGER.info("Already delivered: %s (same content as %s)", path, previous.path)
+            if self.journal is not None:
+                self.journal.mark(path, DUPLICATE)
+            return None
+        if self._following:
+            with self._lock:
+                self._pending[path] = (destination, digest, st)
+        try:
+            run_id = self.runner(path)
+        except Exception:
+            self._forget(path)
+            raise
+        if not self._following:
+            if run_id is not None:
+                self.index.put_delivery(destination, digest, path, st)
+        elif run_id is None and self.tracker is None:
+            # Not started, and not buffered by a runner that starts it later
+            self._forget(path)
+        return run_id
+
+    def finished(self, paths: 'list', status: 'str') -> None:
+        """Record the deliveries of a run that is over; assigned to `RunTracker.on_finished` by `follow`."""
+        with self._lock:
+            deliveries = [(path, d) for path in paths if (d := self._pending.pop(path, None)) is not None]
+        if status == 'SUCCEEDED':
+            for path, (destination, digest, st) in deliveries:
+                self.index.put_delivery(destination, digest, path, st)
+        if self.on_finished is not None:
+            self.on_finished(paths, status)
+
+    def _forget(self, path: 'str') -> None:
+        with self._lock:
+            self._pending.pop(path, None)
+
+    def _failed(self, delivery: 'Delivery') -> bool:
+        # Without a tracker a delivery is recorded when its run starts; it no longer counts once the run failed
+        return self.journal is not None and self.journal.lookup(delivery.path, delivery.inode) == FAILED
+
+    def stats(self) -> 'dict':
+        with self._lock:
+            pending = len(self._pending)
+            hashing = len(self._hashing)
+        return {'skipped': self.skipped, 'saved_bytes': self.saved_bytes, 'pending': pending, 'queued': hashing,
+                'hashing': self.hasher.stats()}
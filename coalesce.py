@@ -0,0 +1,195 @@
+""" Coalesce the event storm of each file into one hand-off once it settles.
+
+Acting on creation alone misses most of our writers: they write `foo.tmp`
+and rename it to `foo.h5`, so the accepted name never sees a creation, and
+a large file being appended raises a stream of modification events that say
+nothing on their own about when it is done. An `EventCoalescer` keeps one
+small state per active path,
+
+    created -> modified* -> closed -> (moved)
+
+and hands the path on once, through `emit(path, ready)`, when
+
+    quiet       no event has touched the path for `debounce` seconds
+    renamed     it was renamed to its final name after its writer closed it
+    evicted     more than `max_paths` paths are active; the oldest goes first
+
+A rename carries the state over to the destination, so `foo.tmp` renamed to
+`foo.h5` is emitted as `foo.h5`, and only the final name has to be accepted
+by `match`. A rename of a file no longer followed starts a state only when its
+old name is not accepted, or when `handed_on(src, dest)`, e.g. the journal
+looked up by inode, says the file was not handed on under its old name; so
+moving a delivered file within the tree does not deliver it again. `ready` is true when the writer's last event was a close (or the
+file was renamed after one), so the dispatcher can skip the readiness check;
+otherwise the readiness engine still waits for the file to be closed.
+
+Only a creation or a rename starts a state: later writes to a file already
+handed on are not followed, as before. Deletions drop the state, and paths
+that settle without being accepted are forgotten, so memory is bounded by
+the paths written in the last `debounce` seconds. Debounce deadlines live in
+a TimerWheel that one thread expires, as in dataset mode.
+"""
+import os
+import threading
+import time
+
+from watchdog.events import EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_DELETED
+from watchdog.events import EVENT_TYPE_CLOSED, EVENT_TYPE_MOVED
+
+from metrics import REGISTRY, SPANS
+from settings import LOGGER
+from timerwheel import TimerWheel
+
+
+COALESCED_EVENTS = REGISTRY.counter(
+    'watcher_coalesced_events_total', 'File events folded into the single hand-off of their file')
+SETTLED_FILES = REGISTRY.counter(
+    'watcher_settled_files_total', 'Files handed on by the coalescer, by what settled them', ('reason',))
+
+# Events of a file's life the coalescer follows; opening or reading a file does not count
+COALESCE_EVENTS = frozenset((EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED, EVENT_TYPE_DELETED,
+                             EVENT_TYPE_CLOSED))
+
+
+class _Path:
+    __slots__ = ('events', 'closed')
+
+    def __init__(self):
+        self.events = 0
+        self.closed = False
+
+
+class EventCoalescer:
+    def __init__(self, match, debounce: 'float'=1.0, max_paths: 'int'=100000, tick: 'float|None'=None):
+        """Hand on each file accepted by `match(path)` once, `debounce` seconds after its last event.
+
+        `emit(path, ready)` is called, on the coalescer's thread or, for
+        renames and evictions, on the thread calling `notify`. Without
+        `handed_on`, files renamed from an accepted name are taken as handed on.
+        """
+        self.match = match
+        self.debounce = debounce
+        self.max_paths = max_paths
+        self.emit = None
+        self.handed_on = None
+        self._wheel = TimerWheel(tick=tick or max(0.01, min(0.25, debounce / 4)))
+        self._paths = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.events = 0
+        self.emitted = 0
+        self.renamed = 0
+        self.deleted = 0
+        self.evicted = 0
+        self.ignored = 0
+        self.moved = 0
+
+    def notify(self, event) -> None:
+        """Fold a watchdog file event into the state of its path."""
+        kind = event.event_type
+        # An atomic rename to an accepted name is the writer's own "done"
+        accepted = kind == EVENT_TYPE_MOVED and self.match(event.dest_path)
+        if accepted and event.src_path not in self._paths and self.match(event.src_path) \
+                and (self.handed_on is None or self.handed_on(event.src_path, event.dest_path)):
+            # Moved within the tree after it was handed on under its old name
+            with self._lock:
+                self.events += 1
+                self.moved += 1
+            LOGGER.debug(f"File renamed after it was handed on: {event.dest_path}")
+            return None
+        evicted = settled = None
+        with self._lock:
+            self.events += 1
+            if kind == EVENT_TYPE_MOVED:
+                path = event.dest_path
+                self._wheel.cancel(event.src_path)
+                if (entry := self._paths.pop(event.src_path, None)) is None:
+                    # Renamed in from a name we never saw written
+                    entry = _Path()
+                # Replacing a file starts over from the renamed one
+                self._paths.pop(path, None)
+                self._paths[path] = entry
+                self.renamed += 1
+            elif kind == EVENT_TYPE_CREATED:
+                path = event.src_path
+                if (entry := self._paths.get(path)) is None:
+                    entry = self._paths[path] = _Path()
+                entry.closed = False
+            elif kind == EVENT_TYPE_DELETED:
+                if self._paths.pop(event.src_path, None) is not None:
+                    self._wheel.cancel(event.src_path)
+                    self.deleted += 1
+                return None
+            elif kind in (EVENT_TYPE_MODIFIED, EVENT_TYPE_CLOSED):
+                path = event.src_path
+                if (entry := self._paths.get(path)) is None:
+                    # Only new files are handed on; later writes to a file already handed on are not followed
+                    return None
+                entry.closed = kind == EVENT_TYPE_CLOSED
+            else:
+                return None
+            if entry.events:
+                COALESCED_EVENTS.inc()
+            entry.events += 1
+            if accepted and entry.closed:
+                settled = path
+            else:
+                self._wheel.schedule(path, time.monotonic() + self.debounce)
+            if len(self._paths) > self.max_paths:
+                evicted = next(iter(self._paths))
+        if SPANS.enabled and (accepted if kind == EVENT_TYPE_MOVED else entry.events == 1 and self.match(path)):
+            SPANS.mark(path, 'created')
+        if settled is not None:
+            self._settle(settled, 'renamed')
+        if evicted is not None:
+            self._settle(evicted, 'evicted')
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+        if self._paths:
+            LOGGER.info(f"{len(self._paths)} files had not settled yet")
+
+    def stats(self) -> 'dict':
+        with self._lock:
+            active = len(self._paths)
+        return {'active': active, 'events': self.events, 'emitted': self.emitted, 'renamed': self.renamed,
+                'deleted': self.deleted, 'evicted': self.evicted, 'ignored': self.ignored, 'moved': self.moved}
+
+    def _settle(self, path: 'str', reason: 'str') -> None:
+        with self._lock:
+            if (entry := self._paths.pop(path, None)) is None:
+                return None
+            self._wheel.cancel(path)
+        matched = self.match(path)
+        with self._lock:
+            if not matched:
+                self.ignored += 1
+            else:
+                self.emitted += 1
+                if reason == 'evicted':
+                    self.evicted += 1
+        if not matched:
+            LOGGER.debug(f"File ignored: {path}")
+            return None
+        SETTLED_FILES.labels(reason).inc()
+        LOGGER.info(f"File settled ({reason}): {os.path.basename(path)} after {entry.events} events")
+        self.emit(path, entry.closed)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._wheel.tick):
+            with self._lock:
+                expired = self._wheel.expired(time.monotonic())
+            for path in expired:
+                try:
+                    self._settle(path, 'quiet')
+                except Exception:
+                    LOGGER.exception(f"Handing on {path} failed")
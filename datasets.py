@@ -0,0 +1,246 @@
+""" Trigger one recursive transfer per dataset directory instead of one run per file.
+
+Instruments often write a run of thousands of files into a fresh
+subdirectory of the watch directory. In dataset mode the watcher treats the
+directory `depth` levels below the watch root as one dataset and starts a
+single recursive transfer of it once it is complete, that is when
+
+    sealed      a sentinel file (`DONE`, `.complete`) appears in it, or
+    quiescent   no file in it has been created, written, moved or removed
+                for `quiet` seconds
+
+Datasets without any file accepted by the watcher's rules are never
+submitted. Quiet periods are kept in a TimerWheel: every event only moves
+the dataset's deadline, and one thread expires the deadlines of all
+datasets. Before a quiescent dataset is submitted its files' mtimes are
+checked, since writes made on another host or seen by the polling observer
+raise no events.
+
+Completed datasets are remembered, so that late events do not start them
+again, up to `max_fired` of them; the ones least recently touched are
+forgotten first, and the journal still knows them. Under sharding, `owns`
+is set to `Shards.owns`: datasets of shards held by other nodes are not
+tracked at all, so that the node taking their shard over later finds them
+untouched.
+"""
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from metrics import REGISTRY
+from settings import LOGGER
+from timerwheel import TimerWheel
+
+
+DATASETS = REGISTRY.counter('watcher_datasets_total', 'Dataset directories submitted, by what completed them',
+                            ('reason',))
+
+DEFAULT_SENTINELS = ('DONE', '.complete')
+
+
+class _Dataset:
+    __slots__ = ('events', 'matched')
+
+    def __init__(self):
+        self.events = 0
+        self.matched = 0
+
+
+def last_write(directory: 'str') -> 'float|None':
+    """The latest mtime of the files below `directory`, or None if it is gone."""
+    latest = None
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif (mtime := entry.stat(follow_symlinks=False).st_mtime) > (latest or 0):
+                            latest = mtime
+                    except OSError:
+                        continue
+        except OSError:
+            if latest is None and not os.path.isdir(directory):
+                return None
+    return 0.0 if latest is None else latest
+
+
+class DatasetTrigger:
+    def __init__(self, roots, depth: 'int'=1, sentinels=DEFAULT_SENTINELS, quiet: 'float|None'=60.0,
+                 tick: 'float'=0.5, max_fired: 'int'=100000):
+        """Datasets `depth` directories below each of `roots`, complete at a sentinel or after `quiet` seconds.
+
+        With `quiet` None or 0 only a sentinel completes a dataset.
+        `submit(directory)` is called, on the trigger's thread, for each
+        completed dataset; `owns(directory)`, when set, limits the datasets tracked.
+        """
+        # Deepest first, so that a file belongs to the closest root
+        self.roots = sorted((os.path.abspath(r).rstrip(os.sep) + os.sep for r in roots), key=len, reverse=True)
+        self.depth = depth
+        self.sentinels = frozenset(sentinels)
+        self.quiet = quiet or None
+        self.max_fired = max_fired
+        self.submit = None
+        self.owns = None
+        self._wheel = TimerWheel(tick=tick)
+        self._datasets = {}
+        self._fired = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.completed = 0
+        self.empty = 0
+
+    def dataset_of(self, path: 'str') -> 'str|None':
+        """The dataset directory holding `path`, or None for files above the dataset level."""
+        for root in self.roots:
+            if path.startswith(root):
+                parts = path[len(root):].split(os.sep)
+                if len(parts) <= self.depth:
+                    return None
+                return root + os.sep.join(parts[:self.depth])
+        return None
+
+    def notify(self, path: 'str', matched: bool) -> None:
+        """Record activity on the file at `path`; `matched` when the watcher's rules accept it."""
+        if (directory := self.dataset_of(path)) is None:
+            LOGGER.debug("Not in a dataset directory: %s", path)
+            return None
+        if self.owns is not None and not self.owns(directory):
+            LOGGER.debug("Dataset %s belongs to a shard held elsewhere, ignoring %s", directory, path)
+            return None
+        sealed = os.path.basename(path) in self.sentinels and os.path.dirname(path) == directory
+        with self._lock:
+            if directory in self._fired:
+                self._fired.move_to_end(directory)
+                LOGGER.debug("Dataset %s already submitted, ignoring %s", directory, path)
+                return None
+            if (dataset := self._datasets.get(directory)) is None:
+                dataset = self._datasets[directory] = _Dataset()
+                LOGGER.info("Dataset started: %s", directory)
+            dataset.events += 1
+            dataset.matched += matched
+            if not sealed:
+                if self.quiet is not None:
+                    self._wheel.schedule(directory, time.monotonic() + self.quiet)
+                return None
+            self._wheel.cancel(directory)
+        self._complete(directory, 'sealed')
+
+    def arm(self, directory: 'str', matched: 'int'=1) -> None:
+        """Track a dataset found by a scan rather than through events, e.g. at startup."""
+        sealed = any(os.path.exists(os.path.join(directory, s)) for s in self.sentinels)
+        with self._lock:
+            if directory in self._fired or directory in self._datasets:
+                return None
+            dataset = self._datasets[directory] = _Dataset()
+            dataset.matched = matched
+            if not sealed:
+                if self.quiet is not None:
+                    self._wheel.schedule(directory, time.monotonic() + self.quiet)
+                return None
+        self._complete(directory, 'sealed')
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="datasets", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+        if self._datasets:
+            LOGGER.info(f"{len(self._datasets)} datasets were not complete yet")
+
+    def stats(self) -> 'dict':
+        with self._lock:
+            return {'open': len(self._datasets), 'fired': len(self._fired), 'completed': self.completed,
+                    'empty': self.empty}
+
+    def _complete(self, directory: 'str', reason: 'str') -> None:
+        with self._lock:
+            if (dataset := self._datasets.pop(directory, None)) is None:
+                return None
+            self._fired[directory] = None
+            if len(self._fired) > self.max_fired:
+                self._fired.popitem(last=False)
+        if not dataset.matched:
+            self.empty += 1
+            LOGGER.info("Dataset %s (%s) holds no matching files, not submitted", directory, reason)
+            return None
+        self.completed += 1
+        DATASETS.labels(reason).inc()
+        LOGGER.info("Dataset complete (%s): %s", reason, directory)
+        self.submit(directory)
+
+    def _expire(self, directory: 'str') -> None:
+        # Writes raise no event on some filesystems and observers; trust the mtimes over the events
+        if (latest := last_write(directory)) is None:
+            with self._lock:
+                self._datasets.pop(directory, None)
+            LOGGER.info("Dataset vanished: %s", directory)
+            return None
+        if (idle := time.time() - latest) < self.quiet:
+            with self._lock:
+                if directory in self._datasets and directory not in self._wheel:
+                    self._wheel.schedule(directory, time.monotonic() + self.quiet - idle)
+            return None
+        self._complete(directory, 'quiescent')
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._wheel.tick):
+            with self._lock:
+                expired = self._wheel.expired(time.monotonic())
+            for directory in expired:
+                try:
+                    self._expire(directory)
+                except Exception:
+                    LOGGER.exception(f"Completing dataset {directory} failed")
+
+
+def has_match(directory: 'str', match, prune=None) -> bool:
+    """True when some file below `directory` is accepted by `match`."""
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if prune is None or not prune(entry.path):
+                            stack.append(entry.path)
+                    elif match(entry.path):
+                        return True
+        except OSError:
+            continue
+    return False
+
+
+def catch_up_datasets(directory: 'str', datasets: 'DatasetTrigger', match, journal, prune=None) -> 'int':
+    """Arm the datasets under `directory` that the journal does not know yet and that hold matching files."""
+    armed = known = 0
+    stack = [directory]
+    while stack:
+        d = stack.pop()
+        if (dataset := datasets.dataset_of(os.path.join(d, ''))) is None:
+            # Above the dataset level
+            try:
+                with os.scandir(d) as it:
+                    stack.extend(e.path for e in it if e.is_dir(follow_symlinks=False)
+                                 and (prune is None or not prune(e.path)))
+            except OSError:
+                pass
+            continue
+        if journal is not None and journal.state(dataset) is not None:
+            known += 1
+            continue
+        if has_match(dataset, match, prune):
+            datasets.arm(dataset)
+            armed += 1
+    LOGGER.info(f"Catch-up scan of {directory}: {armed} datasets to complete, {known} already journaled")
+    return armed
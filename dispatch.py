@@ -0,0 +1,225 @@
+""" Bounded dispatch of triggered files to the flow runner.
+
+The watchdog observer thread only registers matched files with the readiness
+engine; once a file is ready, the engine's callback puts it on a queue that a
+pool of worker threads drains by calling the flow runner. No worker waits for
+a writer, so one slow writer or one slow Flows API call no longer stalls every
+other file. At most `queue_size` files wait for readiness or a worker at once;
+beyond that `submit` blocks the observer thread (backpressure) or, with
+`put_timeout`, drops the file with a warning.
+
+With a journal, `submit` ignores files that are already known and every state
+change of a file is recorded. Paths submitted as `ready`, such as completed
+dataset directories, skip the readiness engine. With a run tracker, each flow run takes an
+in-flight slot and workers wait while the tracker's cap is reached. A flow runner with
+`prefetch(path)` and `prepare(path)` methods, such as the Deduplicator, is handed each file
+as it is queued, and again before its worker takes a slot, e.g. to checksum it meanwhile.
+"""
+import os
+import queue
+import threading
+import time
+
+from journal import READY, SUBMITTED, FAILED
+from metrics import REGISTRY, SPANS
+from settings import LOGGER
+
+
+FLOW_RUNNER_SECONDS = REGISTRY.histogram(
+    'watcher_flow_runner_seconds', 'Seconds spent in the flow runner per file, e.g. one run_flow call')
+
+
+_STOP = object()
+
+
+class Dispatcher:
+    def __init__(self, FlowRunner, readiness, workers: 'int'=4, queue_size: 'int'=1000,
+                 put_timeout: 'float|None'=None, journal=None, tracker=None):
+        self.FlowRunner = FlowRunner
+        self.readiness = readiness
+        self.journal = journal
+        self.tracker = tracker
+        self.prefetch = getattr(FlowRunner, 'prefetch', None)
+        self.prepare = getattr(FlowRunner, 'prepare', None)
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self.queue_size = queue_size
+        # Bounded by the slots below, so that readiness callbacks and stop() never block on it
+        self._queue = queue.Queue()
+        # Held from submission until a worker takes the file, whether it waits for readiness or in the queue
+        self._slots = threading.Semaphore(queue_size) if queue_size > 0 else None
+        self._threads = []
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._started = {}
+        self._busy_seconds = 0.0
+        self._window_start = time.monotonic()
+        self.submitted = 0
+        self.dispatched = 0
+        self.failed = 0
+        self.dropped = 0
+        self.duplicates = 0
+        self.waiting = 0
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name=f"dispatch-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: 'float|None'=None) -> None:
+        """Stop the workers, abandoning files still queued."""
+        abandoned = 0
+        while True:
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+                self._release()
+                abandoned += 1
+            except queue.Empty:
+                break
+        if abandoned:
+            LOGGER.warning(f"Abandoned {abandoned} queued files")
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def join(self) -> None:
+        """Block until every submitted file has been dispatched or has vanished."""
+        with self._idle:
+            self._idle.wait_for(lambda: not self.waiting)
+        self._queue.join()
+
+    def submit(self, path: 'str', ready: bool=False) -> bool:
+        if self.journal is not None and not self.journal.observe(path):
+            with self._lock:
+                self.duplicates += 1
+            LOGGER.debug("Already journaled: %s", path)
+            return False
+        return self.enqueue(path, ready)
+
+    def enqueue(self, path: 'str', ready: bool=False) -> bool:
+        """Queue a file without consulting the journal, e.g. to recover it."""
+        if (slots := self._slots) is not None and not slots.acquire(blocking=False):
+            LOGGER.warning(f"Dispatch queue full ({self.queue_size}), applying backpressure")
+            if not slots.acquire(timeout=self.put_timeout):
+                with self._lock:
+                    self.dropped += 1
+                LOGGER.error(f"Dispatch queue full, dropped: {path}")
+                return False
+        with self._lock:
+            self.submitted += 1
+            if not ready:
+                self.waiting += 1
+        if ready:
+            self._put(path, 0.0)
+        else:
+            # Workers only see the file once the readiness engine released it
+            self.readiness.when_ready(path, self._ready)
+        return True
+
+    def stats(self) -> 'dict':
+        """Queue depth and worker utilization since the previous call."""
+        now = time.monotonic()
+        with self._lock:
+            elapsed = now - self._window_start
+            # Include time spent by workers still busy at the end of the window
+            busy_seconds = self._busy_seconds + sum(
+                now - max(s, self._window_start) for s in self._started.values())
+            self._busy_seconds = 0.0
+            self._window_start = now
+            busy = len(self._started)
+            counters = {
+                'submitted': self.submitted,
+                'dispatched': self.dispatched,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'duplicates': self.duplicates,
+            }
+        utilization = busy_seconds / (elapsed * self.workers) if elapsed > 0 and self.workers else 0.0
+        return {
+            'queue_depth': self._queue.qsize(),
+            'queue_size': self.queue_size,
+            'waiting': self.waiting,
+            'workers': self.workers,
+            'busy_workers': busy,
+            'utilization': min(utilization, 1.0),
+            **counters,
+        }
+
+    def _ready(self, path: 'str', waited: 'float|None') -> None:
+        # Called by the readiness engine; never blocks, as every waiting file holds a queue slot
+        if waited is None:
+            LOGGER.info("File vanished before it was ready: %s", os.path.basename(path))
+            self._journal(path, FAILED, error='vanished before ready')
+            self._release()
+        else:
+            self._put(path, waited)
+        with self._idle:
+            self.waiting -= 1
+            self._idle.notify_all()
+
+    def _put(self, path: 'str', waited: 'float') -> None:
+        if self.prefetch is not None:
+            self.prefetch(path)
+        self._queue.put((path, waited))
+
+    def _release(self) -> None:
+        if self._slots is not None:
+            self._slots.release()
+
+    def _work(self) -> None:
+        while (item := self._queue.get()) is not _STOP:
+            self._release()
+            ident = threading.get_ident()
+            with self._lock:
+                self._started[ident] = time.monotonic()
+            try:
+                self._dispatch(*item)
+            finally:
+                with self._lock:
+                    start = self._started.pop(ident)
+                    self._busy_seconds += time.monotonic() - max(start, self._window_start)
+                self._queue.task_done()
+        self._queue.task_done()
+
+    def _dispatch(self, path: 'str', waited: 'float') -> None:
+        LOGGER.info("File ready: %s (waited %.3fs)", os.path.basename(path), waited)
+        SPANS.mark(path, 'ready')
+        self._journal(path, READY)
+        if self.prepare is not None:
+            self.prepare(path)
+        if self.tracker is not None:
+            self.tracker.acquire()
+        LOGGER.info("Starting flow...")
+        start = time.perf_counter()
+        try:
+            run_id = self.FlowRunner(path)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            LOGGER.exception(f"Flow runner failed for {path}")
+            self._journal(path, FAILED, error=str(e))
+            self._track(None, path)
+            return None
+        FLOW_RUNNER_SECONDS.observe(time.perf_counter() - start)
+        with self._lock:
+            self.dispatched += 1
+        if run_id is not None:
+            SPANS.mark(path, 'submitted')
+            self._journal(path, SUBMITTED, run_id=run_id)
+        self._track(run_id, path)
+
+    def _track(self, run_id: 'str|None', path: 'str') -> None:
+        if self.tracker is None:
+            return None
+        if run_id is None:
+            self.tracker.release()
+        else:
+            self.tracker.track(run_id, [path])
+
+    def _journal(self, path: 'str', state: 'str', **kwargs) -> None:
+        if self.journal is not None:
+            self.journal.mark(path, state, **kwargs)
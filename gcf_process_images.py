@@ -7,21 +7,45 @@ Globus Compute service, as described here:
 https://globus-compute.readthedocs.io/en/latest/Tutorial.html#registering-a-function
 (code is also provided below).
 
-This function generates thumbnail images for all PNG files in the
-source_dir and places them in result_path. It moves the source file to
+This function generates thumbnail images, in one or more sizes, for all
+PNG and JPEG files in the source_dir and places them in result_path. It moves the source file to
 the result path after processing.
 
+Images are processed in parallel by a pool of threads (Pillow releases the
+GIL while decoding, resizing and encoding); pass `workers` in the function
+kwargs to size the pool. Forked worker processes are opt-in (`processes`):
+a Globus Compute worker may run threads of its own, and a child forked
+while one of them holds a lock, e.g. of logging or Pillow, deadlocks.
+
 Before invoking the function, ensure that you have the Pillow library
 (https://python-pillow.org) installed on your Globus Compute endpoint.
 """
 
 
-def process_images(source_dir=None, destination_dir=None):
+def process_images(source_dir=None, destination_dir=None, workers=None, chunksize=16,
+                   sizes=((200, 200),), reducing_gap=2.0, files=None, archives=None, processes=False):
     """
     If no source_dir provided, the function exits returning a JSON string reporting nothing done.
     If only source_dir is given, a subdirectory 'processed' will be created under it.
     The resulting thumbnails and the original files will be placed in a YYYYmmdd subfolder of the 
     destination_dir.
+    One thumbnail is generated per entry of `sizes`, either [width, height] or a single number
+    for a square box. JPEGs are decoded once, at the smallest scale at least `reducing_gap` times
+    the largest size, and every thumbnail is resized from the next larger one; reducing_gap=None
+    decodes at full resolution.
+    Images are processed by `workers` threads (default: one per CPU), which are handed
+    `chunksize` images at a time. With workers=1 everything runs in the calling thread.
+    With processes=True the workers are forked processes instead, which is only safe
+    when no other thread of the calling process may hold a lock.
+    With `files`, a list of paths absolute or relative to source_dir, only those images are
+    processed, otherwise every image in source_dir; listed files that are not images are
+    reported in "skipped". Images whose content is recorded in the
+    destination_dir manifest with all requested thumbnails are skipped. An image that fails
+    is reported in "failed" and does not stop the others.
+    With `archives`, tar or tar.zst archives packed by the watcher (--pack), paths absolute or
+    relative to source_dir, every archive is first unpacked into its own directory, its files
+    checked against the manifest it carries and the archive removed; the images restored are
+    processed along with `files`.
     """
     import json
     results = {
@@ -32,12 +56,17 @@ def process_images(source_dir=None, destination_dir=None):
     destination_dir = source_dir if (dst := destination_dir) is None else dst
 
 
+    import hashlib
+    import multiprocessing
+    import os
+    import queue
+    import tarfile
+    from concurrent.futures import ThreadPoolExecutor
     from datetime import datetime
-    from itertools import chain
+    from itertools import islice
     from pathlib import Path
     
     from PIL import Image
-    from PIL.ExifTags import TAGS
 
 
     source_dir = Path(source_dir).expanduser().absolute()
@@ -45,58 +74,249 @@ def process_images(source_dir=None, destination_dir=None):
     destination_dir = source_dir.joinpath('processed') if (
         d :=  Path(destination_dir).expanduser().absolute()) == source_dir else d
 
-    paths = chain(
-        source_dir.glob('*.png'),
-        source_dir.glob('*.jpg'),
-        source_dir.glob('*.jpeg')
-    )
+    def unpack(archive):
+        # Members are written under a temporary name and renamed, so a half-restored file is never
+        # taken for a complete one; the archive is only removed when all match the manifest
+        stream = open(archive, 'rb')
+        if archive.suffix == '.zst':
+            import zstandard
+            stream = zstandard.ZstdDecompressor().stream_reader(stream, closefd=True)
+        restored = {}
+        packed = None
+        with stream, tarfile.open(fileobj=stream, mode='r|') as tar:
+            for member in tar:
+                if member.name == '.pack-manifest.json':
+                    packed = json.load(tar.extractfile(member))
+                    continue
+                if not member.isfile() or member.name in ('', '.', '..') or '/' in member.name:
+                    raise ValueError(f"Unexpected member {member.name!r}")
+                target = archive.parent.joinpath(member.name)
+                partial = target.with_name(f".{member.name}.unpacking")
+                h = hashlib.sha256()
+                data = tar.extractfile(member)
+                with open(partial, 'wb') as out:
+                    while (block := data.read(1 << 20)):
+                        h.update(block)
+                        out.write(block)
+                os.utime(partial, (member.mtime, member.mtime))
+                os.replace(partial, target)
+                restored[member.name] = h.hexdigest()
+        if packed is None:
+            raise ValueError(f"{archive.name} has no manifest")
+        if (expected := {f['name']: f['sha256'] for f in packed['files']}) != restored:
+            bad = sorted(n for n in expected.keys() | restored.keys() if expected.get(n) != restored.get(n))
+            raise ValueError(f"{len(bad)} files of {archive.name} do not match its manifest, e.g. {bad[0]}")
+        archive.unlink()
+        return [archive.parent.joinpath(name) for name in restored]
 
-    image_files = (p for p in paths if p.is_file())
+    extensions = ('.png', '.jpg', '.jpeg')
+    unpacked = []
+    unpack_failed = []
+    for archive in ([archives] if isinstance(archives, str) else archives or ()):
+        try:
+            unpacked.extend(unpack(source_dir.joinpath(Path(archive).expanduser())))
+        except Exception as e:
+            unpack_failed.append({"file": str(archive), "error": f"{e.__class__.__name__}: {e}"})
 
-    thumbnails_generated = []
+    not_images = []
+    if files is None and archives is None:
+        # A single pass over the directory instead of one glob per extension
+        with os.scandir(source_dir) as it:
+            paths = [Path(e.path) for e in it if e.name.lower().endswith(extensions) and e.is_file()]
+    else:
+        # The watcher may deliver files of any kind; only images are processed, the others are skipped
+        listed = [source_dir.joinpath(Path(f).expanduser()) for f in ([files] if isinstance(files, str) else files or ())]
+        paths = [p for p in listed + unpacked if p.name.lower().endswith(extensions)]
+        not_images = [str(p) for p in listed + unpacked if not p.name.lower().endswith(extensions)]
+
+    # Content hash -> {"source", "sha256", "sizes", "thumbnails"} of every image processed so far.
+    # Each invocation appends its lines with a single O_APPEND write, so concurrent
+    # invocations do not interleave them.
+    manifest_file = destination_dir.joinpath('.manifest.jsonl')
+    manifest = {}
+    try:
+        with open(manifest_file, encoding='utf-8') as stream:
+            for line in stream:
+                try:
+                    entry = json.loads(line)
+                    manifest[entry['sha256']] = entry
+                except (ValueError, KeyError):
+                    continue
+    except FileNotFoundError:
+        pass
+
+    # Largest first, so that each thumbnail is resized from the previous one
+    pyramid = sorted({
+        (int(s), int(s)) if isinstance(s, (int, float, str)) else (int(s[0]), int(s[1])) for s in sizes
+    }, key=lambda s: s[0] * s[1], reverse=True)
+
+    def digest(img_file):
+        h = hashlib.sha256()
+        with open(img_file, 'rb') as stream:
+            while (block := stream.read(1 << 20)):
+                h.update(block)
+        return h.hexdigest()
+
+    def done_before(entry):
+        return entry is not None and set(pyramid) <= {tuple(s) for s in entry['sizes']} and all(
+            os.path.exists(t) for t in entry['thumbnails'])
+
+    def image_date(image, img_file):
+        # EXIF DateTime, or the modification time of files without one
+        if (d := image.getexif().get(0x0132)) is not None:
+            try:
+                return datetime.strptime(d.strip('\x00 '), '%Y:%m:%d %H:%M:%S').strftime('%Y%m%d')
+            except ValueError:
+                pass
+        return datetime.fromtimestamp(img_file.stat().st_mtime).strftime('%Y%m%d')
+
+    def process_image(img_file):
+        entry = {"source": str(img_file), "sha256": digest(img_file), "sizes": pyramid, "thumbnails": []}
+
+        if done_before(previous := manifest.get(entry['sha256'])):
+            # Same content processed before, possibly under another name
+            img_file.rename(Path(previous['thumbnails'][0]).parent.joinpath(img_file.name))
+            return dict(previous, source=str(img_file), skipped=True)
+
+        with Image.open(img_file) as image:
+
+            # Create processed path from metadata
+            result_path = destination_dir.joinpath(image_date(image, img_file))
+
+            # Several workers may create the same date folder at once
+            result_path.mkdir(parents=True, exist_ok=True)
+
+            # Have the JPEG decoder scale by 1/2, 1/4 or 1/8 while decoding, so the full
+            # resolution image is never held in memory; a no-op for other formats
+            if reducing_gap is not None:
+                x_dim, y_dim = pyramid[0]
+                image.draft(None, (int(x_dim * reducing_gap), int(y_dim * reducing_gap)))
+
+            # Generate thumbnails
+            for x_dim, y_dim in pyramid:
+                image.thumbnail(size=(x_dim, y_dim), reducing_gap=reducing_gap)
+
+                processed_img = result_path.joinpath(f"{img_file.stem}_{x_dim}x{y_dim}{img_file.suffix}")
+                # Save thumbnail image
+                image.save(processed_img)
+                entry['thumbnails'].append(str(processed_img))
 
-    for img_file in image_files:
-        image = Image.open(img_file)
-
-        # Create processed path from metadata
-        result_path = None
-        exifdata = image.getexif()
-        
-        d = [exifdata.get(tagid) for tagid in exifdata if TAGS.get(tagid) == 'DateTime'][0]
-
-        image_date = datetime.strptime(d, '%Y:%m:%d %H:%M:%S').strftime('%Y%m%d')
-        result_path = destination_dir.joinpath(image_date)
-        
-        if not (rp := result_path).exists():
-            rp.mkdir(parents=True)
-        
-        # Generate thumbnail
-        x_dim = 200
-        y_dim = 200
-        image.thumbnail(size=(x_dim, y_dim))
-
-        processed_img = result_path.joinpath(f"thumb_{x_dim}x{y_dim}_{img_file.name}")
-        processed_img = result_path.joinpath(f"{img_file.stem}_{x_dim}x{y_dim}{img_file.suffix}")
-        # Save thumbnail image
-        image.save(processed_img)
-        
         # mv original to destination to prevent reprocessing
-        img_file.rename(processed_img.parent.joinpath(f"{img_file.name}"))
-        thumbnails_generated.append(str(processed_img))
+        img_file.rename(result_path.joinpath(f"{img_file.name}"))
+        return entry
+
+    def process_chunk(chunk):
+        done = []
+        for i, img_file in chunk:
+            try:
+                done.append((i, process_image(img_file), None))
+            except Exception as e:
+                # Exceptions do not all survive pickling back from a worker process
+                done.append((i, str(img_file), f"{e.__class__.__name__}: {e}"))
+        return done
+
+    def chunks():
+        numbered = enumerate(paths)
+        while (chunk := list(islice(numbered, chunksize))):
+            yield chunk
+
+    def run_processes():
+        # Forked workers inherit process_image, so nothing but paths and results is pickled;
+        # the task queue is bounded so only a few chunks are in memory at a time
+        ctx = multiprocessing.get_context('fork')
+        tasks = ctx.Queue(maxsize=2 * workers)
+        done = ctx.Queue()
+
+        def work():
+            while (chunk := tasks.get()) is not None:
+                done.put(process_chunk(chunk))
+
+        def collect():
+            while True:
+                try:
+                    return done.get(timeout=5)
+                except queue.Empty:
+                    if not any(p.is_alive() for p in procs):
+                        raise RuntimeError("All image workers exited unexpectedly")
+
+        procs = [ctx.Process(target=work, daemon=True) for _ in range(workers)]
+        for p in procs:
+            p.start()
+        submitted = collected = 0
+        try:
+            for chunk in chunks():
+                tasks.put(chunk)
+                submitted += 1
+                while not done.empty():
+                    yield from collect()
+                    collected += 1
+            for _ in procs:
+                tasks.put(None)
+            while collected < submitted:
+                yield from collect()
+                collected += 1
+        finally:
+            for p in procs:
+                p.join(timeout=1)
+                if p.is_alive():
+                    p.terminate()
+
+    def run_threads():
+        # Pillow releases the GIL while decoding, resizing and encoding
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for chunk in chunks():
+                pending.append(executor.submit(process_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    yield from pending.pop(0).result()
+            for future in pending:
+                yield from future.result()
+
+    workers = (os.cpu_count() or 1) if workers is None else int(workers)
+    if workers <= 1:
+        processed = process_chunk(list(enumerate(paths)))
+    elif processes and 'fork' in multiprocessing.get_all_start_methods() \
+            and not multiprocessing.current_process().daemon:
+        processed = list(run_processes())
+    else:
+        processed = list(run_threads())
+
+    thumbnails_generated = []
+    skipped = not_images
+    failed = unpack_failed
+    new_entries = []
+    for _, entry, error in sorted(processed, key=lambda r: r[0]):
+        if error is not None:
+            failed.append({"file": entry, "error": error})
+        elif entry.pop('skipped', False):
+            skipped.append(entry['source'])
+        else:
+            thumbnails_generated.extend(entry['thumbnails'])
+            new_entries.append(json.dumps(entry) + '\n')
+
+    if new_entries:
+        destination_dir.mkdir(parents=True, exist_ok=True)
+        fd = os.open(manifest_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, ''.join(new_entries).encode('utf-8'))
+        finally:
+            os.close(fd)
 
     return json.dumps({
-        "result": "success",
-        "thumbnails_generated": thumbnails_generated
+        "result": "success" if not failed else "partial" if thumbnails_generated or skipped or unpacked else "failure",
+        "thumbnails_generated": thumbnails_generated,
+        "skipped": skipped,
+        "unpacked": len(unpacked),
+        "failed": failed
     })
 
 
 """Code to register the function with the Globus Compute service
 """
 
-from globus_compute_sdk import Client
-
-
 def deploy_function():
+    from globus_compute_sdk import Client
+
     client = Client()
 
     try:
@@ -0,0 +1,227 @@
+""" Client-side governance of Globus API calls.
+
+Every Globus call made by the watcher and by `manage_flow.py` goes through
+`GOVERNOR.call(...)`, which
+
+    * waits for a token from a token bucket, limiting the request rate,
+    * retries throttled (429), unavailable (5xx) and network failures with
+      exponential backoff and full jitter, honouring Retry-After; requests
+      that must not be repeated, such as starting a run, go through
+      `GOVERNOR.call_once(...)`, which only retries what cannot have reached
+      the service and otherwise first looks up whether it was carried out,
+    * opens a circuit breaker after repeated failures, holding back further
+      calls (and thus dispatch) until a probe call succeeds.
+
+Clients should be created with `transport_params=TRANSPORT_PARAMS` so that the
+SDK does not retry the same responses on its own.
+"""
+import random
+import threading
+import time
+
+import globus_sdk
+
+from metrics import REGISTRY
+from settings import LOGGER
+
+
+# Leave retrying to the governor
+TRANSPORT_PARAMS = {'max_retries': 0}
+
+API_CALL_SECONDS = REGISTRY.histogram(
+    'globus_api_call_seconds', 'Seconds per Globus API request, each retry counted separately', ('method',))
+API_ERRORS = REGISTRY.counter(
+    'globus_api_errors_total', 'Globus API requests that failed, by HTTP status', ('method', 'status'))
+
+
+class TokenBucket:
+    def __init__(self, rate: 'float', burst: 'int'):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> 'float':
+        """Take a token, sleeping until one is available; return the seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: 'int'=5, reset_timeout: 'float'=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened = 0.0
+        self._lock = threading.Condition()
+
+    def before_call(self) -> None:
+        """Block while the circuit is open; let a single probe through when half-open."""
+        with self._lock:
+            while True:
+                if self.state == self.CLOSED:
+                    return None
+                if self.state == self.OPEN and (wait := self._opened + self.reset_timeout - time.monotonic()) <= 0:
+                    self.state = self.HALF_OPEN
+                    LOGGER.info("Circuit half-open, probing Globus service")
+                    return None
+                self._lock.wait(wait if self.state == self.OPEN else None)
+
+    def success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                LOGGER.info("Circuit closed, Globus service recovered")
+            self.state = self.CLOSED
+            self._failures = 0
+            self._lock.notify_all()
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    LOGGER.warning(f"Circuit open for {self.reset_timeout}s after {self._failures} failures")
+                self.state = self.OPEN
+                self._opened = time.monotonic()
+                self._lock.notify_all()
+
+
+def _is_retryable(e: 'Exception') -> bool:
+    if isinstance(e, globus_sdk.NetworkError):
+        return True
+    return isinstance(e, globus_sdk.GlobusAPIError) and (e.http_status == 429 or e.http_status >= 500)
+
+
+def _not_sent(e: 'Exception') -> bool:
+    """True when the request was refused before the service acted on it."""
+    if isinstance(e, globus_sdk.GlobusConnectionTimeoutError):
+        return True
+    return isinstance(e, globus_sdk.GlobusAPIError) and e.http_status == 429
+
+
+def _retry_after(e: 'Exception') -> 'float|None':
+    if not isinstance(e, globus_sdk.GlobusAPIError):
+        return None
+    try:
+        return float(e.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestGovernor:
+    def __init__(self, rate: 'float'=10.0, burst: 'int'=20, max_retries: 'int'=5, base_delay: 'float'=0.5,
+                 max_delay: 'float'=60.0, failure_threshold: 'int'=5, reset_timeout: 'float'=30.0):
+        self.limiter = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        self.retried = 0
+        self.failed = 0
+        self.rate_limited_seconds = 0.0
+
+    def configure(self, rate: 'float|None'=None, burst: 'int|None'=None, max_retries: 'int|None'=None) -> None:
+        if rate is not None:
+            self.limiter.rate = rate
+        if burst is not None:
+            self.limiter.burst = burst
+        if max_retries is not None:
+            self.max_retries = max_retries
+
+    def call(self, fn, *args, **kwargs):
+        """Call `fn`, a request that is safe to repeat such as a GET, retrying every retryable failure."""
+        return self._call(fn, args, kwargs)
+
+    def call_once(self, fn, *args, lookup=None, **kwargs):
+        """Call `fn`, a request that must not be carried out twice, such as starting a flow run.
+
+        It is retried blindly only when the request cannot have reached the
+        service: on a 429, or when the connection timed out being set up.
+        After any other retryable failure the service may have carried it
+        out: `lookup()` then returns its result if it did, and the call is
+        retried only if it returns None. Without `lookup` the error is raised.
+        """
+        return self._call(fn, args, kwargs, repeatable=False, lookup=lookup)
+
+    def _call(self, fn, args, kwargs, repeatable=True, lookup=None):
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            waited = self.limiter.acquire()
+            with self._lock:
+                self.calls += 1
+                self.rate_limited_seconds += waited
+            method = getattr(fn, '__name__', 'call')
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                API_CALL_SECONDS.labels(method).observe(time.perf_counter() - start)
+                API_ERRORS.labels(method, getattr(e, 'http_status', None) or e.__class__.__name__).inc()
+                if not isinstance(e, Exception) or not _is_retryable(e):
+                    if isinstance(e, globus_sdk.GlobusAPIError):
+                        # The service answered; a client error says nothing about its health
+                        self.breaker.success()
+                    else:
+                        # Anything unexpected, e.g. a TypeError or an interrupt, counts as a failure, so that
+                        # a half-open probe always settles and the callers waiting for it go on
+                        self.breaker.failure()
+                    raise
+                self.breaker.failure()
+                sent = not repeatable and not _not_sent(e)
+                with self._lock:
+                    if getattr(e, 'http_status', None) == 429:
+                        self.throttled += 1
+                    if attempt >= self.max_retries or sent and lookup is None:
+                        self.failed += 1
+                        raise
+                    self.retried += 1
+                # Full jitter, but never earlier than the service asked for
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if (retry_after := _retry_after(e)) is not None:
+                    delay = max(delay, min(retry_after, self.max_delay))
+                LOGGER.warning(f"{getattr(fn, '__name__', 'Globus call')} failed ({e.__class__.__name__} "
+                               f"{getattr(e, 'http_status', '')}), "
+                               f"{'looking it up and ' if sent else ''}retrying in {delay:.2f}s")
+                time.sleep(delay)
+                if sent and (found := lookup()) is not None:
+                    LOGGER.warning(f"{method} had been carried out despite the {e.__class__.__name__}, not retrying")
+                    return found
+                attempt += 1
+                continue
+            API_CALL_SECONDS.labels(method).observe(time.perf_counter() - start)
+            self.breaker.success()
+            return result
+
+    def stats(self) -> 'dict':
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'throttled': self.throttled,
+                'retried': self.retried,
+                'failed': self.failed,
+                'rate_limited_seconds': round(self.rate_limited_seconds, 3),
+                'circuit': self.breaker.state,
+            }
+
+
+GOVERNOR = RequestGovernor()
@@ -0,0 +1,338 @@
+""" Durable journal of triggered files.
+
+Every file the watcher accepts is recorded in a SQLite database with its
+dispatch state, so that files are neither lost when the watcher stops nor
+submitted twice when events are repeated:
+
+    seen -> ready -> submitted (run_id) -> succeeded | failed
+                  -> duplicate
+
+A `duplicate` was not transferred because its destination already held the
+same content (see checksum.py); it counts as delivered, like `succeeded`.
+
+A file is identified by its path and inode; the size and mtime recorded when
+it became ready tell a rewrite of the same file apart from a duplicate event.
+State changes are kept in memory and written by a background thread in
+batched transactions on a WAL-mode database, so recording an event does not
+wait for the disk.
+"""
+import itertools
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from settings import LOGGER
+
+
+SEEN = 'seen'
+READY = 'ready'
+SUBMITTED = 'submitted'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+DUPLICATE = 'duplicate'
+
+ACTIVE_STATES = (SEEN, READY, SUBMITTED)
+PENDING_STATES = (SEEN, READY)
+DELIVERED_STATES = (SUCCEEDED, DUPLICATE)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    state TEXT NOT NULL,
+    run_id TEXT,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (path, inode)
+);
+CREATE INDEX IF NOT EXISTS files_state ON files (state);
+CREATE INDEX IF NOT EXISTS files_run_id ON files (run_id);
+"""
+
+_UPSERT = """
+INSERT INTO files (path, inode, size, mtime_ns, state, run_id, error, updated)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (path, inode) DO UPDATE SET
+    size = COALESCE(excluded.size, size),
+    mtime_ns = COALESCE(excluded.mtime_ns, mtime_ns),
+    state = excluded.state,
+    run_id = COALESCE(excluded.run_id, run_id),
+    error = excluded.error,
+    updated = excluded.updated
+"""
+
+_DELETE = "DELETE FROM files WHERE path = ? AND inode = ?"
+
+
+class _Entry:
+    __slots__ = ('state', 'size', 'mtime_ns')
+
+    def __init__(self, state, size=None, mtime_ns=None):
+        self.state = state
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+
+class Journal:
+    def __init__(self, db_path: 'str', flush_interval: 'float'=0.5, batch_size: 'int'=1000, shared: bool=False,
+                 max_failures: 'int'=5):
+        """Journal in the SQLite database `db_path`; `shared` when watchers on several hosts use it,
+        e.g. on a parallel filesystem, where WAL mode cannot work. A batch of changes that fails to
+        be written `max_failures` times in a row is dropped."""
+        self.db_path = os.path.abspath(os.path.expanduser(db_path))
+        self.shared = shared
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_failures = max_failures
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._inodes = {}
+        self._writes = queue.Queue()
+        self._held = []
+        self._failures = 0
+        self._flushed = threading.Condition()
+        self._written = 0
+        self._queued = 0
+        self._stopped = threading.Event()
+        self._kick = threading.Event()
+        self._thread = None
+
+        if not os.path.isdir(d := os.path.dirname(self.db_path)):
+            os.makedirs(d)
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        conn.close()
+        self._reader = self._connect()
+        self._reader_lock = threading.Lock()
+
+    def _connect(self) -> 'sqlite3.Connection':
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        if self.shared:
+            # WAL keeps its index in shared memory, which other hosts cannot see
+            conn.execute('PRAGMA journal_mode=DELETE')
+        else:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def open(self) -> 'Journal':
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._kick.set()
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+        self._reader.close()
+
+    def observe(self, path: 'str') -> bool:
+        """Record a triggering event; return False if the file is already known."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        key = (path, st.st_ino)
+        with self._lock:
+            if (entry := self._lookup(key)) is not None:
+                if entry.state in ACTIVE_STATES:
+                    return False
+                if entry.state in DELIVERED_STATES and (entry.size, entry.mtime_ns) == (st.st_size, st.st_mtime_ns):
+                    return False
+            self._cache[key] = _Entry(SEEN)
+            self._inodes[path] = st.st_ino
+        self._write(key, SEEN)
+        return True
+
+    def mark(self, path: 'str', state: 'str', run_id: 'str|None'=None, error: 'str|None'=None) -> None:
+        size = mtime_ns = None
+        with self._lock:
+            inode = self._inodes.get(path)
+        if inode is None or state == READY:
+            try:
+                st = os.stat(path)
+                inode = st.st_ino if inode is None else inode
+                if state == READY:
+                    size, mtime_ns = st.st_size, st.st_mtime_ns
+            except OSError:
+                if inode is None:
+                    LOGGER.warning(f"Cannot journal {state} for missing file: {path}")
+                    return None
+        key = (path, inode)
+        with self._lock:
+            entry = self._cache.setdefault(key, _Entry(state))
+            entry.state = state
+            if size is not None:
+                entry.size, entry.mtime_ns = size, mtime_ns
+            self._inodes[path] = inode
+        self._write(key, state, size, mtime_ns, run_id, error)
+
+    def moved(self, src: 'str', dest: 'str') -> 'str|None':
+        """The state of a file renamed from `src` to `dest`, found by its inode under its old name.
+
+        A delivered file moves to the new name with its state, so that a
+        catch-up scan does not take it for a new one, and the journal keeps
+        no row for the old name.
+        """
+        try:
+            st = os.stat(dest)
+        except OSError:
+            return None
+        old, new = (src, st.st_ino), (dest, st.st_ino)
+        with self._lock:
+            if (entry := self._lookup(old)) is None:
+                return None
+            if entry.state in DELIVERED_STATES:
+                self._cache[new] = _Entry(entry.state, entry.size, entry.mtime_ns)
+                self._inodes[dest] = st.st_ino
+                self._cache.pop(old, None)
+                if self._inodes.get(src) == st.st_ino:
+                    del self._inodes[src]
+        if entry.state in DELIVERED_STATES:
+            # One queued item, so that both land in the same transaction
+            now = time.time()
+            self._put([(*new, entry.size, entry.mtime_ns, entry.state, None, None, now),
+                       (*old, None, None, None, None, None, now)])
+        return entry.state
+
+    def state(self, path: 'str') -> 'str|None':
+        try:
+            key = (path, os.stat(path).st_ino)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._lookup(key)
+        return None if entry is None else entry.state
+
+    def lookup(self, path: 'str', inode: 'int') -> 'str|None':
+        """The state of one version of a file, which may no longer exist."""
+        with self._lock:
+            entry = self._lookup((path, inode))
+        return None if entry is None else entry.state
+
+    def is_current(self, path: 'str', inode: 'int', size: 'int', mtime_ns: 'int') -> bool:
+        """True when this exact version of the file is already journaled."""
+        with self._lock:
+            entry = self._lookup((path, inode))
+        if entry is None:
+            return False
+        if entry.state in ACTIVE_STATES:
+            return True
+        return entry.state in DELIVERED_STATES and (entry.size, entry.mtime_ns) == (size, mtime_ns)
+
+    def pending(self, states: 'tuple'=PENDING_STATES) -> 'iter':
+        """Yield the paths left in `states`, e.g. after a restart."""
+        self.flush()
+        marks = ','.join('?' * len(states))
+        with self._reader_lock:
+            rows = self._reader.execute(
+                f"SELECT path FROM files WHERE state IN ({marks}) ORDER BY updated", states).fetchall()
+        for (path,) in rows:
+            yield path
+
+    def submitted(self) -> 'dict':
+        """Map run_id to the paths submitted in that run and not yet resolved."""
+        self.flush()
+        runs = {}
+        with self._reader_lock:
+            rows = self._reader.execute(
+                "SELECT run_id, path FROM files WHERE state = ? AND run_id IS NOT NULL", (SUBMITTED,))
+            for run_id, path in rows:
+                runs.setdefault(run_id, []).append(path)
+        return runs
+
+    def flush(self, timeout: 'float|None'=None) -> None:
+        """Block until every state change queued so far is on disk."""
+        if self._thread is None:
+            while self._drain():
+                pass
+            return None
+        with self._flushed:
+            target = self._queued
+            self._kick.set()
+            self._flushed.wait_for(lambda: self._written >= target, timeout)
+
+    def _lookup(self, key: 'tuple') -> '_Entry|None':
+        if (entry := self._cache.get(key)) is not None:
+            return entry
+        with self._reader_lock:
+            row = self._reader.execute(
+                "SELECT state, size, mtime_ns FROM files WHERE path = ? AND inode = ?", key).fetchone()
+        return None if row is None else _Entry(*row)
+
+    def _write(self, key, state, size=None, mtime_ns=None, run_id=None, error=None) -> None:
+        self._put([(key[0], key[1], size, mtime_ns, state, run_id, error, time.time())])
+
+    def _put(self, rows: 'list') -> None:
+        # Rows without a state delete theirs
+        with self._flushed:
+            self._queued += len(rows)
+        self._writes.put(rows)
+
+    def _drain(self, conn: 'sqlite3.Connection|None'=None) -> int:
+        # Changes a failed write left behind go first
+        rows, self._held = self._held, []
+        while len(rows) < self.batch_size:
+            try:
+                rows.extend(self._writes.get_nowait())
+            except queue.Empty:
+                break
+        if not rows:
+            return 0
+        own = conn is None
+        conn = self._connect() if own else conn
+        try:
+            with conn:
+                # In order, as a row may be deleted and written again
+                for delete, group in itertools.groupby(rows, key=lambda row: row[4] is None):
+                    if delete:
+                        conn.executemany(_DELETE, [row[:2] for row in group])
+                    else:
+                        conn.executemany(_UPSERT, list(group))
+        except sqlite3.Error:
+            if (failures := self._failures + 1) < self.max_failures:
+                LOGGER.exception(f"Writing {len(rows)} journal changes failed, retrying")
+                self._failures, self._held = failures, rows
+                return 0
+            # Give up on them rather than leave flush() waiting forever
+            LOGGER.exception(f"Writing {len(rows)} journal changes failed {failures} times, dropping them")
+        else:
+            with self._lock:
+                # Finished files no longer need to be held in memory
+                for path, inode, _, _, state, *_ in rows:
+                    if state not in ACTIVE_STATES and (e := self._cache.get((path, inode))) is not None \
+                            and e.state == state:
+                        del self._cache[(path, inode)]
+                        if self._inodes.get(path) == inode:
+                            del self._inodes[path]
+        finally:
+            if own:
+                conn.close()
+        self._failures = 0
+        with self._flushed:
+            self._written += len(rows)
+            self._flushed.notify_all()
+        return len(rows)
+
+    def _run(self) -> None:
+        conn = self._connect()
+        while not self._stopped.is_set():
+            try:
+                drained = self._drain(conn)
+            except Exception:
+                LOGGER.exception("Journal writer failed")
+                drained = 0
+            if drained < self.batch_size:
+                self._kick.wait(self.flush_interval)
+                self._kick.clear()
+        while self._drain(conn) or self._held:
+            pass
+        conn.close()
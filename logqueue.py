@@ -0,0 +1,101 @@
+""" Queue-based logging, so that writing log lines never blocks the watcher.
+
+With `queue: {enabled: true}` in the logging configuration, the root logger's
+handlers are moved behind a `QueueListener`: callers only put the record on an
+in-memory queue, and a background thread formats and writes it. Records are
+not formatted before they are queued (see `LazyQueueHandler`); with
+structlog's `render_to_log_args_and_kwargs` even the %-style message is merged
+with its arguments on the writer thread.
+
+`SampleFilter` keeps one in `sample` INFO lines per message template that
+carries arguments, i.e. the per-file lines ("File ready: %s ..."), while
+warnings, errors and fixed messages always pass.
+"""
+import atexit
+import logging
+import queue
+import threading
+
+from logging.handlers import QueueHandler, QueueListener
+
+
+class LazyQueueHandler(QueueHandler):
+    """A QueueHandler that neither formats records nor blocks when the queue is full.
+
+    The stock `prepare()` merges the message with its arguments and renders
+    any traceback on the calling thread. The listener runs in this process,
+    so the record can be queued as it is and formatted by the writer.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record: 'logging.LogRecord') -> 'logging.LogRecord':
+        return record
+
+    def enqueue(self, record: 'logging.LogRecord') -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+class SampleFilter(logging.Filter):
+    """Pass one in `sample` records at or below `level` for each message template with arguments."""
+
+    def __init__(self, sample: 'int'=1, level: 'int'=logging.INFO):
+        super().__init__()
+        self.sample = max(1, int(sample))
+        self.level = level
+        self._seen = {}
+
+    def filter(self, record: 'logging.LogRecord') -> bool:
+        if self.sample == 1 or record.levelno > self.level or not record.args:
+            return True
+        # A lost update under contention only shifts which line of a template is kept
+        n = self._seen.get(record.msg, 0)
+        self._seen[record.msg] = n + 1
+        return n % self.sample == 0
+
+
+_LISTENER = None
+_HANDLER = None
+
+
+def install(logger: 'logging.Logger|None'=None, sample: 'int'=1, maxsize: 'int'=100000) -> 'QueueListener':
+    """Move the handlers of `logger` (default: root) behind a queue and a writer thread."""
+    global _LISTENER, _HANDLER
+    uninstall()
+    logger = logging.getLogger() if logger is None else logger
+    records = queue.Queue(maxsize=maxsize)
+    handlers = list(logger.handlers)
+    _HANDLER = LazyQueueHandler(records)
+    if sample > 1:
+        _HANDLER.addFilter(SampleFilter(sample))
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(_HANDLER)
+    _LISTENER = QueueListener(records, *handlers, respect_handler_level=True)
+    _LISTENER.start()
+    return _LISTENER
+
+
+def uninstall() -> None:
+    """Write out the queued records and stop the writer thread."""
+    global _LISTENER, _HANDLER
+    if (listener := _LISTENER) is None:
+        return None
+    _LISTENER = None
+    listener.stop()
+    if (dropped := _HANDLER.dropped):
+        record = logging.makeLogRecord({'msg': f"Log queue was full, dropped {dropped} records",
+                                        'levelno': logging.WARNING, 'levelname': 'WARNING'})
+        for handler in listener.handlers:
+            handler.handle(record)
+    _HANDLER = None
+
+
+atexit.register(uninstall)
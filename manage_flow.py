@@ -1,60 +1,54 @@
 #!/usr/bin/env python
+""" Create, delete and list flows, and list or export their runs.
+
+`create` and `delete` take many flows at once: flows defined by the
+`*_definition.json` files of a directory, or the flows named by ids, an ids
+file or a title pattern. They run on a pool of `--workers` threads, every
+call going through GOVERNOR, so the pool never exceeds `--rate-limit`.
+`list` and `runs` print every page as it arrives, as table rows or JSON
+lines, instead of collecting the whole listing first. The metadata of the
+flows listed is kept in `.flows.cache.json`, which `list --cache` reads
+instead of the service while it is younger than `--cache-ttl`.
+"""
 import argparse
 import globus_sdk
 import json
 import os
+import re
 import sys
+import time
 
-
-from globus_sdk.tokenstorage import SimpleJSONFileAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from tabulate import tabulate
 
-from settings import LOGGER, GLOBUS_CONFIG
+from globus_sdk.config import get_service_url
 
+from auth import TokenManager, get_authorizer, share_session
+from governor import GOVERNOR, TRANSPORT_PARAMS
+from mock_globus import use_mock
+from settings import LOGGER, MYFLOW_CONFIG_DIR, get_config
 
-SUBSCRIPTION_ID = GLOBUS_CONFIG['subscription']['id']
-NATIVE_APP_CLIENT_ID = GLOBUS_CONFIG['native_app']['id']
-DEFAULT_TOKEN_STORE=GLOBUS_CONFIG['token_store']
 
+CONFIG = get_config()
+SUBSCRIPTION_ID = CONFIG.subscription_id
+NATIVE_APP_CLIENT_ID = CONFIG.client_id
+DEFAULT_TOKEN_STORE = CONFIG.token_store
 
-def do_login_flow(native_client, scopes):
-    native_client.oauth2_start_flow(requested_scopes=scopes, refresh_tokens=True)
-    authorize_url = native_client.oauth2_get_authorize_url()
-    print(f"Please go to this URL and login:\n\n{authorize_url}\n")
-    auth_code = input("Please enter the code here: ").strip()
-    tokens = native_client.oauth2_exchange_code_for_tokens(auth_code)
-    return tokens
+FLOWS_CACHE_FILE = MYFLOW_CONFIG_DIR.joinpath('.flows.cache.json')
 
+# Columns of the table output, with their widths
+FLOW_COLUMNS = (('id', 36), ('title', 40), ('updated_at', 32))
+RUN_COLUMNS = (('run_id', 36), ('flow_title', 30), ('status', 10), ('start_time', 32), ('label', 40))
+RESULT_COLUMNS = (('action', 7), ('id', 36), ('title', 40), ('error', 60))
 
-def get_authorizer(native_client, resource_server, scopes, file_adapter):
-    # try to load the tokens from the file, possibly returning None
-    if file_adapter.file_exists():
-        tokens = file_adapter.get_token_data(resource_server)
-    else:
-        tokens = None
-
-    if tokens is None:
-        # do a login flow, getting back initial tokens
-        response = do_login_flow(native_client=native_client, scopes=scopes)
-        # now store the tokens and pull out the correct token
-        file_adapter.store(response)
-        tokens = response.by_resource_server[resource_server]
+# Flow fields kept in the cache; definitions and schemas are left out
+FLOW_FIELDS = ('id', 'title', 'subtitle', 'description', 'keywords', 'created_at', 'updated_at')
 
-    return globus_sdk.RefreshTokenAuthorizer(
-        tokens["refresh_token"],
-        native_client,
-        access_token=tokens["access_token"],
-        expires_at=tokens["expires_at_seconds"],
-        on_refresh=file_adapter.on_refresh,
-    )
 
-
-def get_flows_client(native_client, resource_server, scopes, file_adapter):
-    return globus_sdk.FlowsClient(
-        authorizer=get_authorizer(native_client=native_client,resource_server=resource_server,
-        scopes=scopes,
-        file_adapter=file_adapter))
+def get_flows_client(tokens, resource_server, scopes):
+    return share_session(globus_sdk.FlowsClient(
+        authorizer=get_authorizer(tokens=tokens, resource_server=resource_server, scopes=scopes),
+        transport_params=TRANSPORT_PARAMS))
 
 
 def create_flow(flows_client,
@@ -63,7 +57,9 @@ def create_flow(flows_client,
                 definition={},
                 input_schema={}):
     LOGGER.info(f"Creating flow: {title}")
-    globus_http_response = flows_client.create_flow(
+    # Not repeatable: an error after the service created the flow is reported, not retried into a duplicate
+    globus_http_response = GOVERNOR.call_once(
+        flows_client.create_flow,
         title=title,
         definition=definition,
         input_schema=input_schema,
@@ -73,13 +69,28 @@ def create_flow(flows_client,
 
 def delete_flow(flows_client, flow_id):
     LOGGER.info(f'Deleting flow id: {flow_id}')
-    globus_http_response = flows_client.delete_flow(flow_id)
-    return globus_http_response 
+    globus_http_response = GOVERNOR.call(flows_client.delete_flow, flow_id)
+    return globus_http_response
 
 
-def list_flows(flows_client):
-    globus_http_response = flows_client.list_flows(filter_role="flow_owner")
-    return globus_http_response
+def iter_pages(list_method, key, per_page=50, query_params=None, **kwargs):
+    """Yield the items of a paginated Flows listing, one page at a time, e.g. key='flows' or 'runs'."""
+    marker = None
+    while True:
+        response = GOVERNOR.call(list_method, marker=marker,
+                                 query_params=dict(query_params or {}, per_page=per_page), **kwargs)
+        yield from response[key]
+        if not response.get('has_next_page') or (marker := response.get('marker')) is None:
+            return None
+
+
+def list_flows(flows_client, per_page=50):
+    return iter_pages(flows_client.list_flows, 'flows', per_page=per_page, filter_role="flow_owner")
+
+
+def list_runs(flows_client, flow_ids=None, per_page=50):
+    return iter_pages(flows_client.list_runs, 'runs', per_page=per_page, filter_flow_id=flow_ids or None,
+                      query_params={"orderby": "start_time DESC"})
 
 
 def dict_from(json_str_or_file:'str'='') -> 'dict':
@@ -90,7 +101,7 @@ def dict_from(json_str_or_file:'str'='') -> 'dict':
     except:
         LOGGER.error(f'Cannot load JSON: {str(json_str_or_file)}')
         return None
-    
+
     try:
         return json.loads(json_str_or_file)
     except:
@@ -98,65 +109,288 @@ def dict_from(json_str_or_file:'str'='') -> 'dict':
         return None
 
 
+def flow_definitions(directory: 'str') -> 'list':
+    """(title, definition file, input schema file or None) of every *_definition.json in `directory`."""
+    found = []
+    for definition_file in sorted(Path(directory).glob('*_definition.json')):
+        title = definition_file.name[:-len('_definition.json')]
+        schema_file = definition_file.with_name(f"{title}_input_schema.json")
+        found.append((title, definition_file, schema_file if schema_file.is_file() else None))
+    return found
+
+
+class FlowCache:
+    """Metadata of the flows last listed, per Flows service, in a JSON file."""
+
+    def __init__(self, path=FLOWS_CACHE_FILE):
+        self.path = Path(path)
+
+    def _load(self) -> 'dict':
+        try:
+            with open(self.path, 'r', encoding='utf-8') as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, cached: 'dict') -> None:
+        # Renamed into place, so that a concurrent reader never sees half a cache
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}"
+        with open(tmp, 'w', encoding='utf-8') as stream:
+            json.dump(cached, stream)
+        os.replace(tmp, self.path)
+
+    def get(self, service: 'str', ttl: 'float') -> 'list|None':
+        if (entry := self._load().get(service)) is None or time.time() - entry['fetched'] > ttl:
+            return None
+        return entry['flows']
+
+    def put(self, service: 'str', flows: 'list') -> None:
+        cached = self._load()
+        cached[service] = {'fetched': time.time(), 'flows': [{k: f.get(k) for k in FLOW_FIELDS} for f in flows]}
+        self._save(cached)
+
+    def update(self, service: 'str', created=(), deleted=()) -> None:
+        """Apply creations and deletions to a cached listing, without making it any younger."""
+        if (entry := (cached := self._load()).get(service)) is None:
+            return None
+        deleted = set(deleted)
+        entry['flows'] = [f for f in entry['flows'] if f['id'] not in deleted] + [
+            {k: f.get(k) for k in FLOW_FIELDS} for f in created]
+        self._save(cached)
+
+
+class Output:
+    """Print records as they come, as JSON lines or as the rows of a fixed-width table."""
+
+    def __init__(self, columns, format: 'str'='table', stream=sys.stdout):
+        self.columns = columns
+        self.format = format
+        self.stream = stream
+        self.rows = 0
+
+    def write(self, record: 'dict') -> None:
+        if self.format == 'jsonl':
+            print(json.dumps(record), file=self.stream, flush=True)
+        else:
+            if self.rows == 0:
+                self._header()
+            self._line(record)
+        self.rows += 1
+
+    def close(self) -> None:
+        # An empty table still gets its header
+        if self.format == 'table' and self.rows == 0:
+            self._header()
+
+    def _header(self) -> None:
+        self._line({name: name for name, _ in self.columns})
+        self._line({name: '-' * width for name, width in self.columns})
+
+    def _line(self, record: 'dict') -> None:
+        cells = []
+        for name, width in self.columns:
+            value = '' if (v := record.get(name)) is None else str(v)
+            cells.append(value[:width - 1] + '…' if len(value) > width else value.ljust(width))
+        print('  '.join(cells).rstrip(), file=self.stream, flush=True)
+
+
+def run_all(fn, items, workers: 'int'):
+    """Call `fn(item)` for every item on `workers` threads; yield (item, result, error) as they finish."""
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="manage") as executor:
+        futures = {executor.submit(fn, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except globus_sdk.FlowsAPIError as e:
+                yield futures[future], None, e.text
+            except Exception as e:
+                yield futures[future], None, f"{e.__class__.__name__}: {e}"
+
+
+def create_all(fc, args, output, cache) -> 'int':
+    if args.from_dir is not None:
+        prefix = '' if args.title is None else f"{args.title} "
+        specs = [(prefix + title, d, s) for title, d, s in flow_definitions(args.from_dir)]
+        if not specs:
+            LOGGER.error(f"No *_definition.json files in {args.from_dir}")
+            return 1
+    else:
+        if args.title is None:
+            raise ValueError("create requires --title or --from-dir")
+        if args.flow_definition is None:
+            raise ValueError("create requires --flow-definition")
+        specs = [(args.title, args.flow_definition, args.input_schema)]
+    if args.skip_existing:
+        existing = {f['title'] for f in list_flows(fc)}
+        specs = [spec for spec in specs if spec[0] not in existing]
+
+    def create(spec):
+        title, definition, input_schema = spec
+        if (flow_definition := dict_from(json_str_or_file=str(definition))) is None:
+            raise ValueError(f"Cannot load the definition {definition}")
+        input_schema = {} if input_schema is None else dict_from(json_str_or_file=str(input_schema))
+        LOGGER.debug(f"flow definition: {flow_definition}")
+        LOGGER.debug(f"flow input schema: {input_schema}")
+        return create_flow(flows_client=fc, title=title, definition=flow_definition,
+                           input_schema=input_schema).data
+
+    created = []
+    failed = 0
+    for (title, _, _), flow, error in run_all(create, specs, args.workers):
+        if error is None:
+            LOGGER.info(f"Created flow id: {flow['id']}")
+            created.append(flow)
+        failed += error is not None
+        output.write({'action': 'create', 'id': None if flow is None else flow['id'], 'title': title, 'error': error})
+    cache.update(fc.base_url, created=created)
+    return 1 if failed else 0
+
+
+def delete_all(fc, args, output, cache) -> 'int':
+    targets = {flow_id: None for flow_id in args.flow_id or ()}
+    if args.ids_file is not None:
+        with (sys.stdin if args.ids_file == '-' else open(args.ids_file, 'r')) as stream:
+            targets.update((line.strip(), None) for line in stream if line.strip() and not line.startswith('#'))
+    if args.match is not None:
+        pattern = re.compile(args.match)
+        targets.update((f['id'], f['title']) for f in list_flows(fc) if pattern.search(f['title'] or ''))
+    if not targets:
+        raise ValueError("delete requires --flow-id, --ids-file or --match")
+    if args.dry_run:
+        for flow_id, title in targets.items():
+            output.write({'action': 'dry-run', 'id': flow_id, 'title': title, 'error': None})
+        return 0
+
+    deleted = []
+    failed = 0
+    for flow_id, response, error in run_all(lambda flow_id: delete_flow(fc, flow_id).data, targets, args.workers):
+        if error is None and response.get('DELETED'):
+            LOGGER.info(f"Deleted flow id: {flow_id}")
+            deleted.append(flow_id)
+        failed += error is not None
+        output.write({'action': 'delete', 'id': flow_id, 'title': targets[flow_id] or (response or {}).get('title'),
+                      'error': error})
+    cache.update(fc.base_url, deleted=deleted)
+    return 1 if failed else 0
+
+
+def show_cached_flows(flows, output, cache) -> 'int':
+    LOGGER.debug(f"Listing {len(flows)} flows from {cache.path}")
+    for flow in flows:
+        output.write(flow)
+    return 0
+
+
+def show_flows(fc, args, output, cache) -> 'int':
+    flows = []
+    for flow in list_flows(fc, per_page=args.per_page):
+        output.write(flow if args.format == 'table' else {k: flow.get(k) for k in FLOW_FIELDS})
+        flows.append(flow)
+    cache.put(fc.base_url, flows)
+    return 0
+
+
+def show_runs(fc, args, output) -> 'int':
+    status = None if not args.status else {s.upper() for s in args.status}
+    export = None if args.export is None else open(args.export, 'w', encoding='utf-8')
+    shown = 0
+    try:
+        for run in list_runs(fc, flow_ids=args.flow_id, per_page=args.per_page):
+            if status is not None and run.get('status') not in status:
+                continue
+            if export is not None:
+                # Whole run documents, details included
+                export.write(json.dumps(run) + '\n')
+            else:
+                output.write(run)
+            if (shown := shown + 1) == args.limit:
+                break
+    finally:
+        if export is not None:
+            export.close()
+            LOGGER.info(f"Exported {shown} runs to {args.export}")
+    return 0
+
 
 def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("action", choices=["create", "delete", "list"])
-    parser.add_argument("-f", "--flow-id", help="Flow ID for delete")
-    parser.add_argument("-t", "--title", help="Name for create")
+    parser = argparse.ArgumentParser(description="Create, delete and list flows, and list or export their runs.")
+    parser.add_argument("action", choices=["create", "delete", "list", "runs"])
+    parser.add_argument("-f", "--flow-id", action="append",
+                        help="Flow ID to delete, or whose runs to list; may be repeated")
+    parser.add_argument("-t", "--title", help="Name for create; prefix of the titles with --from-dir")
     parser.add_argument("-d", "--flow-definition", help="JSON file or inline JSON definition to create flow")
     parser.add_argument("-s", "--input-schema", help="JSON file or inline JSON input schema to create flow")
+    parser.add_argument("--from-dir", help="Create a flow from every *_definition.json in this directory, "
+                                           "with the *_input_schema.json of the same name")
+    parser.add_argument("--skip-existing", action="store_true", help="Do not create flows whose title exists")
+    parser.add_argument("--ids-file", help="File with one flow ID per line to delete, - for stdin")
+    parser.add_argument("--match", help="Delete every flow you own whose title matches this regular expression")
+    parser.add_argument("--dry-run", action="store_true", help="Show the flows delete would remove")
+    parser.add_argument("--status", action="append", help="Only list runs in this status; may be repeated")
+    parser.add_argument("--limit", type=int, default=None, help="List at most this many runs")
+    parser.add_argument("--export", help="Write the runs listed, whole, to this JSON lines file")
+    parser.add_argument("--format", choices=["table", "jsonl"], default="table",
+                        help="Print a table or one JSON object per line. [default: table]")
+    parser.add_argument("--per-page", type=int, default=50, help="Items per listing page. [default: 50]")
+    parser.add_argument("--cache", action="store_true",
+                        help="List flows from the local cache when it is younger than --cache-ttl")
+    parser.add_argument("--cache-ttl", type=float, default=300.0, help="Seconds a cached listing is used. [default: 300]")
+    parser.add_argument("--workers", type=int, default=8, help="Flows created or deleted at once. [default: 8]")
+    parser.add_argument("--rate-limit", type=float, default=10.0,
+                        help="Globus API calls per second, all workers together. [default: 10]")
+    parser.add_argument("--burst", type=int, default=20,
+                        help="Globus API calls allowed in a burst above --rate-limit. [default: 20]")
     args = parser.parse_args()
-
+    mocked = use_mock()
+    GOVERNOR.configure(rate=args.rate_limit, burst=args.burst)
 
     try:
-        native_client = globus_sdk.NativeAppAuthClient(NATIVE_APP_CLIENT_ID)
-        file_adapter = SimpleJSONFileAdapter(
-            os.path.abspath(os.path.expanduser(DEFAULT_TOKEN_STORE)))
-        
+        cache = FlowCache()
+        # The cache is keyed by the service URL, as clients are; using it needs no client, and so no login
+        if args.action == "list" and args.cache \
+                and (flows := cache.get(get_service_url('flows'), args.cache_ttl)) is not None:
+            status = show_cached_flows(flows, output := Output(FLOW_COLUMNS, args.format), cache)
+            output.close()
+            sys.exit(status)
+
+        native_client = share_session(globus_sdk.NativeAppAuthClient(NATIVE_APP_CLIENT_ID))
+        # The mock service needs no stored tokens
+        tokens = None if mocked else TokenManager(native_client, DEFAULT_TOKEN_STORE)
+
         flow_client_scopes = [globus_sdk.FlowsClient.scopes.manage_flows]
+        if args.action == "runs":
+            flow_client_scopes.append(globus_sdk.FlowsClient.scopes.run_status)
         resource_server = globus_sdk.FlowsClient.resource_server
 
 
         fc = get_flows_client(
-            native_client=native_client,
+            tokens=tokens,
             resource_server=resource_server,
-            scopes=flow_client_scopes,
-            file_adapter=file_adapter)
-        
+            scopes=flow_client_scopes)
+
         if (command := args.action) == "create":
-            if (t := args.title) is None:
-                parser.error("create requires --title")
-            if (d := args.flow_definition) is None:
-                parser.error("create requires --flow-definition")
-            flow_definition = dict_from(json_str_or_file=d)
-            input_schema = dict_from(json_str_or_file=args.input_schema)
-            LOGGER.debug(f"flow definition: {flow_definition}")
-            LOGGER.debug(f"flow input schema: {input_schema}")
-            response = create_flow(
-                flows_client=fc, title=t, definition=flow_definition,
-                input_schema=input_schema)
-            if not (d := response.data)['id'] is None:
-                LOGGER.info(f"Created flow id: {d['id']}")
+            status = create_all(fc, args, output := Output(RESULT_COLUMNS, args.format), cache)
         elif command == "delete":
-            if (id := args.flow_id) is None:
-                parser.error("delete requires --flow-id")
-            response = delete_flow(flows_client=fc, flow_id=id)
-            if (d := response.data)['DELETED']:
-                LOGGER.info(f"Deleted flow id: {d['id']}")
+            status = delete_all(fc, args, output := Output(RESULT_COLUMNS, args.format), cache)
         elif command == "list":
-            response = list_flows(fc)
-            flows = [ [f['id'], f['title']] for f in response.data['flows']]
-            print("\n")
-            print(tabulate(tabular_data=flows, headers=['flow_id', 'title'], tablefmt='pretty'))
-            print("\n")
+            status = show_flows(fc, args, output := Output(FLOW_COLUMNS, args.format), cache)
+        elif command == "runs":
+            status = show_runs(fc, args, output := Output(RUN_COLUMNS, args.format))
         else:
             raise NotImplementedError()
+        output.close()
+    except ValueError as e:
+        parser.error(str(e))
     except globus_sdk.FlowsAPIError as e:
         #LOGGER.error(f"{e.code} {e.message}")
         LOGGER.error(f"{e.text}")
         sys.exit(1)
+    except BrokenPipeError:
+        # e.g. piped into head
+        sys.exit(0)
+    sys.exit(status)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,185 @@
+""" Include/exclude/prune rules for the paths seen by the watcher.
+
+Rules are compiled once:
+
+    include   suffixes (".dat") go into one tuple tested with a single
+              `str.endswith`; globs ("run_*/**/*.h5") go into one regex
+    exclude   same forms; a file matching any exclude rule never triggers,
+              e.g. temporary files "*.tmp", "*.part", ".*"
+    prune     directory names or globs ("processed", "scratch*") pruned at
+              any depth, or relative paths ("raw/*/tmp"); their whole
+              subtree is ignored and not watched at all
+
+Globs without a "/" are matched against the file name, others against the
+path relative to the watch root. `*` and `?` do not cross "/", `**` does.
+"""
+import operator
+import os
+import re
+
+
+_GLOB_CHARS = re.compile(r'[*?\[]')
+
+
+def glob_to_regex(pattern: 'str') -> 'str':
+    """Translate a path glob to a regex fragment."""
+    i, n = 0, len(pattern)
+    out = []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 2] == '**':
+                i += 2
+                if pattern[i:i + 1] == '/':
+                    # "**/" also matches no directory at all
+                    out.append('(?:.*/)?')
+                    i += 1
+                else:
+                    out.append('.*')
+                continue
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[' and (j := pattern.find(']', i + 2 if pattern[i + 1:i + 2] in '!]' else i + 1)) != -1:
+            body = pattern[i + 1:j].replace('\\', '\\\\')
+            out.append('[^' + body[1:] + ']' if body.startswith('!') else '[' + body + ']')
+            i = j
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+
+def _compile(patterns: 'list', anchored: 'bool'=True) -> 're.Pattern|None':
+    if not patterns:
+        return None
+    body = '|'.join(f"(?:{glob_to_regex(p)})" for p in patterns)
+    return re.compile(f"(?:{body})\\Z" if anchored else body)
+
+
+class PathMatcher:
+    def __init__(self, include=(), exclude=(), prune=(), root: 'str|None'=None):
+        self.root = None if root is None else os.path.abspath(root).rstrip(os.sep)
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.prune = list(prune)
+
+        self._include_suffixes, self._include_name, self._include_path = self._split(self.include)
+        self._exclude_suffixes, self._exclude_name, self._exclude_path = self._split(self.exclude)
+
+        names = [p.rstrip('/') for p in self.prune if '/' not in p.rstrip('/')]
+        paths = [p.rstrip('/') for p in self.prune if '/' in p.rstrip('/')]
+        # A file is pruned when any directory component of its relative path matches
+        self._prune_name = None if not names else re.compile(
+            '(?:^|/)(?:' + '|'.join(f"(?:{glob_to_regex(p)})" for p in names) + ')/')
+        self._prune_path = None if not paths else re.compile(
+            '^(?:' + '|'.join(f"(?:{glob_to_regex(p)})" for p in paths) + ')/')
+
+        if self.include and not (self.exclude or self.prune or self._include_name or self._include_path):
+            # Plain suffix rules need nothing but one C-level str.endswith per event
+            self.matches = operator.methodcaller('endswith', self._include_suffixes)
+
+    @classmethod
+    def from_patterns(cls, patterns, root: 'str|None'=None) -> 'PathMatcher':
+        if callable(getattr(patterns, 'matches', None)):
+            # Already compiled, a PathMatcher or a routing.RoutingTable
+            return patterns
+        return cls(include=[] if patterns is None else patterns, root=root)
+
+    @staticmethod
+    def _split(patterns: 'list') -> 'tuple':
+        suffixes = tuple(p for p in patterns if not _GLOB_CHARS.search(p))
+        name_globs = [p for p in patterns if _GLOB_CHARS.search(p) and '/' not in p]
+        path_globs = [p for p in patterns if _GLOB_CHARS.search(p) and '/' in p]
+        return suffixes, _compile(name_globs), _compile(path_globs)
+
+    def relative(self, path: 'str') -> 'str':
+        if os.sep != '/':
+            path = path.replace(os.sep, '/')
+        if self.root is not None:
+            root = self.root.replace(os.sep, '/')
+            if path.startswith(root + '/'):
+                return path[len(root) + 1:]
+        return path.lstrip('/')
+
+    def matches(self, path: 'str') -> bool:
+        """True when a file at `path` should trigger a flow."""
+        if self._exclude_suffixes and path.endswith(self._exclude_suffixes):
+            return False
+        if self._exclude_name is not None or self._include_name is not None:
+            name = path[path.rfind(os.sep) + 1:]
+            if (r := self._exclude_name) is not None and r.match(name):
+                return False
+
+        rel = None
+        if self._exclude_path is not None or self._prune_name is not None or self._prune_path is not None:
+            rel = self.relative(path)
+            if (r := self._exclude_path) is not None and r.match(rel):
+                return False
+            if self.pruned(rel):
+                return False
+
+        if self._include_suffixes and path.endswith(self._include_suffixes):
+            return True
+        if (r := self._include_name) is not None and r.match(name):
+            return True
+        if (r := self._include_path) is not None:
+            return r.match(self.relative(path) if rel is None else rel) is not None
+        return False
+
+    def pruned(self, rel: 'str') -> bool:
+        """True when a relative file path lies in a pruned directory."""
+        if (r := self._prune_name) is not None and r.search(rel):
+            return True
+        return (r := self._prune_path) is not None and r.match(rel) is not None
+
+    def prunes(self, directory: 'str') -> bool:
+        """True when the subtree at `directory` should be neither watched nor scanned."""
+        if not self.prune:
+            return False
+        return self.pruned(self.relative(directory).rstrip('/') + '/')
+
+    def plan_watches(self, root: 'str|None'=None) -> 'list':
+        """Return the (directory, recursive) watches covering `root` minus pruned subtrees."""
+        root = os.path.abspath(self.root if root is None else root)
+        if not self.prune:
+            return [(root, True)]
+        return plan_watches(root, self.prunes)
+
+
+def plan_watches(root: 'str', prunes) -> 'list':
+    """Return the (directory, recursive) watches covering `root` minus the subtrees `prunes(directory)` rejects.
+
+    Directories with no pruned directory below them get one recursive watch;
+    directories above a pruned one are watched non-recursively.
+    """
+    # Directories having a pruned directory somewhere below them
+    tainted = {}
+    for dirpath, dirnames, _ in os.walk(root):
+        kept = []
+        for d in dirnames:
+            if prunes(os.path.join(dirpath, d)):
+                p = dirpath
+                while p not in tainted:
+                    tainted[p] = None
+                    if p == root:
+                        break
+                    p = os.path.dirname(p)
+            else:
+                kept.append(d)
+        dirnames[:] = kept
+
+    watches = []
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        if d not in tainted:
+            watches.append((d, True))
+            continue
+        watches.append((d, False))
+        try:
+            with os.scandir(d) as it:
+                stack.extend(e.path for e in it if e.is_dir(follow_symlinks=False) and not prunes(e.path))
+        except OSError:
+            pass
+    return watches
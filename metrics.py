@@ -0,0 +1,417 @@
+""" Counters, gauges and latency histograms for the watcher.
+
+Metrics live in a `Registry` (module-level `REGISTRY`) and are exported as
+Prometheus text by `MetricsServer` (GET /metrics) and/or written as JSON
+snapshots by `SnapshotWriter`. Updating a metric costs one lock and an
+addition; a histogram adds a bisect over its buckets. Values that components
+already count, such as queue depth or runs in flight, are read by callback
+metrics at export time and cost nothing per event.
+
+`SPANS` optionally times each file through the pipeline stages
+created -> ready -> submitted -> completed. It is disabled by default; when
+enabled, every stage transition is observed in `watcher_stage_seconds` and
+finished spans may be appended to a JSON lines file.
+"""
+import json
+import os
+import threading
+import time
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from settings import LOGGER
+
+
+# Seconds, from sub-millisecond event handling to hour-long runs
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+def _escape(value) -> 'str':
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: 'tuple', values: 'tuple') -> 'str':
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+def _number(value: 'float') -> 'str':
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: 'str', help: 'str', labelnames: 'tuple'=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values) -> '_Metric':
+        """The child metric for one combination of label values."""
+        if (child := self._children.get(values)) is None:
+            with self._lock:
+                if (child := self._children.get(values)) is None:
+                    child = self._children[values] = self._child()
+        return child
+
+    def _child(self):
+        raise NotImplementedError()
+
+    def samples(self) -> 'list':
+        """[(suffix, labels, value)] at this moment."""
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception:
+                LOGGER.debug(f"Metric callback failed: {self.name}", exc_info=True)
+                return []
+            if isinstance(value, dict):
+                return [('', _labels(self.labelnames, k if isinstance(k, tuple) else (k,)), v)
+                        for k, v in value.items() if v is not None]
+            return [] if value is None else [('', '', value)]
+        out = []
+        for values, child in list(self._children.items()):
+            out.extend((suffix, _labels(self.labelnames + extra_names, values + extra), v)
+                       for suffix, extra_names, extra, v in child.samples())
+        return out
+
+
+class _Value:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: 'float'=1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: 'float'=1) -> None:
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value: 'float') -> None:
+        self.value = value
+
+    def samples(self) -> 'list':
+        return [('', (), (), self.value)]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount: 'float'=1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _child(self):
+        return _Value()
+
+    def set(self, value: 'float') -> None:
+        self.labels().set(value)
+
+    def inc(self, amount: 'float'=1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: 'float'=1) -> None:
+        self.labels().dec(amount)
+
+
+class _Buckets:
+    __slots__ = ('bounds', 'counts', 'sum', 'lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: 'float') -> None:
+        i = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self) -> 'list':
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        out = []
+        cumulative = 0
+        for bound, n in zip(self.bounds + (float('inf'),), counts):
+            cumulative += n
+            out.append(('_bucket', ('le',), (_number(bound),), cumulative))
+        out.append(('_sum', (), (), total))
+        out.append(('_count', (), (), cumulative))
+        return out
+
+    def totals(self) -> 'tuple':
+        """The bucket counts and the sum, copied together."""
+        with self.lock:
+            return list(self.counts), self.sum
+
+    def quantile(self, q: 'float', counts: 'list|None'=None) -> 'float|None':
+        """Upper bucket bound below which a fraction `q` of the observations fall, in `counts` if given."""
+        if counts is None:
+            counts = self.totals()[0]
+        if not (total := sum(counts)):
+            return None
+        cumulative = 0
+        for bound, n in zip(self.bounds + (float('inf'),), counts):
+            cumulative += n
+            if cumulative >= q * total:
+                return bound
+        return float('inf')
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: 'str', help: 'str', labelnames: 'tuple'=(), buckets: 'tuple'=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value: 'float') -> None:
+        self.labels().observe(value)
+
+    def time(self):
+        """Context manager observing the seconds spent in its block."""
+        return _Timer(self.labels())
+
+
+class _Timer:
+    __slots__ = ('target', 'start')
+
+    def __init__(self, target):
+        self.target = target
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.target.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Registry:
+    def __init__(self, prefix: 'str'=''):
+        self.prefix = prefix
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        name = self.prefix + name
+        with self._lock:
+            if (metric := self._metrics.get(name)) is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif 'fn' in kwargs and kwargs['fn'] is not None:
+                # Re-registering a callback, e.g. for a new FileTrigger, replaces the old one
+                metric.fn = kwargs['fn']
+            return metric
+
+    def counter(self, name: 'str', help: 'str', labelnames: 'tuple'=(), fn=None) -> 'Counter':
+        return self._get(Counter, name, help, labelnames, fn=fn)
+
+    def gauge(self, name: 'str', help: 'str', labelnames: 'tuple'=(), fn=None) -> 'Gauge':
+        return self._get(Gauge, name, help, labelnames, fn=fn)
+
+    def histogram(self, name: 'str', help: 'str', labelnames: 'tuple'=(),
+                  buckets: 'tuple'=DEFAULT_BUCKETS) -> 'Histogram':
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self) -> 'str':
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            if not (samples := metric.samples()):
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{metric.name}{suffix}{labels} {_number(value)}" for suffix, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> 'dict':
+        """{metric{labels}: value}, with p50/p95/p99 bucket bounds for histograms."""
+        out = {}
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            if isinstance(metric, Histogram):
+                for values, child in list(metric._children.items()):
+                    key = metric.name + _labels(metric.labelnames, values)
+                    counts, total = child.totals()
+                    out[key] = {'count': sum(counts), 'sum': round(total, 6),
+                                **{f"p{int(q * 100)}": child.quantile(q, counts) for q in (0.5, 0.95, 0.99)}}
+                continue
+            for suffix, labels, value in metric.samples():
+                out[metric.name + suffix + labels] = value
+        return out
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        LOGGER.debug(f"{self.address_string()} {format % args}")
+
+    def do_GET(self):
+        if self.path.split('?')[0].rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        data = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serve the registry as Prometheus text at http://host:port/metrics."""
+    daemon_threads = True
+
+    def __init__(self, registry: 'Registry|None'=None, host: 'str'='127.0.0.1', port: 'int'=9464):
+        super().__init__((host, port), _MetricsHandler)
+        self.registry = REGISTRY if registry is None else registry
+        self._thread = None
+
+    def start(self) -> 'MetricsServer':
+        self._thread = threading.Thread(target=self.serve_forever, name="metrics-http", daemon=True)
+        self._thread.start()
+        host, port = self.server_address[:2]
+        LOGGER.info(f"Serving metrics at http://{host}:{port}/metrics")
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+
+
+class SnapshotWriter:
+    """Write `registry.snapshot()` as JSON to `path` every `interval` seconds."""
+
+    def __init__(self, path: 'str', registry: 'Registry|None'=None, interval: 'float'=15.0):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.registry = REGISTRY if registry is None else registry
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> 'SnapshotWriter':
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-snapshot", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+        self.write()
+
+    def write(self) -> None:
+        # Replace the file whole so readers never see a partial snapshot
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as stream:
+            json.dump({'timestamp': time.time(), 'metrics': self.registry.snapshot()}, stream)
+        os.replace(tmp, self.path)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                LOGGER.exception(f"Writing metrics snapshot to {self.path} failed")
+
+
+class Spans:
+    """Per-file timing of the pipeline stages, off unless enabled."""
+    STAGES = ('created', 'ready', 'submitted', 'completed')
+
+    def __init__(self, registry: 'Registry|None'=None, max_open: 'int'=100000):
+        self.enabled = False
+        self.registry = REGISTRY if registry is None else registry
+        self.max_open = max_open
+        self._open = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._stage_seconds = None
+
+    def enable(self, path: 'str|None'=None) -> None:
+        """Start timing files; finished spans are appended to `path` as JSON lines if given."""
+        self._stage_seconds = self.registry.histogram(
+            'watcher_stage_seconds', 'Seconds a file spent reaching a pipeline stage from the previous one',
+            ('stage',))
+        if path is not None:
+            path = os.path.abspath(os.path.expanduser(path))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = open(path, 'a', encoding='utf-8', buffering=1)
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+        if (f := self._file) is not None:
+            self._file = None
+            f.close()
+
+    def mark(self, path: 'str', stage: 'str') -> None:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            if (span := self._open.get(path)) is None:
+                if stage != 'created' and stage != 'ready':
+                    # A file recovered from the journal or adopted from an earlier watcher
+                    return None
+                if len(self._open) >= self.max_open:
+                    self._open.pop(next(iter(self._open)))
+                span = self._open[path] = {}
+            previous = span[next(reversed(span))] if span else None
+            span[stage] = now
+            done = stage == 'completed'
+            if done:
+                del self._open[path]
+        if previous is not None:
+            self._stage_seconds.labels(stage).observe(now - previous)
+        if done and (f := self._file) is not None:
+            try:
+                f.write(json.dumps({'path': path, **span}) + '\n')
+            except ValueError:
+                pass
+
+    def finish(self, paths: 'list') -> None:
+        """Close the spans of files whose run ended."""
+        if self.enabled:
+            for path in paths:
+                self.mark(path, 'completed')
+
+
+SPANS = Spans()
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+""" A local stand-in for the Globus Flows service, for load testing.
+
+Implements the Flows endpoints used by `manage_flow.py` and the watcher:
+
+    POST   /flows              create a flow (definition and input schema)
+    GET    /flows              list flows
+    GET    /flows/<id>         get a flow
+    DELETE /flows/<id>         delete a flow
+    POST   /flows/<id>/run     start a run
+    GET    /runs               list runs, newest first, paginated with a marker
+    GET    /runs/<id>          get a run
+    GET    /mock/stats         request counters of the mock itself
+
+Runs do nothing: each finishes `run_duration` seconds after it started, as
+FAILED with probability `run_failure_rate`, else SUCCEEDED. Every request may
+be delayed (`latency` + up to `jitter` seconds), throttled with a 429 and a
+Retry-After header (`throttle_rate`), or failed with a 503 (`error_rate`).
+
+Start it and point the scripts at it:
+
+    ./mock_globus.py --port 8765 --preload flows --throttle-rate 0.05
+    export GLOBUS_FLOWS_MOCK_URL=http://127.0.0.1:8765/
+
+With GLOBUS_FLOWS_MOCK_URL set, the SDK clients are sent to the mock with a
+dummy access token and no login is needed.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+from settings import LOGGER
+
+
+MOCK_URL_VAR = 'GLOBUS_FLOWS_MOCK_URL'
+MOCK_TOKEN = 'mock-access-token'
+
+
+def mock_url() -> 'str|None':
+    return os.getenv(MOCK_URL_VAR) or None
+
+
+def use_mock() -> bool:
+    """Send SDK Flows clients to the mock server when GLOBUS_FLOWS_MOCK_URL is set."""
+    if (url := mock_url()) is None:
+        return False
+    os.environ['GLOBUS_SDK_SERVICE_URL_FLOWS'] = url
+    LOGGER.warning(f"Using mock Flows service at {url}")
+    return True
+
+
+def mock_authorizer():
+    import globus_sdk
+    return globus_sdk.AccessTokenAuthorizer(MOCK_TOKEN)
+
+
+class MockError(Exception):
+    def __init__(self, status: 'int', code: 'str', description: 'str', headers: 'dict|None'=None):
+        super().__init__(description)
+        self.status = status
+        self.code = code
+        self.description = description
+        self.headers = headers or {}
+
+
+def _now() -> 'str':
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _validate(instance, schema) -> None:
+    try:
+        import jsonschema
+    except ImportError:
+        # Inputs are accepted unchecked where jsonschema is not installed
+        return None
+    try:
+        jsonschema.validate(instance, schema)
+    except jsonschema.ValidationError as e:
+        raise MockError(400, 'FLOW_INPUT_ERROR', e.message)
+
+
+class MockFlowsService:
+    def __init__(self, latency: 'float'=0.0, jitter: 'float'=0.0, error_rate: 'float'=0.0,
+                 throttle_rate: 'float'=0.0, retry_after: 'float'=1.0, run_duration: 'float'=5.0,
+                 run_failure_rate: 'float'=0.0, seed: 'int|None'=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.run_duration = run_duration
+        self.run_failure_rate = run_failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._flows = {}
+        self._runs = {}
+        self._order = []
+        self.requests = {}
+        self.responses = {}
+
+    def fault(self, route: 'str') -> None:
+        """Delay the request and maybe fail it, as configured."""
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            draw = self._random.random()
+        if delay > 0:
+            time.sleep(delay)
+        if draw < self.throttle_rate:
+            raise MockError(429, 'TOO_MANY_REQUESTS', 'Rate limit exceeded',
+                            {'Retry-After': f"{self.retry_after:g}"})
+        if draw < self.throttle_rate + self.error_rate:
+            raise MockError(503, 'SERVICE_UNAVAILABLE', 'Injected failure')
+
+    def responded(self, status: 'int') -> None:
+        with self._lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+
+    def create_flow(self, body: 'dict', flow_id: 'str|None'=None) -> 'dict':
+        definition = body.get('definition')
+        if not isinstance(definition, dict) or not isinstance(states := definition.get('States'), dict) \
+                or definition.get('StartAt') not in states:
+            raise MockError(400, 'UNPROCESSABLE_ENTITY', 'definition needs States and a StartAt among them')
+        if not body.get('title'):
+            raise MockError(400, 'UNPROCESSABLE_ENTITY', 'title is required')
+        flow_id = str(uuid.uuid4()) if flow_id is None else flow_id
+        flow = {
+            'id': flow_id,
+            'title': body['title'],
+            'subtitle': body.get('subtitle') or '',
+            'description': body.get('description') or '',
+            'definition': definition,
+            'input_schema': body.get('input_schema') or {},
+            'keywords': body.get('keywords') or [],
+            'created_at': _now(),
+            'updated_at': _now(),
+        }
+        with self._lock:
+            self._flows[flow_id] = flow
+        return flow
+
+    def get_flow(self, flow_id: 'str') -> 'dict':
+        with self._lock:
+            if (flow := self._flows.get(flow_id)) is None:
+                raise MockError(404, 'NOT_FOUND', f"No flow {flow_id}")
+            return flow
+
+    def list_flows(self, params: 'dict') -> 'dict':
+        with self._lock:
+            flows = list(self._flows.values())
+        return self._page(flows, params, 'flows')
+
+    def delete_flow(self, flow_id: 'str') -> 'dict':
+        with self._lock:
+            if (flow := self._flows.pop(flow_id, None)) is None:
+                raise MockError(404, 'NOT_FOUND', f"No flow {flow_id}")
+        return dict(flow, DELETED=True)
+
+    def run_flow(self, flow_id: 'str', body: 'dict') -> 'dict':
+        flow = self.get_flow(flow_id)
+        if not isinstance(flow_input := body.get('body'), dict):
+            raise MockError(400, 'UNPROCESSABLE_ENTITY', 'body must be an object')
+        if (schema := flow['input_schema']):
+            _validate(flow_input, schema)
+        started = time.time()
+        with self._lock:
+            failed = self._random.random() < self.run_failure_rate
+        run = {
+            'run_id': (run_id := str(uuid.uuid4())),
+            'action_id': run_id,
+            'flow_id': flow_id,
+            'flow_title': flow['title'],
+            'label': body.get('label') or '',
+            'tags': body.get('tags') or [],
+            'status': 'ACTIVE',
+            'start_time': datetime.fromtimestamp(started, timezone.utc).isoformat(),
+            'completion_time': None,
+            'details': {},
+        }
+        with self._lock:
+            self._runs[run_id] = (run, started + self.run_duration, 'FAILED' if failed else 'SUCCEEDED')
+            self._order.append(run_id)
+        return dict(run)
+
+    def _current(self, run_id: 'str') -> 'dict|None':
+        if (entry := self._runs.get(run_id)) is None:
+            return None
+        run, completes, outcome = entry
+        if run['status'] == 'ACTIVE' and time.time() >= completes:
+            run['status'] = outcome
+            run['completion_time'] = datetime.fromtimestamp(completes, timezone.utc).isoformat()
+        return dict(run)
+
+    def get_run(self, run_id: 'str') -> 'dict':
+        with self._lock:
+            if (run := self._current(run_id)) is None:
+                raise MockError(404, 'NOT_FOUND', f"No run {run_id}")
+            return run
+
+    def list_runs(self, params: 'dict') -> 'dict':
+        # The SDK sends several flow ids comma separated
+        flow_ids = {f for value in params.get('filter_flow_id', []) for f in value.split(',') if f}
+        with self._lock:
+            runs = [r for run_id in reversed(self._order)
+                    if (r := self._current(run_id)) is not None and (not flow_ids or r['flow_id'] in flow_ids)]
+        return self._page(runs, params, 'runs')
+
+    @staticmethod
+    def _page(items: 'list', params: 'dict', key: 'str') -> 'dict':
+        try:
+            offset = int(params.get('marker', ['0'])[0])
+            per_page = max(1, min(50, int(params.get('per_page', ['20'])[0])))
+        except ValueError:
+            raise MockError(400, 'INVALID_PARAMETERS', 'marker and per_page must be integers')
+        page = items[offset:offset + per_page]
+        more = offset + per_page < len(items)
+        return {key: page, 'has_next_page': more, 'marker': str(offset + per_page) if more else None}
+
+    def stats(self) -> 'dict':
+        with self._lock:
+            runs = [self._current(run_id) for run_id in self._order]
+            return {
+                'flows': len(self._flows),
+                'runs': len(runs),
+                'runs_by_status': {s: sum(1 for r in runs if r['status'] == s)
+                                   for s in {r['status'] for r in runs}},
+                'requests': dict(self.requests),
+                'responses': {str(k): v for k, v in self.responses.items()},
+            }
+
+
+_ROUTES = [
+    ('POST', re.compile(r'/flows/?'), 'create_flow'),
+    ('GET', re.compile(r'/flows/?'), 'list_flows'),
+    ('GET', re.compile(r'/flows/(?P<flow_id>[^/]+)/?'), 'get_flow'),
+    ('DELETE', re.compile(r'/flows/(?P<flow_id>[^/]+)/?'), 'delete_flow'),
+    ('POST', re.compile(r'/flows/(?P<flow_id>[^/]+)/run/?'), 'run_flow'),
+    ('GET', re.compile(r'/runs/?'), 'list_runs'),
+    ('GET', re.compile(r'/runs/(?P<run_id>[^/]+)/?'), 'get_run'),
+]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        LOGGER.debug(f"{self.address_string()} {format % args}")
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method: 'str') -> None:
+        service = self.server.service
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if url.path.rstrip('/') == '/mock/stats':
+            return self._respond(200, service.stats())
+        try:
+            for route_method, pattern, action in _ROUTES:
+                if route_method == method and (m := pattern.fullmatch(url.path)):
+                    break
+            else:
+                raise MockError(404, 'NOT_FOUND', f"No route for {method} {url.path}")
+            service.fault(action)
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                raise MockError(401, 'UNAUTHORIZED', 'Missing bearer token')
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                raise MockError(400, 'BAD_REQUEST', 'Body is not valid JSON')
+            if action == 'create_flow':
+                result = service.create_flow(body)
+            elif action == 'run_flow':
+                result = service.run_flow(m['flow_id'], body)
+            elif action in ('list_flows', 'list_runs'):
+                result = getattr(service, action)(params)
+            else:
+                result = getattr(service, action)(*m.groupdict().values())
+            status = 201 if action == 'create_flow' else 200
+        except MockError as e:
+            return self._respond(e.status, {'code': e.code, 'description': e.description,
+                                            'error': {'code': e.code, 'detail': e.description}}, e.headers)
+        self._respond(status, result)
+
+    def _respond(self, status: 'int', body: 'dict', headers: 'dict|None'=None) -> None:
+        self.server.service.responded(status)
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockFlowsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service: 'MockFlowsService|None'=None, host: 'str'='127.0.0.1', port: 'int'=0):
+        super().__init__((host, port), _Handler)
+        self.service = MockFlowsService() if service is None else service
+        self._thread = None
+
+    @property
+    def url(self) -> 'str':
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> 'MockFlowsServer':
+        """Serve from a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, name="mock-flows", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+
+    def preload(self, directory: 'str|Path') -> 'dict':
+        """Create a flow from every *_flow_definition.json in `directory`; return {title: flow_id}.
+
+        Flow ids are derived from the file names, so they survive restarts of the mock.
+        """
+        flows = {}
+        for definition_file in sorted(Path(directory).glob('*_flow_definition.json')):
+            title = definition_file.name[:-len('_definition.json')]
+            schema_file = definition_file.with_name(f"{title}_input_schema.json")
+            with open(definition_file) as stream:
+                body = {'title': title, 'definition': json.load(stream)}
+            if schema_file.is_file():
+                with open(schema_file) as stream:
+                    body['input_schema'] = json.load(stream)
+            flow_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"mock-flows:{title}"))
+            flows[title] = self.service.create_flow(body, flow_id=flow_id)['id']
+        return flows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Globus Flows service")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request. [default: 0]")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many more seconds, at random. [default: 0]")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failed with a 503. [default: 0]")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests throttled with a 429. [default: 0]")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds of a 429. [default: 1]")
+    parser.add_argument("--run-duration", type=float, default=5.0, help="Seconds until a run finishes. [default: 5]")
+    parser.add_argument("--run-failure-rate", type=float, default=0.0, help="Fraction of runs that fail. [default: 0]")
+    parser.add_argument("--preload", type=str, default=None, help="Create the flows defined in this directory, e.g. flows")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    service = MockFlowsService(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after, run_duration=args.run_duration,
+        run_failure_rate=args.run_failure_rate, seed=args.seed)
+    server = MockFlowsServer(service, host=args.host, port=args.port)
+    if args.preload is not None:
+        for title, flow_id in server.preload(args.preload).items():
+            print(f"{flow_id}  {title}")
+    print(f"\nexport {MOCK_URL_VAR}={server.url}\n", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
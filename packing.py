@@ -0,0 +1,330 @@
+""" Pack bursts of small ready files into archives transferred as single files.
+
+Transfer pays a fixed cost per file, so tens of thousands of KB-sized files
+move far slower than their bytes would. A `Packer` is a drop-in flow runner:
+the dispatcher calls it once per ready file, and files up to `max_file_size`
+bytes are streamed into a tar archive (zstd-compressed with `compression`
+'zstd') in `staging_dir`, one archive per directory the files were written
+to. An archive is closed when it holds `max_files` files or `max_bytes`
+bytes, or `window` seconds after its first file, and the archive runner
+then starts one flow for it. Larger files and dataset directories go to the
+per-file runner unchanged.
+
+Each archive ends with a `.pack-manifest.json` member listing the name,
+size, mtime and sha256 of every file, which the compute function checks
+when it restores the files (see `process_images(archives=...)`). An
+archive stays in the staging directory until its run succeeds, so that a
+failed run can be resubmitted with the same archive.
+"""
+import hashlib
+import io
+import itertools
+import json
+import os
+import socket
+import tarfile
+import threading
+import time
+
+from journal import SUBMITTED, FAILED
+from metrics import REGISTRY, SPANS
+from settings import LOGGER
+
+
+ARCHIVE_FILES = REGISTRY.histogram(
+    'watcher_archive_files', 'Files per submitted archive', buckets=(1, 10, 100, 500, 1000, 5000, 10000, 50000))
+PACKED_BYTES = REGISTRY.counter('watcher_packed_bytes_total', 'Bytes of files packed into archives, before compression')
+ARCHIVE_BYTES = REGISTRY.counter('watcher_archive_bytes_total', 'Bytes of archives written to the staging directory')
+
+MANIFEST = '.pack-manifest.json'
+COMPRESSIONS = (None, 'zstd')
+
+
+class _Archive:
+    __slots__ = ('path', 'raw', 'stream', 'tar', 'members', 'bytes', 'opened', 'closed', 'lock')
+
+    def __init__(self, path, raw, stream, tar):
+        self.path = path
+        self.raw = raw
+        self.stream = stream
+        self.tar = tar
+        self.members = {}
+        self.bytes = 0
+        self.opened = time.monotonic()
+        self.closed = False
+        self.lock = threading.Lock()
+
+
+class Packer:
+    def __init__(self, ArchiveRunner, staging_dir: 'str', FileRunner=None, max_files: 'int'=10000,
+                 max_bytes: 'int'=256 << 20, max_file_size: 'int'=1 << 20, window: 'float'=10.0,
+                 compression: 'str|None'=None, level: 'int'=3, group_of=os.path.dirname,
+                 journal=None, tracker=None):
+        """Pack files into archives in `staging_dir` and run `ArchiveRunner(archive, paths)` on each.
+
+        `FileRunner(path)` runs the flow of a file too large to pack.
+        Files with the same `group_of(path)` share archives.
+        """
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {COMPRESSIONS}")
+        if compression == 'zstd':
+            import zstandard
+            self._compressor = zstandard.ZstdCompressor(level=level)
+        self.ArchiveRunner = ArchiveRunner
+        self.FileRunner = FileRunner
+        self.staging_dir = os.path.abspath(os.path.expanduser(staging_dir))
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.window = window
+        self.compression = compression
+        self.group_of = group_of
+        self.journal = journal
+        self.tracker = tracker
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._archives = {}
+        self._in_flight = {}
+        self._sequence = itertools.count(1)
+        self._stopped = False
+        self._thread = None
+        self.archives = 0
+        self.files = 0
+        self.bytes = 0
+        self.archive_bytes = 0
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    def start(self) -> None:
+        # Archives still open when the watcher died were never submitted; their files are recovered from the journal
+        for name in os.listdir(self.staging_dir):
+            if name.endswith('.part'):
+                os.remove(os.path.join(self.staging_dir, name))
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="packer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the window timer and submit every open archive."""
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+            archives = list(self._archives.values())
+            self._archives = {}
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+        for archive in archives:
+            self._finish(archive)
+
+    def __call__(self, path: 'str'):
+        try:
+            size = None if os.path.isdir(path) else os.path.getsize(path)
+        except OSError:
+            size = None
+        if size is None or size > self.max_file_size:
+            return self._run_file(path)
+        group = self.group_of(path)
+        while True:
+            with self._lock:
+                if (archive := self._archives.get(group)) is None:
+                    archive = self._archives[group] = self._open(path)
+                    self._wakeup.notify()
+            with archive.lock:
+                if archive.closed:
+                    # Submitted by the window timer meanwhile; start the next archive
+                    continue
+                if path in archive.members:
+                    return None
+                self._add(archive, path)
+                full = len(archive.members) >= self.max_files or archive.bytes >= self.max_bytes
+            break
+        if full:
+            with self._lock:
+                # Unless the window timer took it first
+                if taken := (self._archives.get(group) is archive):
+                    del self._archives[group]
+            if taken:
+                self._finish(archive)
+        return None
+
+    def resubmit(self, paths: 'list'):
+        """Start a new run for the files of a failed run, with their archive if it is still staged."""
+        with self._lock:
+            archive = self._in_flight.get(paths[0])
+        if archive is None or not os.path.exists(archive):
+            if len(paths) == 1 and self.FileRunner is not None:
+                return self.FileRunner(paths[0])
+            archive = self.pack(paths)
+            with self._lock:
+                for path in paths:
+                    self._in_flight[path] = archive
+        return self.ArchiveRunner(archive, paths)
+
+    def finished(self, paths: 'list', status: 'str') -> None:
+        """Remove the archive of a run that is over; assigned to `RunTracker.on_finished`."""
+        with self._lock:
+            archive = self._in_flight.get(paths[0])
+            for path in paths:
+                self._in_flight.pop(path, None)
+        if archive is None:
+            return None
+        if status != 'SUCCEEDED':
+            LOGGER.warning(f"Run of {archive} {status}; the archive is kept in the staging directory")
+            return None
+        try:
+            os.remove(archive)
+        except FileNotFoundError:
+            pass
+
+    def pack(self, paths: 'list') -> 'str':
+        """Write `paths` into a new archive at once and return its path."""
+        archive = self._open(paths[0])
+        try:
+            for path in paths:
+                self._add(archive, path)
+        except OSError:
+            archive.raw.close()
+            os.remove(archive.path + '.part')
+            raise
+        return self._close(archive)
+
+    def stats(self) -> 'dict':
+        with self._lock:
+            open_files = sum(len(a.members) for a in self._archives.values())
+            staged = len(set(self._in_flight.values()))
+        return {'archives': self.archives, 'files': self.files, 'bytes': self.bytes,
+                'archive_bytes': self.archive_bytes, 'open_files': open_files, 'staged_archives': staged,
+                'ratio': round(self.bytes / self.archive_bytes, 2) if self.archive_bytes else None}
+
+    def _run_file(self, path: 'str'):
+        # Outside --pack the dispatcher takes the tracker slot; here the packer holds the tracker
+        if self.FileRunner is None:
+            LOGGER.warning(f"Not packing {path} and no per-file runner is set")
+            return None
+        if self.tracker is not None:
+            self.tracker.acquire()
+        run_id = None
+        try:
+            run_id = self.FileRunner(path)
+        finally:
+            if self.tracker is not None:
+                if run_id is None:
+                    self.tracker.release()
+                else:
+                    self.tracker.track(run_id, [path])
+        return run_id
+
+    def _open(self, path: 'str') -> '_Archive':
+        sequence = next(self._sequence)
+        prefix = os.path.basename(os.path.dirname(path)) or 'root'
+        suffix = '.tar.zst' if self.compression == 'zstd' else '.tar'
+        name = f"{prefix}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{sequence:06d}{suffix}"
+        final = os.path.join(self.staging_dir, name)
+        raw = open(final + '.part', 'wb')
+        stream = raw if self.compression is None else self._compressor.stream_writer(raw, closefd=False)
+        tar = tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT)
+        return _Archive(final, raw, stream, tar)
+
+    def _add(self, archive: '_Archive', path: 'str') -> None:
+        # Small files are read whole, so that a file shrinking meanwhile cannot corrupt the stream
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        name = os.path.basename(path)
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        # A whole-second mtime keeps PAX from adding an extended header per file; the manifest has it exactly
+        info.mtime = int(st.st_mtime)
+        info.mode = st.st_mode & 0o777
+        archive.tar.addfile(info, io.BytesIO(data))
+        archive.members[path] = {'name': name, 'size': len(data), 'mtime': st.st_mtime,
+                                 'sha256': hashlib.sha256(data).hexdigest()}
+        archive.bytes += len(data)
+        SPANS.mark(path, 'packed')
+
+    def _close(self, archive: '_Archive') -> 'str':
+        manifest = json.dumps({'host': socket.gethostname(), 'created': time.time(),
+                               'files': list(archive.members.values())}, indent=1).encode('utf-8')
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(manifest)
+        info.mtime = int(time.time())
+        archive.tar.addfile(info, io.BytesIO(manifest))
+        archive.tar.close()
+        if archive.stream is not archive.raw:
+            archive.stream.close()
+        archive.raw.flush()
+        os.fsync(archive.raw.fileno())
+        size = archive.raw.tell()
+        archive.raw.close()
+        os.replace(archive.path + '.part', archive.path)
+        with self._lock:
+            self.archives += 1
+            self.files += len(archive.members)
+            self.bytes += archive.bytes
+            self.archive_bytes += size
+        ARCHIVE_FILES.observe(len(archive.members))
+        PACKED_BYTES.inc(archive.bytes)
+        ARCHIVE_BYTES.inc(size)
+        LOGGER.info("Packed %d files (%d bytes) into %s (%d bytes)", len(archive.members), archive.bytes,
+                    os.path.basename(archive.path), size)
+        return archive.path
+
+    def _finish(self, archive: '_Archive') -> None:
+        with archive.lock:
+            archive.closed = True
+            paths = list(archive.members)
+            if not paths:
+                archive.tar.close()
+                archive.raw.close()
+                os.remove(archive.path + '.part')
+                return None
+            try:
+                path = self._close(archive)
+            except OSError as e:
+                LOGGER.exception(f"Writing archive {archive.path} failed")
+                self._journal(paths, FAILED, error=f"packing failed: {e}")
+                return None
+        self._submit(path, paths)
+
+    def _submit(self, archive: 'str', paths: 'list') -> None:
+        if self.tracker is not None:
+            self.tracker.acquire()
+        LOGGER.info("Submitting archive of %d files", len(paths))
+        try:
+            run_id = self.ArchiveRunner(archive, paths)
+        except Exception as e:
+            LOGGER.exception(f"Archive runner failed for {archive}")
+            self._journal(paths, FAILED, error=str(e))
+            run_id = None
+        else:
+            if run_id is not None:
+                with self._lock:
+                    for path in paths:
+                        self._in_flight[path] = archive
+                self._journal(paths, SUBMITTED, run_id=run_id)
+                for path in paths:
+                    SPANS.mark(path, 'submitted')
+        if self.tracker is not None:
+            if run_id is None:
+                self.tracker.release()
+            else:
+                self.tracker.track(run_id, paths)
+
+    def _journal(self, paths: 'list', state: 'str', **kwargs) -> None:
+        if self.journal is not None:
+            for path in paths:
+                self.journal.mark(path, state, **kwargs)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                while not self._stopped and not (due := [g for g, a in self._archives.items()
+                                                         if time.monotonic() - a.opened >= self.window]):
+                    timeout = None if not self._archives else max(
+                        0.0, min(a.opened for a in self._archives.values()) + self.window - time.monotonic())
+                    self._wakeup.wait(timeout)
+                if self._stopped:
+                    return None
+                archives = [self._archives.pop(g) for g in due]
+            for archive in archives:
+                self._finish(archive)
@@ -0,0 +1,316 @@
+""" A polling observer for filesystems where inotify sees nothing.
+
+On NFS and Lustre, inotify only reports changes made by the local client, so
+files written by the instrument on another host never raise an event.
+watchdog's PollingObserver snapshots (lists and stats) the whole tree every
+interval, which takes minutes at millions of files.
+
+`PollingObserver` keeps an index of every watched directory: its mtime, its
+subdirectories and, per file, inode, size and mtime (`_Entry`, `__slots__`).
+A directory's mtime changes whenever an entry is added, removed or renamed in
+it, so each cycle stats the directories only and lists just those whose mtime
+moved; of their files, only the ones with a new name or inode (`d_ino`, which
+the listing returns for free) are stat'ed. A cycle costs one stat per
+directory plus work proportional to the files that came and went, instead of
+a stat per file. Stats and listings are spread over a thread pool, since on a
+network filesystem each one is a round trip.
+
+Directory mtimes are often coarse (a second on many servers), so a directory
+changed again within the same tick as its last listing keeps its mtime. A
+changed directory is therefore listed again in following cycles until a
+listing was made `granularity` seconds after its mtime was first seen.
+
+Events are dispatched to the handlers on the observer thread, like watchdog
+emitters do: files created, deleted, replaced (a new inode under an existing
+name: deleted + created) or renamed within a directory (moved), and
+directories created or deleted. A watched directory that vanishes is stat'ed
+every cycle until it reappears, and is then indexed again, its files reported
+as created. Writes to an existing file are not reported;
+the readiness engine follows files until they are complete. The observer
+implements the part of watchdog's observer interface the watcher uses:
+`schedule`, `start`, `stop` and `join`.
+"""
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from watchdog.events import DirCreatedEvent, DirDeletedEvent, FileCreatedEvent, FileDeletedEvent, FileMovedEvent
+
+from metrics import REGISTRY
+from settings import LOGGER
+
+
+POLL_SECONDS = REGISTRY.histogram('watcher_poll_seconds', 'Seconds per polling cycle over every watched tree')
+POLL_DIRECTORIES = REGISTRY.counter(
+    'watcher_poll_directories_total', 'Directories stat\'ed and listed by the polling observer', ('operation',))
+
+# Directories whose mtime is older than this when first listed are trusted, allowing for
+# the clock difference between this host and the file server
+_TRUSTED_AGE = 60.0
+
+
+class _Entry:
+    __slots__ = ('ino', 'size', 'mtime_ns')
+
+    def __init__(self, ino, size, mtime_ns):
+        self.ino = ino
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+
+class _Dir:
+    __slots__ = ('mtime_ns', 'seen_at', 'listed_at', 'files', 'dirs')
+
+    def __init__(self, mtime_ns, listed_at, files, dirs):
+        self.mtime_ns = mtime_ns
+        # When the current mtime was first seen and when the directory was last listed
+        self.seen_at = listed_at
+        self.listed_at = listed_at
+        self.files = files
+        self.dirs = dirs
+
+
+def _list(path: 'str', known: 'dict|None'=None) -> 'tuple|None':
+    """Return (mtime_ns, files, subdirectory names) of a directory, or None if it is gone.
+
+    Files in `known` under the same name and inode keep their entry instead of being stat'ed.
+    """
+    try:
+        # Stat before listing, so that a change made during the listing moves the mtime past the one kept
+        mtime_ns = os.stat(path).st_mtime_ns
+        files = {}
+        dirs = set()
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.add(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        if known is not None and (e := known.get(entry.name)) is not None \
+                                and e.ino == entry.inode():
+                            files[entry.name] = e
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                        files[entry.name] = _Entry(st.st_ino, st.st_size, st.st_mtime_ns)
+                except OSError:
+                    # Removed while listing; the next cycle sees the directory changed again
+                    continue
+    except OSError:
+        return None
+    return mtime_ns, files, dirs
+
+
+def _mtime(path: 'str') -> 'int|None':
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class _Tree:
+    """The index of one scheduled watch."""
+
+    def __init__(self, handler, root: 'str', recursive: bool):
+        self.handler = handler
+        self.root = root
+        self.recursive = recursive
+        self.dirs = {}
+
+
+class PollingObserver:
+    def __init__(self, interval: 'float'=5.0, workers: 'int'=16, granularity: 'float'=1.0):
+        """Poll the scheduled trees every `interval` seconds with `workers` threads.
+
+        `granularity` is the resolution of directory mtimes on the watched
+        filesystem, in seconds.
+        """
+        self.interval = interval
+        self.workers = workers
+        self.granularity = granularity
+        self._trees = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._pool = None
+        self._thread = None
+        self.cycles = 0
+        self.last_cycle_seconds = 0.0
+        self.last_listed = 0
+
+    def schedule(self, event_handler, path: 'str', recursive: bool=False) -> '_Tree':
+        """Index `path` (and below it, when `recursive`) and poll it for changes from now on."""
+        tree = _Tree(event_handler, os.path.abspath(path), recursive)
+        self._index(tree, [tree.root], emit=False)
+        with self._lock:
+            self._trees.append(tree)
+        return tree
+
+    def unschedule_all(self) -> None:
+        with self._lock:
+            self._trees = []
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="polling-observer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def join(self, timeout: 'float|None'=None) -> None:
+        if (t := self._thread) is not None:
+            t.join(timeout)
+        self._thread = None
+        if (pool := self._pool) is not None:
+            self._pool = None
+            pool.shutdown()
+
+    def stats(self) -> 'dict':
+        with self._lock:
+            trees = list(self._trees)
+        return {'trees': len(trees), 'directories': sum(len(t.dirs) for t in trees),
+                'files': sum(len(d.files) for t in trees for d in list(t.dirs.values())),
+                'cycles': self.cycles, 'last_cycle_seconds': self.last_cycle_seconds,
+                'last_listed': self.last_listed}
+
+    def poll(self) -> 'int':
+        """Run one cycle over every tree; return the number of directories listed."""
+        start = time.perf_counter()
+        with self._lock:
+            trees = list(self._trees)
+        listed = sum(self._poll(tree) for tree in trees)
+        self.cycles += 1
+        self.last_cycle_seconds = time.perf_counter() - start
+        self.last_listed = listed
+        POLL_SECONDS.observe(self.last_cycle_seconds)
+        return listed
+
+    def _map(self, fn, items):
+        if len(items) < 2 or self.workers <= 1:
+            return list(map(fn, items))
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="poll")
+        return list(self._pool.map(fn, items, chunksize=max(1, len(items) // (4 * self.workers))))
+
+    def _poll(self, tree: '_Tree') -> 'int':
+        if tree.root not in tree.dirs:
+            # Vanished, or missing when scheduled: stat it every cycle until it is back
+            POLL_DIRECTORIES.labels('stat').inc()
+            if _mtime(tree.root) is None:
+                return 0
+            LOGGER.warning(f"Watched directory reappeared: {tree.root}")
+            return self._index(tree, [tree.root], emit=True)
+        now = time.monotonic()
+        paths = list(tree.dirs)
+        mtimes = self._map(_mtime, paths)
+        POLL_DIRECTORIES.labels('stat').inc(len(paths))
+        changed = []
+        for path, mtime_ns in zip(paths, mtimes):
+            if (d := tree.dirs.get(path)) is None:
+                # Dropped with a deleted parent earlier in this cycle
+                continue
+            if mtime_ns != d.mtime_ns:
+                changed.append(path)
+            elif d.listed_at < d.seen_at + self.granularity:
+                # Listed within the mtime's tick; a later change in the same tick would not show
+                changed.append(path)
+        if not changed:
+            return 0
+        listings = self._map(lambda path: _list(path, tree.dirs[path].files), changed)
+        POLL_DIRECTORIES.labels('list').inc(len(changed))
+        new_dirs = []
+        for path, listing in zip(changed, listings):
+            if (d := tree.dirs.get(path)) is None:
+                continue
+            if listing is None:
+                if path == tree.root:
+                    LOGGER.warning(f"Watched directory vanished, waiting for it to reappear: {path}")
+                self._drop(tree, path, emit=True)
+                continue
+            mtime_ns, files, dirs = listing
+            self._diff(tree, path, d.files, files)
+            for name in dirs - d.dirs:
+                child = os.path.join(path, name)
+                tree.handler.dispatch(DirCreatedEvent(child))
+                if tree.recursive:
+                    new_dirs.append(child)
+            for name in d.dirs - dirs:
+                if (child := os.path.join(path, name)) in tree.dirs:
+                    self._drop(tree, child, emit=True)
+                else:
+                    tree.handler.dispatch(DirDeletedEvent(child))
+            if mtime_ns != d.mtime_ns:
+                d.mtime_ns, d.seen_at = mtime_ns, now
+            d.listed_at, d.files, d.dirs = now, files, dirs
+        if new_dirs:
+            # Files written into a new directory before this cycle are created events too
+            return len(changed) + self._index(tree, new_dirs, emit=True)
+        return len(changed)
+
+    def _diff(self, tree: '_Tree', path: 'str', old: 'dict', new: 'dict') -> None:
+        dispatch = tree.handler.dispatch
+        removed = {name: e for name, e in old.items() if (n := new.get(name)) is None or n.ino != e.ino}
+        # Renames within the directory keep their inode
+        moved_from = {e.ino: name for name, e in removed.items()}
+        for name, e in new.items():
+            if (o := old.get(name)) is not None and o.ino == e.ino:
+                continue
+            if (src := moved_from.pop(e.ino, None)) is not None:
+                removed.pop(src, None)
+                # Whatever the rename replaced is gone without an event of its own, as with inotify
+                removed.pop(name, None)
+                dispatch(FileMovedEvent(os.path.join(path, src), os.path.join(path, name)))
+                continue
+            if o is not None:
+                # A new file under an existing name
+                removed.pop(name, None)
+                dispatch(FileDeletedEvent(os.path.join(path, name)))
+            dispatch(FileCreatedEvent(os.path.join(path, name)))
+        for name in removed:
+            dispatch(FileDeletedEvent(os.path.join(path, name)))
+
+    def _index(self, tree: '_Tree', roots: 'list', emit: bool) -> 'int':
+        """List `roots` and, in a recursive tree, every directory below them, level by level."""
+        listed = 0
+        frontier = roots
+        while frontier:
+            now = time.monotonic()
+            trusted_ns = time.time_ns() - int((_TRUSTED_AGE + self.granularity) * 1e9)
+            listings = self._map(_list, frontier)
+            listed += len(frontier)
+            POLL_DIRECTORIES.labels('list').inc(len(frontier))
+            next_frontier = []
+            for path, listing in zip(frontier, listings):
+                if listing is None:
+                    continue
+                mtime_ns, files, dirs = listing
+                tree.dirs[path] = d = _Dir(mtime_ns, now, files, dirs)
+                if mtime_ns < trusted_ns:
+                    # Long unchanged, so the listing is complete; no need to list it again next cycle
+                    d.seen_at = now - self.granularity
+                if emit:
+                    for name in files:
+                        tree.handler.dispatch(FileCreatedEvent(os.path.join(path, name)))
+                if tree.recursive:
+                    for name in dirs:
+                        child = os.path.join(path, name)
+                        if emit:
+                            tree.handler.dispatch(DirCreatedEvent(child))
+                        next_frontier.append(child)
+            frontier = next_frontier
+        return listed
+
+    def _drop(self, tree: '_Tree', path: 'str', emit: bool) -> None:
+        prefix = path + os.sep
+        for p in [p for p in tree.dirs if p == path or p.startswith(prefix)]:
+            del tree.dirs[p]
+        if emit:
+            tree.handler.dispatch(DirDeletedEvent(path))
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                LOGGER.exception("Polling cycle failed")
@@ -0,0 +1,330 @@
+""" File readiness engines used by the watcher.
+
+A triggering file must not be handed to a flow while its writer still holds
+it open. Each engine keeps a table of pending files and decides, once per
+polling tick, which of them became ready. Every pending file is checked
+against the same tick, so the cost of a check no longer grows with the
+number of pending files.
+
+    procfd      index /proc/*/fd once per tick and release every pending
+                file that no process holds open
+    inotify     release a file on its IN_CLOSE_WRITE event (delivered by the
+                watchdog observer); files that never see a close event, e.g.
+                ones renamed into place or written into a new directory
+                before its watch was added, fall back to the /proc index
+    quiescence  release a file once its size and mtime have not changed for
+                a quiet period; works where /proc and inotify do not
+"""
+import os
+import threading
+import time
+
+from collections import deque
+
+from watchdog.events import EVENT_TYPE_CLOSED, EVENT_TYPE_CREATED
+
+from metrics import REGISTRY
+from settings import LOGGER
+
+
+OPEN_FILE_INDEX_SECONDS = REGISTRY.histogram(
+    'watcher_open_file_index_seconds', 'Seconds spent indexing the files held open on the host')
+READINESS_WAIT_SECONDS = REGISTRY.histogram(
+    'watcher_readiness_wait_seconds', 'Seconds a file waited to be closed by its writer', ('backend',))
+
+
+def open_file_index(candidates: 'set|None'=None) -> 'set':
+    """Return the set of paths held open by any process on the host.
+
+    When `candidates` is given, only those (resolved) paths are collected.
+    On Linux the index is built from the /proc/<pid>/fd symlinks; elsewhere it
+    falls back to psutil.
+    """
+    with OPEN_FILE_INDEX_SECONDS.time():
+        if not os.path.isdir('/proc/self/fd'):
+            return _psutil_open_file_index(candidates)
+        return _proc_open_file_index(candidates)
+
+
+def _proc_open_file_index(candidates: 'set|None'=None) -> 'set':
+    found = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        fd_dir = f"/proc/{pid}/fd"
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # Process exited or belongs to another user
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(f"{fd_dir}/{fd}")
+            except OSError:
+                continue
+            if candidates is None or target in candidates:
+                found.add(target)
+    return found
+
+
+def _psutil_open_file_index(candidates: 'set|None'=None) -> 'set':
+    import psutil
+
+    found = set()
+    for proc in psutil.process_iter():
+        try:
+            for item in proc.open_files():
+                if candidates is None or item.path in candidates:
+                    found.add(item.path)
+        except Exception:
+            pass
+    return found
+
+
+class _Pending:
+    __slots__ = ('path', 'key', 'since', 'callbacks', 'stat')
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.since = time.monotonic()
+        self.callbacks = []
+        self.stat = None
+
+
+class ReadinessEngine:
+    """Base class for readiness engines.
+
+    `when_ready(path, callback)` registers a file; `callback(path, waited)` is
+    called once the file is ready, with the seconds spent waiting, or with
+    `waited=None` if the file disappeared first. `wait(path)` is the blocking
+    equivalent. Subclasses implement `tick(pending)` returning the keys that
+    became ready.
+    """
+    name = None
+
+    def __init__(self, interval: 'float'=1.0):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._stopped = threading.Event()
+        self._thread = None
+        self.wait_times = deque(maxlen=1024)
+        self.completed = 0
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=f"readiness-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+
+    def when_ready(self, path: 'str', callback) -> None:
+        key = os.path.realpath(path)
+        with self._lock:
+            if (entry := self._pending.get(key)) is None:
+                entry = self._pending[key] = _Pending(path, key)
+            entry.callbacks.append(callback)
+        self.registered(entry)
+
+    def cancel(self, path: 'str', callback) -> None:
+        """Unregister a callback given to `when_ready`; the file is forgotten with its last callback."""
+        key = os.path.realpath(path)
+        with self._lock:
+            if (entry := self._pending.get(key)) is None:
+                return None
+            try:
+                entry.callbacks.remove(callback)
+            except ValueError:
+                pass
+            if not entry.callbacks:
+                del self._pending[key]
+
+    def wait(self, path: 'str', timeout: 'float|None'=None) -> 'float|None':
+        """Block until `path` is ready; return the seconds waited or None."""
+        done = threading.Event()
+        result = []
+
+        def release(_, waited):
+            result.append(waited)
+            done.set()
+
+        self.when_ready(path, release)
+        if not done.wait(timeout):
+            self.cancel(path, release)
+            # Released between the timeout and the cancel
+            return result[0] if result else None
+        return result[0]
+
+    def registered(self, entry: '_Pending') -> None:
+        """Hook called after a file is added to the pending table."""
+        pass
+
+    def notify(self, event) -> None:
+        """Hook receiving every watchdog event seen by the Handler."""
+        pass
+
+    def tick(self, pending: 'dict') -> 'set':
+        raise NotImplementedError()
+
+    def stats(self) -> 'dict':
+        with self._lock:
+            pending = len(self._pending)
+        waits = list(self.wait_times)
+        return {
+            'backend': self.name,
+            'pending': pending,
+            'completed': self.completed,
+            'wait_last': waits[-1] if waits else None,
+            'wait_mean': sum(waits) / len(waits) if waits else None,
+            'wait_max': max(waits) if waits else None,
+        }
+
+    def release(self, keys: 'set', vanished: 'set'=frozenset()) -> None:
+        now = time.monotonic()
+        fired = []
+        with self._lock:
+            for key in keys | vanished:
+                if (entry := self._pending.pop(key, None)) is not None:
+                    fired.append((entry, None if key in vanished else now - entry.since))
+
+        waits = READINESS_WAIT_SECONDS.labels(self.name)
+        for entry, waited in fired:
+            if waited is not None:
+                self.wait_times.append(waited)
+                self.completed += 1
+                waits.observe(waited)
+            for callback in entry.callbacks:
+                try:
+                    callback(entry.path, waited)
+                except Exception:
+                    LOGGER.exception(f"Readiness callback failed for {entry.path}")
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                pending = dict(self._pending)
+            if not pending:
+                continue
+            vanished = {k for k, e in pending.items() if not os.path.exists(e.path)}
+            for k in vanished:
+                pending.pop(k)
+            try:
+                ready = self.tick(pending)
+            except Exception:
+                LOGGER.exception("Readiness tick failed")
+                ready = set()
+            self.release(ready, vanished)
+
+
+class ProcFdReadiness(ReadinessEngine):
+    name = 'procfd'
+
+    def tick(self, pending: 'dict') -> 'set':
+        held = open_file_index(set(pending))
+        return set(pending) - held
+
+
+class InotifyReadiness(ProcFdReadiness):
+    name = 'inotify'
+
+    def __init__(self, interval: 'float'=1.0, fallback_after: 'float'=30.0, remember: 'int'=4096):
+        super().__init__(interval=interval)
+        self.fallback_after = fallback_after
+        # Close events that arrived before the file was registered
+        self._closed = {}
+        self._remember = remember
+        # Directories created recently, and pending files in them, whose close
+        # may have happened before the new directory was watched
+        self._new_dirs = {}
+        self._unwatched = set()
+
+    def notify(self, event) -> None:
+        if event.is_directory:
+            if event.event_type == EVENT_TYPE_CREATED:
+                with self._lock:
+                    self._new_dirs[os.path.realpath(event.src_path)] = time.monotonic()
+                    if len(self._new_dirs) > self._remember:
+                        self._new_dirs.pop(next(iter(self._new_dirs)))
+            return
+        if event.event_type != EVENT_TYPE_CLOSED:
+            return
+        key = os.path.realpath(event.src_path)
+        with self._lock:
+            pending = key in self._pending
+            if not pending:
+                self._closed[key] = time.time()
+                if len(self._closed) > self._remember:
+                    self._closed.pop(next(iter(self._closed)))
+        if pending:
+            self.release({key})
+
+    def registered(self, entry: '_Pending') -> None:
+        with self._lock:
+            closed_at = self._closed.pop(entry.key, None)
+            if closed_at is None and (
+                    created := self._new_dirs.get(os.path.dirname(entry.key))) is not None:
+                if time.monotonic() - created < self.fallback_after:
+                    self._unwatched.add(entry.key)
+        if closed_at is None:
+            return
+        try:
+            if os.stat(entry.path).st_mtime <= closed_at:
+                self.release({entry.key})
+        except OSError:
+            self.release(set(), {entry.key})
+
+    def tick(self, pending: 'dict') -> 'set':
+        now = time.monotonic()
+        with self._lock:
+            self._unwatched &= self._pending.keys()
+            unwatched = set(self._unwatched)
+        stale = {k: e for k, e in pending.items() if k in unwatched or now - e.since >= self.fallback_after}
+        if not stale:
+            return set()
+        return super().tick(stale)
+
+
+class QuiescenceReadiness(ReadinessEngine):
+    name = 'quiescence'
+
+    def __init__(self, interval: 'float'=1.0, quiet_period: 'float'=5.0):
+        super().__init__(interval=interval)
+        self.quiet_period = quiet_period
+
+    def tick(self, pending: 'dict') -> 'set':
+        now = time.monotonic()
+        ready = set()
+        for key, entry in pending.items():
+            try:
+                st = os.stat(entry.path)
+            except OSError:
+                continue
+            sig = (st.st_size, st.st_mtime_ns)
+            if entry.stat is None or entry.stat[0] != sig:
+                entry.stat = (sig, now)
+            elif now - entry.stat[1] >= self.quiet_period:
+                ready.add(key)
+        return ready
+
+
+READINESS_BACKENDS = {
+    ProcFdReadiness.name: ProcFdReadiness,
+    InotifyReadiness.name: InotifyReadiness,
+    QuiescenceReadiness.name: QuiescenceReadiness,
+}
+
+
+def make_readiness(backend: 'str|ReadinessEngine'='procfd', **kwargs) -> 'ReadinessEngine':
+    if isinstance(backend, ReadinessEngine):
+        return backend
+    try:
+        return READINESS_BACKENDS[backend](**kwargs)
+    except KeyError:
+        raise ValueError(f"Unknown readiness backend: {backend}")
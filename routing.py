@@ -0,0 +1,187 @@
+""" Route files to flows by the directory they arrive in.
+
+The `routes` list of the flow configuration maps directories to flows:
+
+    routes:
+        - path: /data/instrument_a
+          extensions: [".dat"]
+          flow_id: <flow uuid>
+          destination_base_path: /instrument_a/
+          input:
+              destination:
+                  id: <collection uuid>
+        - path: /data/instrument_b/raw
+          exclude: ["*.tmp"]
+          input:
+              compute_function_id: <function uuid>
+
+`extensions`, `exclude` and `prune` default to the command line options,
+`flow_id`, `label` and `destination_base_path` to those of `flow`, and
+`input` is merged into a copy of `flow.input`. A file belongs to the deepest
+route whose directory contains it and whose rules accept it, falling back to
+routes further up. Route directories are kept in a trie of path components,
+so resolving a file takes one dictionary lookup per directory level,
+however many routes there are.
+"""
+import copy
+import os
+
+from matcher import PathMatcher, plan_watches
+
+
+def merge(base: 'dict', overrides: 'dict') -> 'dict':
+    """Return a deep copy of `base` with `overrides` merged in, recursively for nested dicts."""
+    merged = copy.deepcopy(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+class Route:
+    __slots__ = ('name', 'path', 'matcher', 'flow_id', 'label', 'destination_base_path', 'input')
+
+    def __init__(self, path: 'str', matcher: 'PathMatcher', flow_id: 'str|None', label: 'str|None'=None,
+                 destination_base_path: 'str|None'=None, input: 'dict|None'=None, name: 'str|None'=None):
+        self.path = path
+        self.name = (os.path.basename(path) or path) if name is None else name
+        self.matcher = matcher
+        self.flow_id = flow_id
+        self.label = label
+        self.destination_base_path = destination_base_path
+        self.input = {} if input is None else input
+
+    def __repr__(self):
+        return f"Route({self.name!r}, {self.path!r}, flow_id={self.flow_id!r})"
+
+
+class _Node:
+    __slots__ = ('children', 'route', 'below')
+
+    def __init__(self):
+        self.children = {}
+        self.route = None
+        # Routes at or below this node
+        self.below = 0
+
+
+def _components(path: 'str') -> 'list':
+    return [c for c in path.split(os.sep) if c]
+
+
+class RoutingTable:
+    def __init__(self, routes=()):
+        self._root = _Node()
+        self.routes = []
+        for route in routes:
+            self.add(route)
+
+    @classmethod
+    def from_config(cls, routes: 'list', flow: 'dict', include=(), exclude=(), prune=()) -> 'RoutingTable':
+        """Build the table from the `routes` and `flow` sections of the flow configuration."""
+        table = cls()
+        for spec in routes:
+            path = os.path.abspath(os.path.expanduser(spec['path']))
+            matcher = PathMatcher(include=spec.get('extensions', include), exclude=spec.get('exclude', exclude),
+                                  prune=spec.get('prune', prune), root=path)
+            table.add(Route(
+                path, matcher,
+                flow_id=spec.get('flow_id') or flow['id'],
+                label=spec.get('label', flow.get('label')),
+                destination_base_path=spec.get('destination_base_path', flow.get('destination_base_path')),
+                input=merge(flow['input'], spec.get('input') or {}),
+                name=spec.get('name')))
+        return table
+
+    def add(self, route: 'Route') -> None:
+        node = self._root
+        node.below += 1
+        for c in _components(route.path):
+            node = node.children.setdefault(c, _Node())
+            node.below += 1
+        if node.route is not None:
+            raise ValueError(f"Two routes for {route.path}: {node.route.name} and {route.name}")
+        node.route = route
+        self.routes.append(route)
+
+    def _walk(self, path: 'str') -> 'tuple':
+        """Return the routes whose directory contains `path`, outermost first, and the trie node of `path` if any."""
+        found = []
+        node = self._root
+        if node.route is not None:
+            found.append(node.route)
+        for c in _components(path):
+            if (node := node.children.get(c)) is None:
+                return found, None
+            if node.route is not None:
+                found.append(node.route)
+        return found, node
+
+    def resolve(self, path: 'str', directory: bool=False) -> 'Route|None':
+        """The route of a file at `path`, or None if no route accepts it.
+
+        A `directory`, e.g. a complete dataset, belongs to the deepest route containing it.
+        """
+        found, _ = self._walk(path)
+        if directory:
+            return found[-1] if found else None
+        for route in reversed(found):
+            if route.matcher.matches(path):
+                return route
+        return None
+
+    def matches(self, path: 'str') -> bool:
+        return self.resolve(path) is not None
+
+    def flow_ids(self) -> 'list':
+        return list(dict.fromkeys(r.flow_id for r in self.routes))
+
+    def roots(self) -> 'list':
+        """Route directories not inside another route's directory; watching these covers every route."""
+        roots = []
+        # Sorted by components, so that a directory's descendants follow it before any sibling sharing its
+        # prefix: /data/a, /data/a/x, /data/a-b rather than /data/a, /data/a-b, /data/a/x
+        for path in sorted({r.path for r in self.routes}, key=lambda p: p.rstrip(os.sep).split(os.sep)):
+            if not roots or not (path + os.sep).startswith(roots[-1].rstrip(os.sep) + os.sep):
+                roots.append(path)
+        return roots
+
+    def prunes(self, directory: 'str') -> bool:
+        """True when no route needs the subtree at `directory` watched or scanned."""
+        found, node = self._walk(directory)
+        if node is not None and node.below:
+            # A route lives at or below this directory
+            return False
+        if not found:
+            return True
+        return found[-1].matcher.prunes(directory)
+
+    def plan_watches(self, root: 'str') -> 'list':
+        if not any(r.matcher.prune for r in self.routes):
+            return [(os.path.abspath(root), True)]
+        return plan_watches(os.path.abspath(root), self.prunes)
+
+
+class RouteRunner:
+    """A flow runner that hands each file to the runner of its route, e.g. one Batcher per route,
+    so that a batch never mixes files bound for different flows."""
+
+    def __init__(self, routes: 'RoutingTable', runners: 'dict', tracker=None):
+        self.routes = routes
+        self.runners = runners
+        self.tracker = tracker
+
+    def __call__(self, path: 'str'):
+        if (route := self.routes.resolve(path, directory=os.path.isdir(path))) is None:
+            return None
+        return self.runners[route](path)
+
+    def start(self) -> None:
+        for runner in self.runners.values():
+            runner.start()
+
+    def stop(self) -> None:
+        for runner in self.runners.values():
+            runner.stop()
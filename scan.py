@@ -0,0 +1,113 @@
+""" Streaming, parallel scan of a directory tree.
+
+Used at startup to find files that arrived while the watcher was not running.
+Directories are listed with `os.scandir` by a pool of threads; matching files
+are streamed to the caller through a bounded queue, so memory use does not
+grow with the size of the tree. Only files accepted by `match` are stat'ed.
+"""
+import os
+import queue
+import threading
+import time
+
+from settings import LOGGER
+
+
+_DONE = object()
+
+
+class TreeScanner:
+    def __init__(self, root: 'str', match=None, prune=None, workers: 'int'=8, buffer: 'int'=10000):
+        self.root = root
+        self.match = match
+        self.prune = prune
+        self.workers = workers
+        self.buffer = buffer
+        self.directories = 0
+        self.files = 0
+        self.matched = 0
+        self.elapsed = 0.0
+
+    @property
+    def rate(self) -> 'float':
+        """Files scanned per second."""
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    def __iter__(self):
+        """Yield (path, inode, size, mtime_ns) for every matching file."""
+        dirs = queue.Queue()
+        out = queue.Queue(maxsize=self.buffer)
+        lock = threading.Lock()
+        stopped = threading.Event()
+        outstanding = [1]
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def work():
+            while (directory := dirs.get()) is not None:
+                files = matched = 0
+                subdirs = []
+                try:
+                    with os.scandir(directory) as it:
+                        for entry in it:
+                            if entry.is_dir(follow_symlinks=False):
+                                if self.prune is None or not self.prune(entry.path):
+                                    subdirs.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False):
+                                files += 1
+                                if self.match is not None and not self.match(entry.path):
+                                    continue
+                                try:
+                                    st = entry.stat(follow_symlinks=False)
+                                except OSError:
+                                    continue
+                                matched += 1
+                                if not put((entry.path, st.st_ino, st.st_size, st.st_mtime_ns)):
+                                    break
+                except OSError as e:
+                    LOGGER.debug(f"Cannot scan {directory}: {e}")
+                with lock:
+                    self.directories += 1
+                    self.files += files
+                    self.matched += matched
+                    outstanding[0] += len(subdirs) - 1
+                    done = outstanding[0] == 0
+                for d in subdirs:
+                    dirs.put(d)
+                if done:
+                    put(_DONE)
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=work, name=f"scan-{i}", daemon=True) for i in range(self.workers)]
+        for t in threads:
+            t.start()
+        dirs.put(self.root)
+        try:
+            while (item := out.get()) is not _DONE:
+                yield item
+        finally:
+            stopped.set()
+            for _ in threads:
+                dirs.put(None)
+            self.elapsed = time.monotonic() - start
+
+
+def catch_up(root: 'str', match, journal, submit, prune=None, workers: 'int'=8) -> 'TreeScanner':
+    """Submit every matching file under `root` that the journal does not know yet."""
+    scanner = TreeScanner(root, match=match, prune=prune, workers=workers)
+    submitted = 0
+    for path, inode, size, mtime_ns in scanner:
+        if journal.is_current(path, inode, size, mtime_ns):
+            continue
+        if submit(path):
+            submitted += 1
+    LOGGER.info(f"Catch-up scan of {root}: {scanner.files} files in {scanner.directories} directories, "
+                f"{scanner.matched} matched, {submitted} new, {scanner.rate:.0f} files/sec")
+    return scanner
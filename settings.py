@@ -1,27 +1,33 @@
 #! /usr/bin/env python
+""" Flow and logging configuration, loaded on first use.
+
+Importing this module has no side effects. The configuration directory, the
+default `.logging.yaml` and the rendered `.flow.yaml` are created, parsed and
+overridden from the environment (`ENV_OVERRIDES`) the first time
+`get_config()`, `GLOBUS_CONFIG` or `LOGGING_CONFIG` is used, and logging is
+configured the first time `LOGGER` logs. The parsed files are cached as JSON
+in `.settings.cache.json`, keyed on their modification times and sizes, so
+later processes need neither the YAML parser nor Jinja2. Set
+`GLOBUS_SETTINGS_CACHE=0` to bypass the cache.
+"""
 import argparse
+import json
 import os
 import sys
-import yaml
-
-import json
-import logging
-import logging.config
-import structlog
+import threading
 
 from shutil import copy as cp
 from pathlib import Path
 
 
-from jinja2 import Environment, FileSystemLoader
-
-
 DEFAULT_CONIFG_DIR = Path(os.path.expanduser("~/.config"))
 GLOBUS_CONFIG_DIR = DEFAULT_CONIFG_DIR.joinpath('globus')
 MYFLOW_CONFIG_DIR = GLOBUS_CONFIG_DIR.joinpath('flow')
 
 MYFLOW_CONFIG_FILE = MYFLOW_CONFIG_DIR.joinpath('.flow.yaml')
 LOGGING_CONFIG_FILE = MYFLOW_CONFIG_DIR.joinpath('.logging.yaml')
+CONFIG_CACHE_FILE = MYFLOW_CONFIG_DIR.joinpath('.settings.cache.json')
+CONFIG_CACHE_VAR = 'GLOBUS_SETTINGS_CACHE'
 
 
 __CONFIGS__ = {
@@ -40,7 +46,49 @@ __CONFIGS__ = {
 }
 
 
+def log_level(setting: 'str') -> 'str':
+    setting = setting.upper()
+    return setting if setting in ['INFO', 'DEBUG', 'WARNING', 'ERROR', 'CRITICAL'] else 'INFO'
+
+
+# Environment variable, configuration ('globus' or 'logging'), keys of the value, conversion
+ENV_OVERRIDES = (
+    # Logging level
+    ('LOGLEVEL', 'logging', ('root', 'level'), log_level),
+    # Globus
+    ('GLOBUS_CLIENT_NAME', 'globus', ('native_app', 'name'), None),
+    ('GLOBUS_SUBSCRIPTION_ID', 'globus', ('subscription', 'id'), None),
+    ('GLOBUS_CLIENT_ID', 'globus', ('native_app', 'id'), None),
+    ('GLOBUS_DEFAULT_TOKEN_STORE', 'globus', ('token_store',), None),
+    # Globus Flow Settings
+    ('GLOBUS_FLOW_ID', 'globus', ('flow', 'id'), None),
+    # Globus transfer_files action input values
+    ('GLOBUS_LOCAL_ID', 'globus', ('flow', 'input', 'source', 'id'), None),
+    ('GLOBUS_SRC_BASEPATH', 'globus', ('flow', 'input', 'source', 'path'), None),
+    ('GLOBUS_REMOTE_ID', 'globus', ('flow', 'input', 'destination', 'id'), None),
+    ('GLOBUS_DST_BASEPATH', 'globus', ('flow', 'destination_base_path'), None),
+    # Globus compute action input values
+    ('GLOBUS_COMPUTE_ENDPOINT', 'globus', ('flow', 'input', 'compute_endpoint_id'), None),
+    ('GLOBUS_COMPUTE_FUNCID', 'globus', ('flow', 'input', 'compute_function_id'), None),
+    ('GLOBUS_COMPUTE_KWARGS', 'globus', ('flow', 'input', 'compute_function_kwargs'), None),
+)
+
+
+def apply_overrides(configs: 'dict', environ: 'dict|None'=None) -> None:
+    """ Set the values named in ENV_OVERRIDES from the environment, in place. """
+    environ = os.environ if environ is None else environ
+    for var, name, keys, convert in ENV_OVERRIDES:
+        if (setting := environ.get(var)) is None:
+            continue
+        node = configs[name]
+        for key in keys[:-1]:
+            node = node[key]
+        node[keys[-1]] = setting if convert is None else convert(setting)
+
+
 def export(config_file: 'str|Path'=None, template_file: 'str'=None, configs: 'dict'=None) -> None:
+    from jinja2 import Environment, FileSystemLoader
+
     # Default Values
     config_file = config_file if config_file is not None else MYFLOW_CONFIG_FILE
     template_file = template_file if template_file is not None else 'conf/flow.yaml.j2'
@@ -55,90 +103,130 @@ def export(config_file: 'str|Path'=None, template_file: 'str'=None, configs: 'di
     return
 
 
-for p in [GLOBUS_CONFIG_DIR, MYFLOW_CONFIG_DIR]:
-    if not p.exists():
-        os.makedirs(p)
-
-
-if not (f := LOGGING_CONFIG_FILE).exists():
-    cp(Path('conf/logging.yaml'), f)
-
-
-if not (f := MYFLOW_CONFIG_FILE).exists():
-    # Render flow configuration file with values from the environment or set them to None
-    # Users may edit the resulting config file
-    export()
-
-
-LOGGING_CONFIG = {}
-with open(LOGGING_CONFIG_FILE, 'r') as stream:
-    LOGGING_CONFIG = yaml.safe_load(stream)
-
-GLOBUS_CONFIG = {}
-with open(MYFLOW_CONFIG_FILE, 'r') as stream:
-    GLOBUS_CONFIG = yaml.safe_load(stream)
-
-# Override with values from environment
-
-# Logging level
-if (setting := os.getenv('LOGLEVEL')) is not None:
-    setting = setting.upper()
-    setting = setting if setting in ['INFO', 'DEBUG', 'WARNING', 'ERROR', 'CRITICAL'] else 'INFO'
-    LOGGING_CONFIG['root']['level'] = setting
-
-# Globus
-if (setting := os.getenv('GLOBUS_CLIENT_NAME')) is not None:
-    GLOBUS_CONFIG['native_app']['name'] = setting
-
-if (setting := os.getenv('GLOBUS_SUBSCRIPTION_ID')) is not None:
-    GLOBUS_CONFIG['subscription']['id'] = setting
-
-if (setting := os.getenv('GLOBUS_CLIENT_ID')) is not None:
-    GLOBUS_CONFIG['native_app']['id'] = setting
-
-if (setting := os.getenv('GLOBUS_DEFAULT_TOKEN_STORE')) is not None:
-    GLOBUS_CONFIG['token_store'] = setting
-
-# Globus Flow Settings
-if (setting := os.getenv('GLOBUS_FLOW_ID')) is not None:
-    GLOBUS_CONFIG['flow']['id'] = setting
-
-# Globus Flow tasks
-
-# Globus transfer_files action input values
-if (setting := os.getenv('GLOBUS_LOCAL_ID')) is not None:
-    GLOBUS_CONFIG['flow']['input']['source']['id'] = setting
-
-if (setting := os.getenv('GLOBUS_SRC_BASEPATH')) is not None:
-    GLOBUS_CONFIG['flow']['input']['source']['path'] = setting
-
-if (setting := os.getenv('GLOBUS_REMOTE_ID')) is not None:
-    GLOBUS_CONFIG['flow']['input']['destination']['id'] = setting
-
-if (setting := os.getenv('GLOBUS_DST_BASEPATH')) is not None:
-    GLOBUS_CONFIG['flow']['destination_base_path'] = setting
-
-# Globus compute action input values
-if (setting := os.getenv('GLOBUS_COMPUTE_ENDPOINT')) is not None:
-    GLOBUS_CONFIG['flow']['input']['compute_endpoint_id'] = setting
-
-if (setting := os.getenv('GLOBUS_COMPUTE_FUNCID')) is not None:
-    GLOBUS_CONFIG['flow']['input']['compute_function_id'] = setting
-
-if (setting := os.getenv('GLOBUS_COMPUTE_KWARGS')) is not None:
-    GLOBUS_CONFIG['flow']['input']['compute_function_kwargs'] = setting
-    
-# Initilialize logger
-
-# Expand any ~ components in path
-if not (logfile := Path(LOGGING_CONFIG['handlers']['file']['filename']).expanduser()).parent.exists():
-    logfile.parent.mkdir(parents=True)
-LOGGING_CONFIG['handlers']['file']['filename'] = str(Path(logfile))
-
-logging.config.dictConfig(LOGGING_CONFIG)
-
-structlog.configure(
-    processors=[
+class Config:
+    """ The flow (`globus`) and logging configurations, with the environment overrides applied. """
+    __slots__ = ('globus', 'logging')
+
+    def __init__(self, globus: 'dict', logging: 'dict'):
+        self.globus = globus
+        self.logging = logging
+
+    @property
+    def subscription_id(self) -> 'str|None':
+        return self.globus['subscription']['id']
+
+    @property
+    def client_id(self) -> 'str|None':
+        return self.globus['native_app']['id']
+
+    @property
+    def token_store(self) -> 'str|None':
+        return self.globus['token_store']
+
+    @property
+    def flow_id(self) -> 'str|None':
+        return self.globus['flow']['id']
+
+    @property
+    def flow(self) -> 'dict':
+        return self.globus['flow']
+
+    @property
+    def routes(self) -> 'list':
+        return self.globus.get('routes') or []
+
+
+def create_config_files() -> None:
+    for p in [GLOBUS_CONFIG_DIR, MYFLOW_CONFIG_DIR]:
+        if not p.exists():
+            os.makedirs(p, exist_ok=True)
+
+    if not (f := LOGGING_CONFIG_FILE).exists():
+        cp(Path('conf/logging.yaml'), f)
+
+    if not (f := MYFLOW_CONFIG_FILE).exists():
+        # Render flow configuration file with values from the environment or set them to None
+        # Users may edit the resulting config file
+        export()
+
+
+def load_config_files(cache: 'bool'=True) -> 'tuple[dict, dict]':
+    """ Parse the flow and logging configuration files, or read them from the cache if neither changed. """
+    sources = [MYFLOW_CONFIG_FILE, LOGGING_CONFIG_FILE]
+    key = [[str(p), (s := os.stat(p)).st_mtime_ns, s.st_size] for p in sources]
+    if cache:
+        try:
+            with open(CONFIG_CACHE_FILE, 'r', encoding='utf-8') as stream:
+                if (cached := json.load(stream))['key'] == key:
+                    return cached['globus'], cached['logging']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    import yaml
+    with open(MYFLOW_CONFIG_FILE, 'r') as stream:
+        globus = yaml.safe_load(stream)
+    with open(LOGGING_CONFIG_FILE, 'r') as stream:
+        logging = yaml.safe_load(stream)
+
+    if cache:
+        # Renamed into place, so that a concurrent reader never sees half a cache
+        tmp = f"{CONFIG_CACHE_FILE}.{os.getpid()}"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as stream:
+                json.dump({'key': key, 'globus': globus, 'logging': logging}, stream)
+            os.replace(tmp, CONFIG_CACHE_FILE)
+        except (OSError, TypeError, ValueError):
+            # e.g. YAML dates, which JSON cannot hold; parse the files every time
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+    return globus, logging
+
+
+_CONFIG = None
+_LOCK = threading.RLock()
+
+
+def get_config() -> 'Config':
+    """ The configuration, loaded on the first call. """
+    global _CONFIG
+    if (config := _CONFIG) is None:
+        with _LOCK:
+            if (config := _CONFIG) is None:
+                create_config_files()
+                globus, logging = load_config_files(cache=os.getenv(CONFIG_CACHE_VAR, '1') != '0')
+                apply_overrides({'globus': globus, 'logging': logging})
+                config = _CONFIG = Config(globus, logging)
+    return config
+
+
+def __getattr__(name):
+    if name == 'GLOBUS_CONFIG':
+        return get_config().globus
+    if name == 'LOGGING_CONFIG':
+        return get_config().logging
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def configure_logging(config: 'dict') -> None:
+    """ Configure stdlib logging from `config` and the structlog processor chain in front of it.
+
+    With `queue: {enabled: true}` the handlers write from a background thread
+    (see logqueue.py), and %-style arguments are handed to the stdlib record
+    unformatted so that the message, too, is built on that thread.
+    """
+    import logging.config
+    import structlog
+
+    # Expand any ~ components in path
+    if (handler := config.get('handlers', {}).get('file')) is not None:
+        if not (logfile := Path(handler['filename']).expanduser()).parent.exists():
+            logfile.parent.mkdir(parents=True)
+        handler['filename'] = str(logfile)
+
+    options = config.get('queue') or {}
+    logging.config.dictConfig({k: v for k, v in config.items() if k != 'queue'})
+
+    processors = [
         structlog.stdlib.filter_by_level,
         structlog.stdlib.add_logger_name,
         structlog.stdlib.add_log_level,
@@ -149,14 +237,43 @@ structlog.configure(
         #YYYY-MM-DD'T'HH:mm:ssZ
         structlog.processors.TimeStamper(fmt="%Y-%m-%dT%H:%M:%SZ"),
         structlog.stdlib.render_to_log_kwargs
-    ],
-    context_class=dict,
-    logger_factory=structlog.stdlib.LoggerFactory(),
-    wrapper_class=structlog.stdlib.BoundLogger,
-    cache_logger_on_first_use=True,
-)
-
-LOGGER = structlog.get_logger()
+    ]
+    if options.get('enabled', False):
+        import logqueue
+        logqueue.install(sample=options.get('sample', 1), maxsize=options.get('maxsize', 100000))
+        # structlog < 25.1 has no render_to_log_args_and_kwargs and formats the arguments itself
+        if (render := getattr(structlog.stdlib, 'render_to_log_args_and_kwargs', None)) is not None:
+            processors = [p for p in processors if not isinstance(p, structlog.stdlib.PositionalArgumentsFormatter)]
+            processors[-1] = render
+
+    structlog.configure(
+        processors=processors,
+        context_class=dict,
+        # Name loggers after the module that logs first, not after the LOGGER proxy below
+        logger_factory=structlog.stdlib.LoggerFactory(ignore_frame_names=[__name__]),
+        wrapper_class=structlog.stdlib.BoundLogger,
+        cache_logger_on_first_use=True,
+    )
+
+
+class _Logger:
+    """ Configures logging the first time it is used, then passes everything to the structlog logger. """
+    __slots__ = ('_logger',)
+
+    def __init__(self):
+        self._logger = None
+
+    def __getattr__(self, name):
+        if (logger := self._logger) is None:
+            with _LOCK:
+                if (logger := self._logger) is None:
+                    import structlog
+                    configure_logging(get_config().logging)
+                    logger = self._logger = structlog.get_logger()
+        return getattr(logger, name)
+
+
+LOGGER = _Logger()
 
 def main():
     parser = argparse.ArgumentParser()
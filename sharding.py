@@ -0,0 +1,272 @@
+""" Split the watch tree between several watcher nodes with renewable leases.
+
+Every file belongs to one of `count` shards, by the hash of its top-level
+directory under the watch root (`by='top'`, keeps a directory on one node)
+or of its whole relative path (`by='hash'`, spreads a single busy directory).
+Nodes hold shards through leases in a SQLite database on storage they all
+share (rollback journal, not WAL, which needs shared memory on one host):
+
+    nodes (node, expires)                  heartbeats, to count live nodes
+    shards (shard, owner, expires, epoch)  one lease per shard
+
+Every `interval` seconds a node, in one BEGIN IMMEDIATE transaction, renews
+its heartbeat and leases, gives up the leases above its fair share
+(ceil(count / live nodes)) and claims free or expired ones up to it. A
+released lease stays unclaimable for `grace` seconds so that files the old
+owner is submitting get through first; the lease of a node that died expires
+after `ttl` seconds and a survivor takes it over. A node stops treating a
+shard as its own `skew` seconds before its lease runs out, measured on its
+own monotonic clock, so two nodes never both hold a shard while their clocks
+agree within `skew`.
+
+The watcher drops events of shards it does not hold (`OwnedMatcher`) and
+checks the lease again just before starting a flow (`Fenced`). With a journal
+shared by the nodes, a node taking over a shard recovers its pending files,
+adopts its runs in flight and scans it for files that arrived in between.
+"""
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+
+from metrics import REGISTRY
+from settings import LOGGER
+
+
+SHARD_CHANGES = REGISTRY.counter(
+    'watcher_shard_changes_total', 'Shard leases acquired, released to other nodes or lost by expiry', ('change',))
+FENCED = REGISTRY.counter(
+    'watcher_fenced_files_total', 'Ready files left to another node because their shard lease was no longer held')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    node TEXT PRIMARY KEY,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shards (
+    shard INTEGER PRIMARY KEY,
+    owner TEXT,
+    expires REAL NOT NULL,
+    epoch INTEGER NOT NULL
+);
+"""
+
+
+def default_node() -> 'str':
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Shards:
+    def __init__(self, db_path: 'str', roots, count: 'int'=16, by: 'str'='top', node: 'str|None'=None,
+                 ttl: 'float'=30.0, interval: 'float|None'=None, grace: 'float|None'=None, skew: 'float|None'=None):
+        """Leases on `count` shards of the files under `roots`, kept in the SQLite database `db_path`.
+
+        Leases last `ttl` seconds and are renewed every `interval` seconds
+        (default ttl/3); `skew` (default 2s, at most ttl/10) is the clock
+        difference between nodes the leases tolerate. `on_change(acquired, lost)` is called, on the lease
+        thread, with the sets of shards gained and given up at each renewal.
+        """
+        if by not in ('top', 'hash'):
+            raise ValueError(f"Unknown shard key {by!r}, expected 'top' or 'hash'")
+        self.db_path = os.path.abspath(os.path.expanduser(db_path))
+        # Deepest first, so that a file is keyed relative to the closest root
+        self.roots = sorted((os.path.abspath(r).rstrip(os.sep) + os.sep for r in roots), key=len, reverse=True)
+        self.count = count
+        self.by = by
+        self.node = default_node() if node is None else node
+        self.ttl = ttl
+        self.interval = ttl / 3 if interval is None else interval
+        self.grace = self.interval if grace is None else grace
+        self.skew = min(2.0, ttl / 10) if skew is None else skew
+        if self.interval + self.skew >= self.ttl:
+            raise ValueError(f"Lease ttl {ttl}s leaves no time to renew every {self.interval}s with {self.skew}s skew")
+        self.on_change = None
+        self._owned = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.renewals = 0
+        self.failures = 0
+
+        if not os.path.isdir(d := os.path.dirname(self.db_path)):
+            os.makedirs(d)
+        # Transactions are begun explicitly, see _renew()
+        self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.executescript(_SCHEMA)
+        self._conn.executemany('INSERT OR IGNORE INTO shards (shard, owner, expires, epoch) VALUES (?, NULL, 0, 0)',
+                               [(k,) for k in range(count)])
+        if (n := self._conn.execute('SELECT COUNT(*) FROM shards').fetchone()[0]) != count:
+            raise ValueError(f"{self.db_path} holds {n} shards, not {count}; every node needs the same --shards")
+
+    def key(self, path: 'str') -> 'str':
+        for root in self.roots:
+            if path.startswith(root):
+                rel = path[len(root):]
+                return rel if self.by == 'hash' else rel.partition(os.sep)[0]
+        return path
+
+    def shard(self, path: 'str') -> 'int':
+        return zlib.crc32(self.key(path).encode('utf-8', 'surrogateescape')) % self.count
+
+    def directory_shard(self, directory: 'str') -> 'int|None':
+        """The shard of every file below `directory`, if they all share one."""
+        if self.by == 'hash':
+            return None
+        for root in self.roots:
+            if (directory + os.sep).startswith(root) and len(directory) >= len(root):
+                return self.shard(directory)
+        return None
+
+    def owned(self) -> 'set':
+        """Shards whose lease this node holds now."""
+        now = time.monotonic()
+        with self._lock:
+            return {k for k, valid_until in self._owned.items() if valid_until > now}
+
+    def owns(self, path: 'str') -> bool:
+        with self._lock:
+            valid_until = self._owned.get(self.shard(path))
+        return valid_until is not None and valid_until > time.monotonic()
+
+    def start(self) -> 'Shards':
+        """Claim a first share of the leases, then keep renewing them on a background thread."""
+        self._stopped.clear()
+        self.renew()
+        self._thread = threading.Thread(target=self._run, name="shard-leases", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop renewing and hand every lease back, so that other nodes take the shards over at once."""
+        self._stopped.set()
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+        with self._lock:
+            released = set(self._owned)
+            self._owned.clear()
+        try:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.execute('UPDATE shards SET owner = NULL, expires = 0 WHERE owner = ?', (self.node,))
+            self._conn.execute('DELETE FROM nodes WHERE node = ?', (self.node,))
+            self._conn.execute('COMMIT')
+        except sqlite3.Error:
+            LOGGER.exception("Releasing shard leases failed; they expire by themselves")
+        if released:
+            SHARD_CHANGES.labels('released').inc(len(released))
+            LOGGER.info(f"Released {len(released)} shards")
+        self._conn.close()
+
+    def renew(self) -> 'tuple':
+        """Renew, rebalance and claim leases once; return the sets of shards acquired and lost."""
+        started = time.monotonic()
+        with self._lock:
+            previous = set(self._owned)
+        try:
+            held, released = self._renew(time.time())
+        except sqlite3.Error as e:
+            # Keep the leases we have until they run out; another node may take them over then
+            self.failures += 1
+            LOGGER.warning(f"Renewing shard leases failed: {e}")
+            held, released = self.owned(), set()
+            with self._lock:
+                self._owned = {k: v for k, v in self._owned.items() if k in held}
+        else:
+            self.renewals += 1
+            with self._lock:
+                self._owned = dict.fromkeys(held, started + self.ttl - self.skew)
+        acquired, lost = held - previous, previous - held
+        if acquired:
+            SHARD_CHANGES.labels('acquired').inc(len(acquired))
+        if released:
+            SHARD_CHANGES.labels('released').inc(len(released))
+        if expired := lost - released:
+            SHARD_CHANGES.labels('lost').inc(len(expired))
+            LOGGER.warning(f"Shard leases expired before they were renewed: {sorted(expired)}")
+        if acquired or lost:
+            LOGGER.info(f"Holding {len(held)} of {self.count} shards: +{sorted(acquired)} -{sorted(lost)}")
+            if self.on_change is not None:
+                self.on_change(acquired, lost)
+        return acquired, lost
+
+    def _renew(self, now: 'float') -> 'tuple':
+        conn = self._conn
+        # BEGIN IMMEDIATE takes the write lock up front; other nodes wait for it up to the timeout
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT INTO nodes (node, expires) VALUES (?, ?) '
+                         'ON CONFLICT (node) DO UPDATE SET expires = excluded.expires', (self.node, now + self.ttl))
+            conn.execute('DELETE FROM nodes WHERE expires < ?', (now - self.ttl,))
+            live = conn.execute('SELECT COUNT(*) FROM nodes WHERE expires >= ?', (now,)).fetchone()[0]
+            share = math.ceil(self.count / max(live, 1))
+            mine = [k for (k,) in conn.execute('SELECT shard FROM shards WHERE owner = ? ORDER BY shard', (self.node,))]
+            keep, extra = mine[:share], mine[share:]
+            conn.executemany('UPDATE shards SET expires = ? WHERE shard = ?', [(now + self.ttl, k) for k in keep])
+            # Nobody may claim a released shard before the files we are submitting from it got through
+            conn.executemany('UPDATE shards SET owner = NULL, expires = ? WHERE shard = ?',
+                             [(now + self.grace, k) for k in extra])
+            claimed = []
+            if len(keep) < share:
+                claimed = [k for (k,) in conn.execute(
+                    'SELECT shard FROM shards WHERE expires + ? < ? ORDER BY owner IS NOT NULL, shard LIMIT ?',
+                    (self.skew, now, share - len(keep)))]
+                conn.executemany('UPDATE shards SET owner = ?, expires = ?, epoch = epoch + 1 WHERE shard = ?',
+                                 [(self.node, now + self.ttl, k) for k in claimed])
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return set(keep) | set(claimed), set(extra)
+
+    def stats(self) -> 'dict':
+        return {'node': self.node, 'owned': len(self.owned()), 'shards': self.count,
+                'renewals': self.renewals, 'failures': self.failures}
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.renew()
+
+
+class OwnedMatcher:
+    """Accepts the files `matcher` accepts in shards this node holds; pruning is left to `matcher`."""
+
+    def __init__(self, matcher, shards: 'Shards'):
+        self.matcher = matcher
+        self.shards = shards
+
+    def matches(self, path: 'str') -> bool:
+        return self.shards.owns(path) and self.matcher.matches(path)
+
+    def prunes(self, directory: 'str') -> bool:
+        return self.matcher.prunes(directory)
+
+    def plan_watches(self, root: 'str') -> 'list':
+        # Watches cover every shard, so that a shard taken over needs no new ones
+        return self.matcher.plan_watches(root)
+
+
+class Fenced:
+    """A flow runner that starts flows only for files in shards this node still holds.
+
+    A file left behind stays `ready` in the journal and is recovered by the
+    node that took its shard over.
+    """
+
+    def __init__(self, runner, shards: 'Shards'):
+        self.runner = runner
+        self.shards = shards
+        self.tracker = getattr(runner, 'tracker', None)
+        for hook in ('prefetch', 'prepare'):
+            if (fn := getattr(runner, hook, None)) is not None:
+                setattr(self, hook, fn)
+
+    def __call__(self, path: 'str'):
+        if not self.shards.owns(path):
+            FENCED.inc()
+            LOGGER.warning("Shard %d of %s is no longer held here, leaving the file to its new owner",
+                           self.shards.shard(path), path)
+            return None
+        return self.runner(path)
@@ -1,62 +1,44 @@
 #!/usr/bin/env python
 
 import argparse
+import copy
 import globus_sdk
+import json
 import os
+import posixpath
+import uuid
 
 # This could go into a different file and be invoked without the file watcher
-from globus_sdk.tokenstorage import SimpleJSONFileAdapter
+from auth import TokenManager, get_authorizer, share_session
+from batching import Batcher
+from checksum import Deduplicator, DigestIndex, Hasher
+from datasets import DEFAULT_SENTINELS, DatasetTrigger
+from governor import GOVERNOR, TRANSPORT_PARAMS
+from journal import Journal
+from metrics import SPANS, MetricsServer, SnapshotWriter
+from mock_globus import use_mock
+from packing import Packer
+from routing import RouteRunner, RoutingTable
+from sharding import Shards
+from tracker import RunTracker
 from watch import FileTrigger, translate_local_path_to_globus_path
 
-from settings import LOGGER, GLOBUS_CONFIG
+from settings import LOGGER, MYFLOW_CONFIG_DIR, get_config
 
 
-SUBSCRIPTION_ID = GLOBUS_CONFIG['subscription']['id']
-NATIVE_APP_CLIENT_ID = GLOBUS_CONFIG['native_app']['id']
-DEFAULT_TOKEN_STORE=GLOBUS_CONFIG['token_store']
+CONFIG = get_config()
+SUBSCRIPTION_ID = CONFIG.subscription_id
+NATIVE_APP_CLIENT_ID = CONFIG.client_id
+DEFAULT_TOKEN_STORE = CONFIG.token_store
 
-FLOW_ID = GLOBUS_CONFIG['flow']['id']
+FLOW_ID = CONFIG.flow_id
 RESOURCE_SERVER = globus_sdk.FlowsClient.resource_server
 
 
-def do_login_flow(native_client, scopes):
-    native_client.oauth2_start_flow(requested_scopes=scopes, refresh_tokens=True)
-    authorize_url = native_client.oauth2_get_authorize_url()
-    print(f"Please go to this URL and login:\n\n{authorize_url}\n")
-    auth_code = input("Please enter the code here: ").strip()
-    tokens = native_client.oauth2_exchange_code_for_tokens(auth_code)
-    return tokens
-
-
-def get_authorizer(native_client, resource_server, scopes, file_adapter):
-    # try to load the tokens from the file, possibly returning None
-    if file_adapter.file_exists():
-        tokens = file_adapter.get_token_data(resource_server)
-    else:
-        tokens = None
-
-    if tokens is None:
-        # do a login flow, getting back initial tokens
-        response = do_login_flow(native_client=native_client, scopes=scopes)
-        # now store the tokens and pull out the correct token
-        file_adapter.store(response)
-        tokens = response.by_resource_server[resource_server]
-
-    return globus_sdk.RefreshTokenAuthorizer(
-        tokens["refresh_token"],
-        native_client,
-        access_token=tokens["access_token"],
-        expires_at=tokens["expires_at_seconds"],
-        on_refresh=file_adapter.on_refresh,
-    )
-
-
-def run_flow(event_file):
-    flow_label = f"Trigger transfer: {os.path.basename(event_file)}" if (l := GLOBUS_CONFIG['flow']['label']) is None else l
-
-    # source_id = GLOBUS_CONFIG['flow']['input']['source']['id']
-    # destination_id = GLOBUS_CONFIG['flow']['input']['destination']['id']
-    destination_base_path = f"/{FLOW_ID.split('-')[0]}/" if (p := GLOBUS_CONFIG['flow']['destination_base_path']) is None else p
+def transfer_paths(event_file, route):
+    # The source and destination collection ids are in route.input.
+    # event_file may be a dataset directory, transferred recursively
+    destination_base_path = f"/{route.flow_id.split('-')[0]}/" if (p := route.destination_base_path) is None else p
 
     # Get the Globus-compatible directory name where the triggering file is stored.
     event_folder = os.path.dirname(event_file)
@@ -71,27 +53,165 @@ def run_flow(event_file):
         destination_base_path, event_folder_name, os.path.basename(event_file))
     # Convert Windows path separators to forward slashes.
     destination_path = destination_path.replace("\\", "/")
+    if os.path.isdir(event_file):
+        source_path = source_path.rstrip("/") + "/"
+        destination_path = destination_path.rstrip("/") + "/"
+    return source_path, destination_path
+
+
+def set_compute_files(flow_input, destination_paths, key='files'):
+    # Tell the compute function which files (or, with key='archives', which archives to unpack)
+    # this run delivered, relative to its source_dir, so that it does not rescan the whole directory.
+    # Paths are relative to the deepest directory holding all of them, so files of different
+    # subdirectories, or with the same name, stay apart. GLOBUS_COMPUTE_KWARGS arrives as a string.
+    if not flow_input.get('compute_function_id'):
+        return None
+    if isinstance(kwargs := flow_input.get('compute_function_kwargs'), str):
+        kwargs = json.loads(kwargs) if kwargs.strip() else None
+    kwargs = {} if kwargs is None else kwargs
+    root = posixpath.commonpath([posixpath.dirname(p) for p in destination_paths])
+    kwargs[key] = [posixpath.relpath(p, root) for p in destination_paths]
+    flow_input['compute_function_kwargs'] = kwargs
+
+
+def destination_of(event_file):
+    # Where a file lands, to tell whether it already holds the same content
+    if (route := resolve_route(event_file)) is None:
+        return None
+    return f"{route.input['destination']['id']}:{transfer_paths(event_file, route)[1]}"
+
+
+def resolve_route(event_file):
+    if (route := ROUTES.resolve(event_file, directory=os.path.isdir(event_file))) is None:
+        # e.g. a file journaled before the routes were changed
+        LOGGER.warning(f"No route for {event_file}")
+    return route
+
+
+def start_run(route, body, label):
+    # Starting a run is not repeatable: tag it uniquely, so that after an error that may have come
+    # after the service accepted it, the run is looked up instead of started a second time
+    request_tag = f"trigger-request:{uuid.uuid4()}"
+
+    def started():
+        response = GOVERNOR.call(
+            flows_client.list_runs, filter_flow_id=route.flow_id,
+            query_params={"orderby": "start_time DESC", "per_page": 50})
+        return next((run for run in response['runs'] if request_tag in (run.get('tags') or ())), None)
+
+    return GOVERNOR.call_once(
+        flow_clients[route.flow_id].run_flow,
+        body=body,
+        label=label,
+        tags=["Trigger_Tutorial", request_tag],
+        lookup=started
+    )
+
+
+def run_flow(event_file):
+    if (route := resolve_route(event_file)) is None:
+        return None
+    flow_label = f"Trigger transfer: {os.path.basename(event_file)}" if (l := route.label) is None else l
+    dataset = os.path.isdir(event_file)
+
+    source_path, destination_path = transfer_paths(event_file, route)
 
-    LOGGER.info(f"source_path: {source_path}")
-    LOGGER.info(f"destination_path: {destination_path}")
+    LOGGER.info("source_path: %s", source_path)
+    LOGGER.info("destination_path: %s", destination_path)
 
-    # Modify initial values read from configuration with watchdog event paths
-    # These modified values are not cached in `~/.config/globs/flow/.flow.yaml` configuration file
-    GLOBUS_CONFIG['flow']['input']['source']['path'] = source_path
-    GLOBUS_CONFIG['flow']['input']['destination']['path'] = destination_path
+    # Fill a per-run copy of the route's initial values with watchdog event paths
+    # so that concurrent dispatch workers never share the input dictionary
+    flow_input = copy.deepcopy(route.input)
+    flow_input['source']['path'] = source_path
+    flow_input['destination']['path'] = destination_path
+    if dataset:
+        # One recursive transfer of the whole dataset; the compute function processes all of it
+        flow_input['recursive_tx'] = True
+    else:
+        set_compute_files(flow_input, [destination_path])
 
     # Inputs to the flow
     req_body = {
-        "input": GLOBUS_CONFIG['flow']['input']
+        "input": flow_input
     }
 
-    response = specific_flow_client.run_flow(
-        body=req_body,
-        label=flow_label,
-        tags=["Trigger_Tutorial"]
-    )
-    LOGGER.info(f"Transferring {event_file}")
-    LOGGER.info(f"View status at https://app.globus.org/runs/{response['run_id']}/logs")
+    response = start_run(route, req_body, flow_label)
+    LOGGER.info("Transferring %s", event_file)
+    LOGGER.info("View status at https://app.globus.org/runs/%s/logs", response['run_id'])
+    return response['run_id']
+
+
+def run_batch_flow(event_files):
+    # Requires a flow deployed from flows/*_batch_flow_definition.json.
+    # Batches are collected per route and directory, so the first file tells the route of all
+    # and every file lands in the same destination directory
+    if (route := resolve_route(event_files[0])) is None:
+        return None
+    flow_label = f"Trigger transfer: {len(event_files)} files" if (l := route.label) is None else l
+
+    transfer_items = []
+    for event_file in event_files:
+        source_path, destination_path = transfer_paths(event_file, route)
+        transfer_items.append({
+            "source_path": source_path,
+            "destination_path": destination_path,
+            "recursive": os.path.isdir(event_file),
+        })
+
+    # The batch input schema only accepts collection ids; paths are given per item
+    flow_input = copy.deepcopy(route.input)
+    flow_input['source'] = {'id': flow_input['source']['id']}
+    flow_input['destination'] = {'id': flow_input['destination']['id']}
+    flow_input.pop('recursive_tx', None)
+    flow_input['transfer_items'] = transfer_items
+    if not any(item['recursive'] for item in transfer_items):
+        set_compute_files(flow_input, [item['destination_path'] for item in transfer_items])
+
+    response = start_run(route, {"input": flow_input}, flow_label)
+    LOGGER.info("Transferring %d files", len(event_files))
+    LOGGER.info("View status at https://app.globus.org/runs/%s/logs", response['run_id'])
+    return response['run_id']
+
+
+def run_archive_flow(archive, event_files):
+    # Archives are packed per route and directory, so the first file tells where all of them go
+    if (route := resolve_route(event_files[0])) is None:
+        return None
+    flow_label = f"Trigger transfer: {len(event_files)} files packed" if (l := route.label) is None else l
+
+    # The archive lands in the directory its files would have been transferred to one by one,
+    # and the compute function unpacks them there
+    member_destination = transfer_paths(event_files[0], route)[1]
+    destination_path = posixpath.join(posixpath.dirname(member_destination), os.path.basename(archive))
+
+    flow_input = copy.deepcopy(route.input)
+    flow_input['source']['path'] = translate_local_path_to_globus_path(archive)
+    flow_input['destination']['path'] = destination_path
+    set_compute_files(flow_input, [destination_path], key='archives')
+
+    response = start_run(route, {"input": flow_input}, flow_label)
+    LOGGER.info("Transferring %d files in %s", len(event_files), os.path.basename(archive))
+    LOGGER.info("View status at https://app.globus.org/runs/%s/logs", response['run_id'])
+    return response['run_id']
+
+
+def fetch_run_statuses(run_ids):
+    # Page through the most recent runs of the flow, then ask for any stragglers one by one
+    wanted = set(run_ids)
+    statuses = {}
+    marker = None
+    for _ in range(len(wanted) // 50 + 2):
+        response = GOVERNOR.call(
+            flows_client.list_runs, filter_flow_id=ROUTES.flow_ids(), marker=marker,
+            query_params={"orderby": "start_time DESC", "per_page": 50})
+        for run in response['runs']:
+            if run['run_id'] in wanted:
+                statuses[run['run_id']] = run['status']
+        if len(statuses) == len(wanted) or not response.get('has_next_page') or (marker := response.get('marker')) is None:
+            break
+    for run_id in list(wanted - set(statuses))[:10]:
+        statuses[run_id] = GOVERNOR.call(flows_client.get_run, run_id)['status']
+    return statuses
 
 
 # Parse input arguments
@@ -103,35 +223,443 @@ def parse_args():
     parser.add_argument(
         "--watchdir",
         type=str,
-        default=os.path.abspath(".") if (p := GLOBUS_CONFIG['flow']['input']['source']['path']) is None else p,
-        help=f"Directory path to watch. [default: current directory]",
+        default=os.path.abspath(".") if (p := CONFIG.flow['input']['source']['path']) is None else p,
+        help=f"Directory path to watch when the flow configuration has no routes. [default: current directory]",
     )
     parser.add_argument(
         "--extensions",
         type=str,
         default="",
         nargs="*",
-        help='Filename extension(s) that will trigger the flow. [default: ""]',
+        help='Filename extension(s) or glob(s) that will trigger the flow. [default: ""]',
+    )
+    parser.add_argument(
+        "--exclude",
+        type=str,
+        default=[],
+        nargs="*",
+        help='Suffixes or globs of files that never trigger the flow, e.g. "*.tmp" ".*". [default: none]',
+    )
+    parser.add_argument(
+        "--prune",
+        type=str,
+        default=[],
+        nargs="*",
+        help='Names, globs or relative paths of directories neither watched nor scanned, e.g. "processed". [default: none]',
+    )
+    parser.add_argument(
+        "--readiness",
+        type=str,
+        default="procfd",
+        choices=["procfd", "inotify", "quiescence"],
+        help="How to decide that a new file has been closed by its writer. [default: procfd]",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=0,
+        help="Coalesce the events of each file and submit it once, under its final name, after this many "
+             "seconds without events or as soon as it is renamed into place after being closed; follows "
+             "writers that write a temporary file and rename it. 0 submits files as they are created. "
+             "[default: 0]",
+    )
+    parser.add_argument(
+        "--debounce-max-files",
+        type=int,
+        default=100000,
+        help="Most files whose events are coalesced at once with --debounce; the oldest is submitted "
+             "early beyond it. [default: 100000]",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads starting flows for ready files. [default: 4]",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=1000,
+        help="Maximum number of files waiting to be closed or for a dispatch worker. [default: 1000]",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Submit ready files in batches; FLOW_ID must be a flow deployed from a *_batch_flow_definition.json.",
+    )
+    parser.add_argument(
+        "--batch-window",
+        type=float,
+        default=5.0,
+        help="Seconds to collect files into a batch. [default: 5]",
+    )
+    parser.add_argument(
+        "--batch-max-files",
+        type=int,
+        default=1000,
+        help="Maximum number of files in a batch. [default: 1000]",
+    )
+    parser.add_argument(
+        "--batch-max-bytes",
+        type=int,
+        default=None,
+        help="Maximum total bytes in a batch. [default: unlimited]",
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Pack small ready files into tar archives in --pack-dir and transfer the archives; "
+             "the transfer-and-compute flow unpacks them.",
+    )
+    parser.add_argument(
+        "--pack-dir",
+        type=str,
+        default=str(MYFLOW_CONFIG_DIR.joinpath('staging')),
+        help="Staging directory of the archives; must be readable through the source collection. "
+             "[default: ~/.config/globus/flow/staging]",
+    )
+    parser.add_argument(
+        "--pack-max-file-size",
+        type=int,
+        default=1 << 20,
+        help="Files larger than this many bytes are transferred on their own. [default: 1048576]",
+    )
+    parser.add_argument(
+        "--pack-max-files",
+        type=int,
+        default=10000,
+        help="Maximum number of files in an archive. [default: 10000]",
+    )
+    parser.add_argument(
+        "--pack-max-bytes",
+        type=int,
+        default=256 << 20,
+        help="Maximum bytes of files in an archive. [default: 268435456]",
+    )
+    parser.add_argument(
+        "--pack-window",
+        type=float,
+        default=10.0,
+        help="Seconds to collect files into an archive. [default: 10]",
+    )
+    parser.add_argument(
+        "--pack-compression",
+        choices=['none', 'zstd'],
+        default='none',
+        help="Compress archives with zstd; needs the zstandard package here and on the compute endpoint. "
+             "[default: none]",
+    )
+    parser.add_argument(
+        "--journal",
+        type=str,
+        default=None,
+        help="SQLite journal recording every triggered file. [default: ~/.config/globus/flow/.journal.sqlite, "
+             "or .journal.sqlite next to --shard-db]",
+    )
+    parser.add_argument(
+        "--no-journal",
+        action="store_true",
+        help="Do not journal triggered files; files arriving while stopped are not recovered.",
+    )
+    parser.add_argument(
+        "--no-catch-up",
+        action="store_true",
+        help="Do not scan the watch directory at startup for files missing from the journal.",
+    )
+    parser.add_argument(
+        "--observer",
+        choices=['native', 'polling'],
+        default='native',
+        help="How file events are detected: 'native' uses inotify (or the platform's equivalent); 'polling' "
+             "rescans changed directories, for NFS and Lustre where files written on other hosts raise no "
+             "inotify events. Combine 'polling' with '--readiness quiescence'. [default: native]",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between polling cycles with '--observer polling'. [default: 5]",
+    )
+    parser.add_argument(
+        "--poll-workers",
+        type=int,
+        default=16,
+        help="Threads stat'ing and listing directories with '--observer polling'. [default: 16]",
+    )
+    parser.add_argument(
+        "--datasets",
+        action="store_true",
+        help="Transfer each dataset directory (see --dataset-depth) recursively in one run once it is "
+             "complete, instead of starting a run per file.",
+    )
+    parser.add_argument(
+        "--dataset-depth",
+        type=int,
+        default=1,
+        help="How many levels below the watch directory dataset directories are. [default: 1]",
+    )
+    parser.add_argument(
+        "--dataset-sentinel",
+        nargs="+",
+        default=list(DEFAULT_SENTINELS),
+        help="File names that mark a dataset directory complete. [default: DONE .complete]",
+    )
+    parser.add_argument(
+        "--dataset-quiet",
+        type=float,
+        default=60.0,
+        help="Seconds without writes after which a dataset is complete without a sentinel; "
+             "0 waits for the sentinel. [default: 60]",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Checksum every ready file and do not transfer it again when its destination already "
+             "received the same content.",
+    )
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=4,
+        help="Threads checksumming files with --dedup. [default: 4]",
+    )
+    parser.add_argument(
+        "--hash-algorithm",
+        type=str,
+        default='sha256',
+        help="hashlib algorithm of the --dedup checksums. [default: sha256]",
+    )
+    parser.add_argument(
+        "--digest-db",
+        type=str,
+        default=None,
+        help="SQLite database caching checksums and the content delivered to each destination. "
+             "[default: .digests.sqlite next to the journal]",
+    )
+    parser.add_argument(
+        "--shard-db",
+        type=str,
+        default=None,
+        help="Share the watch tree with other watcher nodes through leases in this SQLite database, "
+             "on storage every node can reach. The journal is shared as well. [default: no sharding]",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=16,
+        help="Number of shards the watch tree is split into; the same on every node. [default: 16]",
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=['top', 'hash'],
+        default='top',
+        help="Shard files by their top-level directory under the watch directory, or by the hash of "
+             "their path. [default: top]",
+    )
+    parser.add_argument(
+        "--lease-ttl",
+        type=float,
+        default=30.0,
+        help="Seconds a shard lease lasts unless renewed; a failed node's shards are taken over "
+             "after this long. [default: 30]",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=100,
+        help="Maximum number of runs not yet finished before dispatch pauses. [default: 100]",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=2,
+        help="Times a failed run is resubmitted. [default: 2]",
+    )
+    parser.add_argument(
+        "--no-track",
+        action="store_true",
+        help="Do not follow the status of submitted runs.",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=10.0,
+        help="Maximum Globus API calls per second. [default: 10]",
+    )
+    parser.add_argument(
+        "--burst",
+        type=int,
+        default=20,
+        help="Globus API calls allowed in a burst above --rate-limit. [default: 20]",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve Prometheus metrics at http://127.0.0.1:PORT/metrics. [default: disabled]",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        type=str,
+        default="127.0.0.1",
+        help="Address the metrics endpoint listens on. [default: 127.0.0.1]",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        default=None,
+        help="Write a JSON snapshot of the metrics to this file every --metrics-interval seconds. [default: disabled]",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=15.0,
+        help="Seconds between metrics snapshots. [default: 15]",
+    )
+    parser.add_argument(
+        "--spans",
+        action="store_true",
+        help="Time every file through created, ready, submitted and completed.",
+    )
+    parser.add_argument(
+        "--spans-file",
+        type=str,
+        default=None,
+        help="Append the stage timestamps of every completed file to this JSON lines file (implies --spans).",
     )
     parser.set_defaults(verbose=True)
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.pack and args.batch:
+        parser.error("--pack and --batch are alternatives; choose one")
+    if args.debounce and args.datasets:
+        parser.error("--datasets waits for --dataset-quiet instead of --debounce")
+    if args.shard_db is not None and args.no_journal:
+        parser.error("--shard-db needs the journal to hand files over between nodes")
+    if args.journal is None:
+        args.journal = str(MYFLOW_CONFIG_DIR.joinpath('.journal.sqlite')) if args.shard_db is None else \
+            os.path.join(os.path.dirname(os.path.abspath(args.shard_db)), '.journal.sqlite')
+    if args.digest_db is None:
+        args.digest_db = os.path.join(os.path.dirname(os.path.abspath(args.journal)), '.digests.sqlite')
+    return args
 
 
 if __name__ == "__main__":
     args = parse_args()
+    mocked = use_mock()
 
     # Creates and starts the watcher
-    native_client = globus_sdk.NativeAppAuthClient(NATIVE_APP_CLIENT_ID)
-    file_adapter = SimpleJSONFileAdapter(
-        os.path.abspath(os.path.expanduser(DEFAULT_TOKEN_STORE)))
-    flow_scope = globus_sdk.SpecificFlowClient(FLOW_ID).scopes.user
-
-    specific_flow_client = globus_sdk.SpecificFlowClient(
-        flow_id=FLOW_ID, authorizer=get_authorizer(
-            native_client=native_client,resource_server=FLOW_ID,
-            scopes=flow_scope, file_adapter=file_adapter))
+    GOVERNOR.configure(rate=args.rate_limit, burst=args.burst)
+
+    # Without routes in the flow configuration, everything in --watchdir goes to the configured flow
+    ROUTES = RoutingTable.from_config(
+        CONFIG.routes or [{'path': args.watchdir}], CONFIG.flow,
+        include=args.extensions, exclude=args.exclude, prune=args.prune)
+
+    native_client = share_session(globus_sdk.NativeAppAuthClient(NATIVE_APP_CLIENT_ID))
+    # The mock service needs no stored tokens
+    tokens = None if mocked else TokenManager(native_client, DEFAULT_TOKEN_STORE)
+
+    # One client per flow, all on the same session and tokens
+    flow_clients = {}
+    for flow_id in ROUTES.flow_ids():
+        flow_scope = globus_sdk.SpecificFlowClient(flow_id).scopes.user
+        flow_clients[flow_id] = share_session(globus_sdk.SpecificFlowClient(
+            flow_id=flow_id, authorizer=get_authorizer(
+                tokens=tokens, resource_server=flow_id, scopes=flow_scope),
+            transport_params=TRANSPORT_PARAMS))
     
+    journal = None if args.no_journal else Journal(args.journal, shared=args.shard_db is not None).open()
+    shards = None if args.shard_db is None else Shards(
+        args.shard_db, ROUTES.roots(), count=args.shards, by=args.shard_by, ttl=args.lease_ttl)
+
+    if args.spans or args.spans_file:
+        SPANS.enable(args.spans_file)
+    metrics_server = None if args.metrics_port is None else MetricsServer(
+        host=args.metrics_host, port=args.metrics_port).start()
+    snapshots = None if args.metrics_file is None else SnapshotWriter(
+        args.metrics_file, interval=args.metrics_interval).start()
+
+    # Lists runs, also without tracking: start_run() looks up runs whose start failed ambiguously
+    flows_client = share_session(globus_sdk.FlowsClient(authorizer=get_authorizer(
+        tokens=tokens, resource_server=RESOURCE_SERVER,
+        scopes=[globus_sdk.FlowsClient.scopes.run_status]),
+        transport_params=TRANSPORT_PARAMS))
+
+    tracker = None
+    if not args.no_track:
+        tracker = RunTracker(
+            fetch_run_statuses, max_in_flight=args.max_in_flight, max_retries=args.max_retries,
+            resubmit=run_batch_flow if args.batch else lambda paths: run_flow(paths[0]),
+            journal=journal)
+        if journal is not None and shards is None:
+            # With shards, runs are adopted with the shards they belong to
+            tracker.adopt(journal.submitted())
+        tracker.start()
+
+    if tokens is not None:
+        # Renew tokens before they expire, so that no run waits for Globus Auth
+        tokens.start()
+
+    flow_runner = run_flow
+    if args.batch:
+        flow_runner = RouteRunner(ROUTES, {route: Batcher(run_batch_flow, window=args.batch_window,
+            max_files=args.batch_max_files, max_bytes=args.batch_max_bytes, journal=journal,
+            tracker=tracker, group_of=os.path.dirname) for route in ROUTES.routes}, tracker=tracker)
+        flow_runner.start()
+    elif args.pack:
+        flow_runner = Packer(run_archive_flow, args.pack_dir, FileRunner=run_flow,
+            max_files=args.pack_max_files, max_bytes=args.pack_max_bytes,
+            max_file_size=args.pack_max_file_size, window=args.pack_window,
+            compression=None if args.pack_compression == 'none' else args.pack_compression,
+            group_of=lambda path: (getattr(ROUTES.resolve(path), 'name', None), os.path.dirname(path)),
+            journal=journal, tracker=tracker)
+        if tracker is not None:
+            # Failed runs are retried with their archive, which is removed once its run succeeded
+            tracker.resubmit = flow_runner.resubmit
+            tracker.on_finished = flow_runner.finished
+        flow_runner.start()
+
+    digests = hasher = None
+    runner = flow_runner
+    if args.dedup:
+        digests = DigestIndex(args.digest_db)
+        hasher = Hasher(args.hash_algorithm, workers=args.hash_workers, index=digests)
+        runner = Deduplicator(flow_runner, hasher, digests, destination_of, journal=journal)
+        if tracker is not None:
+            # Deliveries count once their run succeeded
+            runner.follow(tracker)
+
+    datasets = None if not args.datasets else DatasetTrigger(
+        ROUTES.roots(), depth=args.dataset_depth, sentinels=args.dataset_sentinel, quiet=args.dataset_quiet)
+
     trigger = FileTrigger(
-        watch_dir=os.path.expanduser(args.watchdir), patterns=args.extensions, FlowRunner=run_flow,)
+        watch_dir=None, patterns=args.extensions, FlowRunner=runner, routes=ROUTES,
+        readiness=args.readiness, workers=args.workers, queue_size=args.queue_size, journal=journal,
+        catch_up=not args.no_catch_up, tracker=None if args.batch or args.pack else tracker, shards=shards,
+        observer=args.observer, poll_interval=args.poll_interval, poll_workers=args.poll_workers,
+        datasets=datasets, debounce=args.debounce, max_active=args.debounce_max_files)
     trigger.run()
 
+    if hasher is not None:
+        LOGGER.info("Deduplication", **runner.stats())
+        hasher.close()
+        digests.close()
+    if args.batch or args.pack:
+        flow_runner.stop()
+    if args.pack:
+        LOGGER.info("Packing", **flow_runner.stats())
+    if shards is not None:
+        # Only once the last batches are submitted may other nodes take the shards over
+        shards.stop()
+    if tracker is not None:
+        tracker.stop()
+    if tokens is not None:
+        tokens.close()
+    if journal is not None:
+        journal.close()
+    if snapshots is not None:
+        snapshots.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+    SPANS.disable()
+
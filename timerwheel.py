@@ -0,0 +1,80 @@
+""" A hashed timer wheel for many timeouts that are pushed back often.
+
+Deadlines are filed into `slots` buckets of `tick` seconds each, by the tick
+they fall in; `expired(now)` only visits the buckets of the ticks passed since
+the previous call. Moving a deadline later, the common case for an activity
+timeout, only updates a dict: the key stays in its old bucket and is filed
+again, at its new deadline, when that bucket comes round. Cancelled keys are
+dropped the same way. Scheduling, rescheduling and cancelling are O(1), and
+one pass over the wheel costs the number of keys due or parked in the
+visited buckets, not the number of timers.
+
+The wheel does no locking and keeps no thread; its owner calls `expired()`
+from its own loop.
+"""
+
+
+class TimerWheel:
+    def __init__(self, tick: 'float'=0.5, slots: 'int'=512):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._deadlines = {}
+        self._cursor = None
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, key) -> bool:
+        return key in self._deadlines
+
+    def deadline(self, key) -> 'float|None':
+        return self._deadlines.get(key)
+
+    def schedule(self, key, deadline: 'float') -> None:
+        """Make `key` expire at `deadline` (same clock as `expired`), replacing any earlier deadline."""
+        previous = self._deadlines.get(key)
+        self._deadlines[key] = deadline
+        if previous is None or deadline < previous:
+            # A later deadline is picked up when the key's current bucket comes round
+            self._file(key, deadline)
+
+    def cancel(self, key) -> None:
+        self._deadlines.pop(key, None)
+
+    def expired(self, now: 'float') -> 'list':
+        """Remove and return keys whose deadline is at or before `now`.
+
+        A key is returned by the first call in a later tick than its deadline
+        at the latest, i.e. at most `tick` seconds late.
+        """
+        target = int(now // self.tick)
+        if self._cursor is None:
+            self._cursor = target - 1
+        if target <= self._cursor:
+            return []
+        # After a pause longer than a revolution every bucket is due once
+        first = max(self._cursor + 1, target - len(self._slots) + 1)
+        self._cursor = target
+        due = []
+        later = []
+        for t in range(first, target + 1):
+            bucket = self._slots[t % len(self._slots)]
+            for key in bucket:
+                if (deadline := self._deadlines.get(key)) is None:
+                    continue
+                if deadline <= now:
+                    del self._deadlines[key]
+                    due.append(key)
+                else:
+                    later.append(key)
+            bucket.clear()
+        for key in later:
+            self._file(key, self._deadlines[key])
+        return due
+
+    def _file(self, key, deadline: 'float') -> None:
+        t = int(deadline // self.tick)
+        if self._cursor is not None and t <= self._cursor:
+            # Already due; the next call picks it up
+            t = self._cursor + 1
+        self._slots[t % len(self._slots)].add(key)
@@ -0,0 +1,210 @@
+""" Track submitted flow runs until they finish.
+
+`RunTracker` keeps a table of outstanding run ids and the files each run
+carries. A background thread asks the Flows service for their status in bulk,
+polling quickly while runs are finishing and backing off while nothing
+changes. Failed runs are resubmitted up to `max_retries` times.
+
+The tracker also caps how many runs may be in flight: whoever submits a run
+first takes a slot with `acquire()`, which blocks while the cap is reached.
+This pauses dispatch, and through the bounded dispatch queue the Handler,
+until the service catches up.
+"""
+import threading
+import time
+
+from journal import SUBMITTED, SUCCEEDED, FAILED
+from metrics import REGISTRY, SPANS
+from settings import LOGGER
+
+
+RUN_SECONDS = REGISTRY.histogram(
+    'watcher_run_seconds', 'Seconds from submitting a run until it was seen finished', ('status',))
+
+
+# Statuses of runs that have not finished yet
+ACTIVE = ('ACTIVE', 'INACTIVE')
+
+
+class _Run:
+    __slots__ = ('run_id', 'paths', 'attempt', 'submitted', 'status')
+
+    def __init__(self, run_id, paths, attempt=0):
+        self.run_id = run_id
+        self.paths = paths
+        self.attempt = attempt
+        self.submitted = time.monotonic()
+        self.status = None
+
+
+class RunTracker:
+    def __init__(self, fetch_statuses, max_in_flight: 'int'=100, resubmit=None, max_retries: 'int'=2,
+                 journal=None, min_interval: 'float'=2.0, max_interval: 'float'=60.0):
+        """`fetch_statuses(run_ids)` returns {run_id: status} for the runs it found;
+        `resubmit(paths)` starts a new run for the files of a failed run and returns its id, or None if it did not.
+        `on_finished(paths, status)`, when set, is called once a run is over for good.
+        """
+        self.fetch_statuses = fetch_statuses
+        self.max_in_flight = max_in_flight
+        self.resubmit = resubmit
+        self.max_retries = max_retries
+        self.journal = journal
+        self.on_finished = None
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self._runs = {}
+        self._slots = 0
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._stopped = threading.Event()
+        self._thread = None
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="run-tracker", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        with self._lock:
+            self._available.notify_all()
+        if (t := self._thread) is not None:
+            t.join()
+        self._thread = None
+
+    def acquire(self, timeout: 'float|None'=None) -> bool:
+        """Take an in-flight slot, blocking while the cap is reached."""
+        with self._lock:
+            if self._slots >= self.max_in_flight:
+                LOGGER.info(f"{self._slots} runs in flight, pausing dispatch")
+            if not self._available.wait_for(
+                    lambda: self._slots < self.max_in_flight or self._stopped.is_set(), timeout):
+                return False
+            self._slots += 1
+            return True
+
+    def release(self) -> None:
+        """Give back a slot that did not result in a run."""
+        with self._lock:
+            self._slots -= 1
+            self._available.notify()
+
+    def track(self, run_id: 'str', paths: 'list', attempt: 'int'=0) -> None:
+        """Start tracking a run submitted with an acquired slot."""
+        with self._lock:
+            self._runs[run_id] = _Run(run_id, list(paths), attempt)
+        self.interval = self.min_interval
+
+    def adopt(self, runs: 'dict') -> None:
+        """Track runs submitted by an earlier watcher, e.g. from `Journal.submitted()`.
+
+        Runs already tracked are skipped, so that a shard handed back to this
+        node does not take their slots twice.
+        """
+        adopted = 0
+        with self._lock:
+            for run_id, paths in runs.items():
+                if run_id in self._runs:
+                    continue
+                self._runs[run_id] = _Run(run_id, list(paths))
+                self._slots += 1
+                adopted += 1
+        if adopted:
+            LOGGER.info(f"Tracking {adopted} runs submitted before restart")
+
+    def stats(self) -> 'dict':
+        with self._lock:
+            in_flight = self._slots
+            outstanding = len(self._runs)
+        return {
+            'in_flight': in_flight,
+            'outstanding_runs': outstanding,
+            'max_in_flight': self.max_in_flight,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'retried': self.retried,
+            'poll_interval': self.interval,
+        }
+
+    def poll(self) -> 'int|None':
+        """Fetch the status of every outstanding run; return how many finished."""
+        with self._lock:
+            run_ids = list(self._runs)
+        if not run_ids:
+            return None
+        statuses = self.fetch_statuses(run_ids)
+        finished = 0
+        for run_id, status in statuses.items():
+            with self._lock:
+                if (run := self._runs.get(run_id)) is None:
+                    continue
+                run.status = status
+                if status in ACTIVE:
+                    continue
+                del self._runs[run_id]
+            finished += 1
+            if status == 'SUCCEEDED':
+                self._succeeded(run)
+            else:
+                self._failed(run, status)
+        return finished
+
+    def _succeeded(self, run: '_Run') -> None:
+        self.succeeded += 1
+        RUN_SECONDS.labels('SUCCEEDED').observe(time.monotonic() - run.submitted)
+        SPANS.finish(run.paths)
+        LOGGER.info("Run %s succeeded (%d files)", run.run_id, len(run.paths))
+        self._journal(run.paths, SUCCEEDED)
+        self._finished(run, 'SUCCEEDED')
+        self.release()
+
+    def _failed(self, run: '_Run', status: 'str') -> None:
+        if self.resubmit is not None and run.attempt < self.max_retries:
+            LOGGER.warning(f"Run {run.run_id} {status}, resubmitting (attempt {run.attempt + 1})")
+            try:
+                # The new run takes over the slot of the failed one
+                if (run_id := self.resubmit(run.paths)) is not None:
+                    self.retried += 1
+                    self.track(run_id, run.paths, attempt=run.attempt + 1)
+                    self._journal(run.paths, SUBMITTED, run_id=run_id)
+                    return None
+                # e.g. no route for the files any more, or their shard is held elsewhere now
+                LOGGER.warning(f"Run {run.run_id} was not resubmitted")
+            except Exception:
+                LOGGER.exception(f"Resubmitting run {run.run_id} failed")
+        self.failed += 1
+        RUN_SECONDS.labels(status).observe(time.monotonic() - run.submitted)
+        SPANS.finish(run.paths)
+        LOGGER.error(f"Run {run.run_id} {status} ({len(run.paths)} files)")
+        self._journal(run.paths, FAILED, error=f"run {run.run_id} {status}")
+        self._finished(run, status)
+        self.release()
+
+    def _finished(self, run: '_Run', status: 'str') -> None:
+        if self.on_finished is not None:
+            try:
+                self.on_finished(run.paths, status)
+            except Exception:
+                LOGGER.exception(f"Finishing run {run.run_id} failed")
+
+    def _journal(self, paths: 'list', state: 'str', **kwargs) -> None:
+        if self.journal is not None:
+            for path in paths:
+                self.journal.mark(path, state, **kwargs)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                finished = self.poll()
+            except Exception:
+                LOGGER.exception("Polling run status failed")
+                finished = 0
+            # Poll quickly while runs are completing, back off while nothing changes
+            if finished is None or finished > 0:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
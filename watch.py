@@ -6,34 +6,101 @@ import yaml
 from datetime import datetime
 
 import os
-import psutil
 import sys
+import threading
 import time
 
 from watchdog.events import FileSystemEventHandler
 from watchdog.events import EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_DELETED
+from watchdog.events import EVENT_TYPE_CLOSED, EVENT_TYPE_MOVED
 from watchdog.observers import Observer
 
+from checksum import Deduplicator
+from coalesce import COALESCE_EVENTS, EventCoalescer
+from datasets import catch_up_datasets
+from dispatch import Dispatcher
+from governor import GOVERNOR
+from journal import DELIVERED_STATES
+from matcher import PathMatcher
+from metrics import REGISTRY, SPANS
+from polling import PollingObserver
+from readiness import make_readiness, open_file_index
+from scan import catch_up
+from sharding import Fenced, OwnedMatcher
 from settings import LOGGER
 
 
+EVENTS = REGISTRY.counter('watcher_events_total', 'File system events seen by the Handler', ('type',))
+
+
+def make_observer(kind='native', poll_interval=5.0, poll_workers=16):
+    if kind == 'native':
+        return Observer()
+    if kind == 'polling':
+        return PollingObserver(interval=poll_interval, workers=poll_workers)
+    raise ValueError(f"Unknown observer {kind!r}, expected 'native' or 'polling'")
+
+
 def has_handle(fpath):
-    for proc in psutil.process_iter():
-        try:
-            for item in proc.open_files():
-                if fpath == item.path:
-                    return True
-        except Exception:
-            pass
-    return False
+    return (p := os.path.realpath(fpath)) in open_file_index({p})
 
 
 class FileTrigger:
-    def __init__(self, watch_dir, patterns, FlowRunner=None):
-        self.observer = Observer()
-        self.watch_dir = watch_dir
+    def __init__(self, watch_dir, patterns, FlowRunner=None, readiness='procfd',
+                 workers=4, queue_size=1000, stats_interval=60, journal=None,
+                 catch_up=True, scan_workers=8, tracker=None, exclude=(), prune=(), routes=None, shards=None,
+                 observer='native', poll_interval=5.0, poll_workers=16, datasets=None, debounce=None,
+                 max_active=100000):
+        """Watch `watch_dir` for files accepted by `patterns`, or with `routes`, a RoutingTable,
+        every route's directory for the files its rules accept.
+
+        With `shards`, a sharding.Shards shared with other watcher nodes, only
+        files in the shards this node holds a lease on trigger a flow.
+
+        `observer` is 'native' (inotify and the like) or 'polling', for network
+        and parallel filesystems whose changes made on other hosts raise no
+        events; it polls every `poll_interval` seconds with `poll_workers` threads.
+
+        With `datasets`, a datasets.DatasetTrigger, files are not submitted one
+        by one: each dataset directory is submitted once it is complete.
+
+        With `debounce` seconds, the events of each file are coalesced (see
+        coalesce.EventCoalescer): a file is submitted once, under its final
+        name, when it has seen no event for `debounce` seconds or was renamed
+        into place after being closed. At most `max_active` files are followed.
+        """
+        self.observer = make_observer(observer, poll_interval, poll_workers)
+        self.routes = routes
         self.patterns = patterns
+        if routes is not None:
+            # One observer and one pool of workers for every route
+            self.watch_dirs = routes.roots()
+            self.matcher = routes
+        else:
+            self.watch_dirs = [os.path.abspath(watch_dir)]
+            self.matcher = patterns if isinstance(patterns, PathMatcher) else PathMatcher(
+                include=patterns, exclude=exclude, prune=prune, root=self.watch_dirs[0])
+        self.watch_dir = os.path.commonpath(self.watch_dirs)
+        self.shards = shards
+        self.datasets = datasets
+        self.coalescer = None
+        if shards is not None:
+            self.matcher = OwnedMatcher(self.matcher, shards)
         self.FlowRunner = FlowRunner
+        if debounce and datasets is None:
+            # Dataset mode has a quiet period of its own
+            self.coalescer = EventCoalescer(self.matches, debounce=debounce, max_paths=max_active)
+        self.readiness = make_readiness(readiness)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.stats_interval = stats_interval
+        self.journal = journal
+        self.catch_up = catch_up
+        self.scan_workers = scan_workers
+        self.tracker = tracker
+        self.dispatcher = None
+        self._shallow = set()
+        self._stopped = threading.Event()
 
     def run(self):
         LOGGER.info("Watcher Started")
@@ -43,53 +110,267 @@ class FileTrigger:
             LOGGER.info("Using system print()")
             self.FlowRunner = print
 
-        if not os.path.isdir(self.watch_dir):
-            LOGGER.info("Watch directory does not exist.")
-            os.mkdir(self.watch_dir)
-            LOGGER.info("Directory " + self.watch_dir + " was created")
+        for watch_dir in self.watch_dirs:
+            if not os.path.isdir(watch_dir):
+                LOGGER.info("Watch directory does not exist.")
+                os.makedirs(watch_dir)
+                LOGGER.info("Directory " + watch_dir + " was created")
+            LOGGER.info(f"Monitoring: {watch_dir}")
 
         os.chdir(self.watch_dir)
-        LOGGER.info(f"Monitoring: {self.watch_dir}")
+        if self.routes is not None:
+            LOGGER.info(f"Routing files to {len(self.routes.flow_ids())} flows by {len(self.routes.routes)} routes")
 
-        event_handler = Handler(self.FlowRunner, self.patterns)
-        self.observer.schedule(event_handler, self.watch_dir, recursive=True)
+        self.dispatcher = Dispatcher(
+            self.FlowRunner if self.shards is None else Fenced(self.FlowRunner, self.shards), self.readiness, workers=self.workers, queue_size=self.queue_size,
+            journal=self.journal, tracker=self.tracker)
+        event_handler = Handler(
+            self.FlowRunner, self.matcher, readiness=self.readiness, dispatcher=self.dispatcher,
+            on_new_directory=self.watch_new_directory, datasets=self.datasets, coalescer=self.coalescer)
+        if self.coalescer is not None:
+            self.coalescer.handed_on = event_handler.handed_on
+        self.register_metrics()
+        self.readiness.start()
+        self.dispatcher.start()
+        if self.datasets is not None:
+            # Complete datasets need no readiness check of their own
+            self.datasets.submit = lambda directory: self.dispatcher.submit(directory, ready=True)
+            if self.shards is not None:
+                self.datasets.owns = self.shards.owns
+            self.datasets.start()
+            LOGGER.info(f"Dataset mode: directories {self.datasets.depth} below the watch directory, complete at "
+                        f"{' or '.join(sorted(self.datasets.sentinels))}"
+                        + (f" or after {self.datasets.quiet}s without writes" if self.datasets.quiet else ""))
+        if self.coalescer is not None:
+            # Files closed before they settled need no readiness check of their own
+            self.coalescer.emit = lambda path, ready: self.dispatcher.submit(path, ready=ready)
+            self.coalescer.start()
+            LOGGER.info(f"Coalescing file events, debounce {self.coalescer.debounce}s")
+        LOGGER.info(f"File readiness backend: {self.readiness.name}")
+        LOGGER.info(f"Dispatch workers: {self.workers}, queue size: {self.queue_size}")
+        self.event_handler = event_handler
+        watches = [w for watch_dir in self.watch_dirs for w in self.matcher.plan_watches(watch_dir)]
+        for directory, recursive in watches:
+            self.observer.schedule(event_handler, directory, recursive=recursive)
+            if not recursive:
+                self._shallow.add(directory)
+        LOGGER.info(f"Watching {len(watches)} subtrees, {len(self._shallow)} non-recursively"
+                    f"{' by polling' if isinstance(self.observer, PollingObserver) else ''}")
         self.observer.start()
 
+        if self.shards is not None:
+            # Recovery and catch-up happen per shard, as leases are acquired
+            self.shards.on_change = self.take_over
+            self.shards.start()
+        elif self.journal is not None:
+            self.recover()
+            if self.catch_up:
+                for watch_dir in self.watch_dirs:
+                    self.scan(watch_dir, self.matches, prune=self.matcher.prunes, workers=self.scan_workers)
+
         try:
-            while True:
-                time.sleep(1)
+            last = time.monotonic()
+            while not self._stopped.wait(1):
+                if self.stats_interval and (now := time.monotonic()) - last >= self.stats_interval:
+                    last = now
+                    self.log_stats()
         except:
-            self.observer.stop()
-            LOGGER.info("Watcher stopped.")
+            pass
+        self.observer.stop()
+        LOGGER.info("Watcher stopped.")
 
         self.observer.join()
+        if self.datasets is not None:
+            self.datasets.stop()
+        if self.coalescer is not None:
+            self.coalescer.stop()
+        self.dispatcher.stop(timeout=10)
+        self.readiness.stop()
+
+    def stop(self):
+        """Make `run` return, e.g. when the trigger runs in another thread."""
+        self._stopped.set()
+
+    def matches(self, path):
+        return self.matcher.matches(path)
+
+    def watch_new_directory(self, path):
+        # Directories created next to a pruned one are not covered by a recursive watch
+        if os.path.dirname(path) not in self._shallow or self.matcher.prunes(path):
+            return None
+        for directory, recursive in self.matcher.plan_watches(path):
+            self.observer.schedule(self.event_handler, directory, recursive=recursive)
+            if not recursive:
+                self._shallow.add(directory)
+        if self.journal is not None:
+            # Pick up files written before the watch was in place
+            self.scan(path, self.matches, prune=self.matcher.prunes, workers=1)
+
+    def scan(self, root, match, prune=None, workers=1):
+        """Submit the files, or arm the datasets, under `root` that the journal does not know."""
+        if self.datasets is None:
+            catch_up(root, match, self.journal, self.dispatcher.submit, prune=prune, workers=workers)
+        else:
+            catch_up_datasets(root, self.datasets, match, self.journal, prune=prune)
+
+    def recover(self):
+        # Files accepted by an earlier watcher that never reached a flow
+        recovered = 0
+        for path in self.journal.pending():
+            # Dataset directories were complete when they were journaled
+            self.dispatcher.enqueue(path, ready=os.path.isdir(path))
+            recovered += 1
+        LOGGER.info(f"Recovered {recovered} pending files from journal")
+
+    def take_over(self, acquired, lost):
+        """Pick up the work of shards this node has just acquired, on a thread of its own
+        so that the lease thread keeps renewing."""
+        if acquired and self.journal is not None:
+            threading.Thread(target=self._take_over, args=(acquired,), name="shard-takeover", daemon=True).start()
+
+    def _take_over(self, acquired):
+        shard = self.shards.shard
+        recovered = 0
+        for path in self.journal.pending():
+            if shard(path) in acquired:
+                self.dispatcher.enqueue(path, ready=os.path.isdir(path))
+                recovered += 1
+        LOGGER.info(f"Recovered {recovered} pending files of shards {sorted(acquired)} from journal")
+        if (tracker := self.tracker if self.tracker is not None else getattr(self.FlowRunner, 'tracker', None)) \
+                is not None:
+            tracker.adopt({run_id: paths for run_id, paths in self.journal.submitted().items()
+                           if shard(paths[0]) in acquired})
+        if not self.catch_up:
+            return None
+
+        def prune(directory):
+            return self.matcher.prunes(directory) or self.shards.directory_shard(directory) not in (None, *acquired)
+
+        for watch_dir in self.watch_dirs:
+            self.scan(watch_dir, lambda p: shard(p) in acquired and self.matches(p), prune=prune,
+                      workers=self.scan_workers)
+
+    def stats(self):
+        return {
+            'dispatch': self.dispatcher.stats() if self.dispatcher is not None else None,
+            'readiness': self.readiness.stats(),
+            'runs': self.tracker.stats() if self.tracker is not None else None,
+            'api': GOVERNOR.stats(),
+            'shards': self.shards.stats() if self.shards is not None else None,
+            'polling': self.observer.stats() if isinstance(self.observer, PollingObserver) else None,
+            'datasets': self.datasets.stats() if self.datasets is not None else None,
+            'dedup': self.FlowRunner.stats() if isinstance(self.FlowRunner, Deduplicator) else None,
+            'coalesce': self.coalescer.stats() if self.coalescer is not None else None,
+        }
+
+    def register_metrics(self, registry=REGISTRY):
+        # Read at export time from the counters the components keep anyway
+        d, r = self.dispatcher, self.readiness
+        # In batch mode the tracker belongs to the Batcher
+        t = self.tracker if self.tracker is not None else getattr(self.FlowRunner, 'tracker', None)
+        registry.gauge('watcher_queue_depth', 'Files waiting for a dispatch worker', fn=d._queue.qsize)
+        registry.gauge('watcher_queue_size', 'Capacity of the dispatch queue', fn=lambda: d.queue_size)
+        registry.gauge('watcher_busy_workers', 'Dispatch workers handling a file', fn=lambda: len(d._started))
+        registry.counter('watcher_files_total', 'Files by dispatch outcome', ('outcome',), fn=lambda: {
+            'submitted': d.submitted, 'dispatched': d.dispatched, 'failed': d.failed,
+            'dropped': d.dropped, 'duplicate': d.duplicates})
+        registry.gauge('watcher_readiness_pending', 'Files waiting to be closed by their writer',
+                       ('backend',), fn=lambda: {r.name: len(r._pending)})
+        if t is not None:
+            registry.gauge('watcher_runs_in_flight', 'Runs holding an in-flight slot', fn=lambda: t._slots)
+            registry.gauge('watcher_runs_max_in_flight', 'Cap on runs in flight', fn=lambda: t.max_in_flight)
+            registry.counter('watcher_runs_total', 'Finished runs by outcome', ('outcome',), fn=lambda: {
+                'succeeded': t.succeeded, 'failed': t.failed, 'retried': t.retried})
+        if (c := self.coalescer) is not None:
+            registry.gauge('watcher_coalescer_active_paths', 'Files whose events are being coalesced',
+                           fn=lambda: len(c._paths))
+        if (s := self.shards) is not None:
+            registry.gauge('watcher_shards_owned', 'Shards this node holds a lease on', fn=lambda: len(s.owned()))
+        registry.counter('globus_api_calls_total', 'Globus API requests by result', ('result',), fn=lambda: {
+            'sent': GOVERNOR.calls, 'throttled': GOVERNOR.throttled, 'retried': GOVERNOR.retried,
+            'failed': GOVERNOR.failed})
+        registry.counter('globus_api_rate_limited_seconds_total', 'Seconds calls waited for the rate limiter',
+                         fn=lambda: GOVERNOR.rate_limited_seconds)
+        registry.gauge('globus_api_circuit_open', '1 while the circuit breaker holds calls back',
+                       fn=lambda: int(GOVERNOR.breaker.state != GOVERNOR.breaker.CLOSED))
+
+    def log_stats(self):
+        LOGGER.info("Watcher stats", **self.stats())
+
+
+# Events that count as activity in a dataset directory; opening or reading a file does not
+DATASET_EVENTS = frozenset((EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED, EVENT_TYPE_DELETED,
+                            EVENT_TYPE_CLOSED))
 
 
 class Handler(FileSystemEventHandler):
-    def __init__(self, FlowRunner, patterns):
+    def __init__(self, FlowRunner, patterns, readiness=None, dispatcher=None, on_new_directory=None,
+                 datasets=None, coalescer=None):
         super(FileSystemEventHandler).__init__()
         self.logic_function = FlowRunner
         self.patterns = patterns
+        self.matcher = PathMatcher.from_patterns(patterns)
+        self.readiness = make_readiness() if readiness is None else readiness
+        self.dispatcher = dispatcher
+        self.on_new_directory = on_new_directory
+        self.datasets = datasets
+        self.coalescer = coalescer
+
+    def handed_on(self, src, dest):
+        """True when a file renamed from the accepted name `src` to `dest` was handed on under its old name."""
+        if (journal := getattr(self.dispatcher, 'journal', None)) is None:
+            # It was, when it was created under its old name
+            return True
+        return journal.moved(src, dest) in DELIVERED_STATES
+
+    def on_ready(self, source, waited):
+        if waited is None:
+            LOGGER.info("File vanished before it was ready: %s", os.path.basename(source))
+            return None
+        LOGGER.info("File ready: %s (waited %.3fs)", os.path.basename(source), waited)
+        LOGGER.info("Starting flow...")
+        self.logic_function(source)
 
     # This is the callback function for file events.
     # You can edit it to trigger at file creation, modification or deletion,
     # and have different behaviors for each.
     def on_any_event(self, event):
+        EVENTS.labels(event.event_type).inc()
+        self.readiness.notify(event)
         if (evt := event).is_directory:
+            if evt.event_type == EVENT_TYPE_CREATED and self.on_new_directory is not None:
+                self.on_new_directory(evt.src_path)
+            return None
+        elif self.datasets is not None:
+            # Files travel with their dataset directory
+            if evt.event_type in DATASET_EVENTS:
+                source = evt.dest_path or evt.src_path
+                self.datasets.notify(source, self.matcher.matches(source))
+            return None
+        elif self.coalescer is not None:
+            # One submission per file once its events settle, under its final name
+            if evt.event_type in COALESCE_EVENTS:
+                self.coalescer.notify(evt)
             return None
         else:
-            if evt.event_type == EVENT_TYPE_CREATED:
-                source = evt.src_path
-                LOGGER.info(f"File created: {os.path.basename(source)}")
-                for pattern in self.patterns:
-                    if source.endswith(pattern):
-                        LOGGER.info(f"File ends with {pattern}")
-                        while has_handle(source):
-                            # Block action until file is closed
-                            LOGGER.info(f"Waiting for file {os.path.basename(source)}")
-                            time.sleep(5)
-                        LOGGER.info("Starting flow...")
-                        self.logic_function(source)
+            if evt.event_type in (EVENT_TYPE_CREATED, EVENT_TYPE_MOVED):
+                # A file renamed into place, e.g. foo.tmp to foo.h5, is created under its final name
+                source = evt.dest_path or evt.src_path
+                if not self.matcher.matches(source):
+                    LOGGER.debug("File ignored: %s", source)
+                    return None
+                if evt.event_type == EVENT_TYPE_MOVED and self.matcher.matches(evt.src_path) \
+                        and self.handed_on(evt.src_path, source):
+                    LOGGER.info(f"File renamed after it was handed on: {os.path.basename(source)}")
+                    return None
+                LOGGER.info("File created: %s", os.path.basename(source))
+                SPANS.mark(source, 'created')
+                if self.dispatcher is not None:
+                    # Workers wait for the file to be closed and start the flow
+                    self.dispatcher.submit(source)
+                else:
+                    # Action is deferred until the readiness engine sees the file closed
+                    self.readiness.when_ready(source, self.on_ready)
                 return None
             elif evt.event_type == EVENT_TYPE_MODIFIED:
                 LOGGER.debug("Event type not implemented")